@@ -0,0 +1,77 @@
+""" Compares the ROI-restricted blur of Anonymiser.anonymise with a full-frame blur for an increasing fraction
+    of the image area covered by the targets
+
+    Usage (from the root folder): 
+        python -m benchmarks.bench_anonymiser [--width 4000] [--height 3000] [--kernel 57] [--anonym_type blur]
+"""
+import argparse
+import time
+
+import numpy as np
+
+from image_anonymiser.backend.anonymiser import BLUR_TYPES, Anonymiser, blur_image
+from image_anonymiser.backend.regions import TargetRegions
+
+AREA_FRACTIONS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0]
+NUM_BOXES = 8
+
+
+def make_boxes(height, width, area_fraction, num_boxes=NUM_BOXES, seed=0):
+    """ Returns non-overlapping square boxes (on a grid) that cover approximately area_fraction of the image
+    """
+    rng = np.random.default_rng(seed)
+    grid = int(np.ceil(np.sqrt(num_boxes)))
+    cell_h, cell_w = height // grid, width // grid
+    side = int(np.sqrt(area_fraction * height * width / num_boxes))
+    side = max(1, min(side, cell_h, cell_w))
+    cells = rng.choice(grid * grid, size=num_boxes, replace=False)
+    boxes = list()
+    for cell in cells:
+        row, col = divmod(int(cell), grid)
+        y1 = row * cell_h + int(rng.integers(0, cell_h - side + 1))
+        x1 = col * cell_w + int(rng.integers(0, cell_w - side + 1))
+        boxes.append([x1, y1, x1 + side, y1 + side])
+    return boxes
+
+
+def full_frame_blur(image, targets, blur_kernel, anonym_type="blur"):
+    """ Reference implementation: blur the full frame and copy back the target pixels
+    """
+    output = np.copy(image)
+    blur = blur_image(image, blur_kernel, anonym_type)
+    return targets.apply(output, source=blur)
+
+
+def timeit(fn, repeat):
+    timings = list()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def main(args):
+    image = np.random.default_rng(0).integers(0, 256, (args.height, args.width, 3), dtype=np.uint8)
+    kernel = (args.kernel, args.kernel)
+    anonymiser = Anonymiser()
+    print(f"image: {args.width}x{args.height}, {args.anonym_type}, kernel: {args.kernel}, boxes: {NUM_BOXES}")
+    print(f"{'area':>8} {'full (ms)':>10} {'roi (ms)':>10} {'speedup':>8} {'identical':>10}")
+    for fraction in AREA_FRACTIONS:
+        targets = TargetRegions.from_boxes(make_boxes(args.height, args.width, fraction))
+        covered = targets.to_mask(image.shape).mean()
+        t_full, ref = timeit(lambda: full_frame_blur(image, targets, kernel, args.anonym_type), args.repeat)
+        t_roi, out = timeit(lambda: anonymiser.anonymise(image, targets, args.anonym_type, kernel), args.repeat)
+        print(f"{covered:>8.2%} {t_full * 1000:>10.1f} {t_roi * 1000:>10.1f} {t_full / t_roi:>7.1f}x "
+              f"{str(np.array_equal(ref, out)):>10}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--width", default=4000, type=int, help="Width of the synthetic image. Default is 4000")
+    parser.add_argument("--height", default=3000, type=int, help="Height of the synthetic image. Default is 3000")
+    parser.add_argument("--kernel", default=57, type=int, help="Blur kernel size (odd). Default is 57")
+    parser.add_argument("--anonym_type", default="blur", choices=BLUR_TYPES, help="Blur type. Default is blur")
+    parser.add_argument("--repeat", default=3, type=int, help="Number of runs per measure (min is kept). Default is 3")
+    args = parser.parse_args()
+    main(args)
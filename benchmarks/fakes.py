@@ -0,0 +1,77 @@
+""" Stand-in detection models used by the benchmarks: they don't need any weights or deep learning library and
+    return deterministic predictions (in the same format as the real detectors) for synthetic images
+"""
+import time
+
+import numpy as np
+
+from image_anonymiser.models.base import DetectionModel
+from image_anonymiser.models.masks import encode_rle_from_crop
+from image_anonymiser.models.predictions import get_instance_ids
+
+
+class FakeDetector(DetectionModel):
+    """ Returns random boxes covering approximately box_fraction of the image (per box)
+
+    Params:
+        num_instances: int, number of objects returned for each image
+        box_fraction: float, area of each box as a fraction of the image area
+        latency_ms: float, simulated inference time
+        class_names: list[str], classes assigned (in turn) to the objects
+        seed: int, seed of the random generator
+    """
+
+    def __init__(self, num_instances=10, box_fraction=0.01, latency_ms=0, class_names=["object"], seed=0):
+        super().__init__()
+        self.num_instances = num_instances
+        self.box_fraction = box_fraction
+        self.latency_ms = latency_ms
+        self.class_names = list(class_names)
+        self.name2int = {name: i for i, name in enumerate(self.class_names)}
+        self.seed = seed
+
+    @classmethod
+    def get_class_names(cls, class_names=["object"], **params):
+        return list(class_names)
+
+    def detect(self, image):
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+        boxes = self._make_boxes(image.shape)
+        pred_classes = np.arange(len(boxes)) % len(self.class_names)
+        predictions = dict()
+        predictions["pred_classes"] = pred_classes
+        predictions["pred_labels"] = [self.class_names[i] for i in np.unique(pred_classes)]
+        predictions["scores"] = np.full(len(boxes), 0.9)
+        predictions["boxes"] = boxes
+        predictions["masks"] = []
+        predictions["class_names"] = self.class_names
+        predictions["name2int"] = self.name2int
+        predictions["instance_ids"] = get_instance_ids(pred_classes)
+        return predictions
+
+    def _make_boxes(self, shape):
+        h, w = shape[:2]
+        rng = np.random.default_rng(self.seed)
+        side_h = max(1, int(h * np.sqrt(self.box_fraction)))
+        side_w = max(1, int(w * np.sqrt(self.box_fraction)))
+        x1 = rng.integers(0, max(1, w - side_w), self.num_instances)
+        y1 = rng.integers(0, max(1, h - side_h), self.num_instances)
+        return np.stack([x1, y1, x1 + side_w, y1 + side_h], axis=1).astype(np.int64)
+
+
+class FakeSegmentationDetector(FakeDetector):
+    """ Same as FakeDetector but also returns an elliptic segmentation mask inside each box
+    """
+
+    def detect(self, image):
+        predictions = super().detect(image)
+        masks = list()
+        for x1, y1, x2, y2 in predictions["boxes"].tolist():
+            ys, xs = np.ogrid[:y2 - y1, :x2 - x1]
+            cx, cy = (x2 - x1) / 2, (y2 - y1) / 2
+            rx, ry = max(1, (x2 - x1) / 2), max(1, (y2 - y1) / 2)
+            ellipse = ((xs - cx) / rx) ** 2 + ((ys - cy) / ry) ** 2 <= 1
+            masks.append(encode_rle_from_crop(ellipse, (x1, y1), image.shape[:2]))
+        predictions["masks"] = masks
+        return predictions
@@ -0,0 +1,250 @@
+""" Compares the predictions of a detector (as configured, the reference) with variants of the same detector (e.g.
+    run with the onnx backend or quantized to INT8) on a folder of images: the detections are matched by class and
+    box IoU, and the script reports for each variant its recall and precision, the IoU of the matched boxes and masks,
+    the difference of their scores and its latency speedup. The exit code is 1 if the agreement of a variant is below
+    the tolerances (so it can be used as a check before changing the backend of a deployment). The onnx variants of
+    the configured models are checked with fixed tolerances on a few fixture images by tests/test_parity.py
+
+    Usage (from the root folder):
+        python -m benchmarks.parity images_dir --model "Face detection" [--bconfig config.yml]
+            [--variants backend=onnx backend=onnx,quantization=int8 quantization=int8] [--output results.json]
+"""
+import argparse
+import copy
+import json
+import statistics
+import sys
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+import yaml
+
+from benchmarks.run import get_metadata
+from image_anonymiser.backend.detector import CONFIG_DIR
+from image_anonymiser.backend.registry import ModelRegistry
+from image_anonymiser.backend.video import box_iou
+from image_anonymiser.cli.folder import list_images
+from image_anonymiser.models.masks import decode_mask
+
+
+def get_detector_config(bconfig, model):
+    """ Returns the config of a detector given its name or its index in the detectors section
+    """
+    with open(CONFIG_DIR / bconfig, "r") as f:
+        detectors = yaml.safe_load(f)["detectors"]
+    names = [d["name"] for d in detectors]
+    if model in names:
+        return detectors[names.index(model)]
+    if model.isdigit() and int(model) < len(detectors):
+        return detectors[int(model)]
+    raise ValueError(f"model: {model} not found; use one of {names} (or their index)")
+
+
+def parse_params(variant):
+    """ Returns the params of a variant given as key=value pairs separated by commas (the values are parsed as YAML,
+        e.g. "backend=onnx,quantization=int8")
+    """
+    params = dict()
+    for item in variant.split(","):
+        key, _, value = item.partition("=")
+        params[key] = yaml.safe_load(value)
+    return params
+
+
+def match_predictions(reference, candidate, iou_threshold=0.5):
+    """ Matches greedily (by decreasing IoU) the detections of the same class of two predictions
+
+    Returns:
+        matches: list[tuple(int, int, float)], indices of the matched detections in reference and candidate, and
+                the IoU of their boxes
+    """
+    boxes = np.asarray(reference["boxes"], dtype=np.float64).reshape(-1, 4)
+    other_boxes = np.asarray(candidate["boxes"], dtype=np.float64).reshape(-1, 4)
+    if len(boxes) == 0 or len(other_boxes) == 0:
+        return []
+    ious = box_iou(boxes, other_boxes)
+    ious[np.asarray(reference["pred_classes"])[:, None] != np.asarray(candidate["pred_classes"])[None, :]] = 0
+    matches = list()
+    matched, other_matched = set(), set()
+    for flat in np.argsort(-ious, axis=None):
+        i, j = np.unravel_index(flat, ious.shape)
+        if ious[i, j] < iou_threshold:
+            break
+        if i in matched or j in other_matched:
+            continue
+        matched.add(i)
+        other_matched.add(j)
+        matches.append((int(i), int(j), float(ious[i, j])))
+    return matches
+
+
+def mask_iou(mask, other):
+    mask, other = decode_mask(mask), decode_mask(other)
+    union = np.count_nonzero(mask | other)
+    return float(np.count_nonzero(mask & other) / union) if union > 0 else 1.0
+
+
+def compare(reference, candidate, iou_threshold=0.5):
+    """ Returns the agreement statistics of the predictions of two models on the same image
+    """
+    matches = match_predictions(reference, candidate, iou_threshold)
+    stats = {"reference": len(reference["pred_classes"]),
+             "candidate": len(candidate["pred_classes"]),
+             "matched": len(matches),
+             "box_ious": [iou for _, _, iou in matches],
+             "score_diffs": [abs(float(reference["scores"][i]) - float(candidate["scores"][j])) for i, j, _ in matches],
+             "mask_ious": list()}
+    if len(reference["masks"]) > 0 and len(candidate["masks"]) > 0:
+        stats["mask_ious"] = [mask_iou(reference["masks"][i], candidate["masks"][j]) for i, j, _ in matches]
+    return stats
+
+
+def timed_detect(model, image):
+    start = time.perf_counter()
+    predictions = model.detect(image)
+    return predictions, time.perf_counter() - start
+
+
+def summarize(totals, timings, reference_ms):
+    """ Returns the agreement and latency of a variant over all the images
+    """
+    mean = lambda values: statistics.mean(values) if values else None
+    result = {"detections": totals["reference"],
+              "recall": totals["matched"] / totals["reference"] if totals["reference"] else 1.0,
+              "precision": totals["matched"] / totals["candidate"] if totals["candidate"] else 1.0,
+              "box_iou": mean(totals["box_ious"]),
+              "mask_iou": mean(totals["mask_ious"]),
+              "score_diff": mean(totals["score_diffs"]),
+              "median_ms": statistics.median(timings) * 1000}
+    result["speedup"] = reference_ms / result["median_ms"]
+    return result
+
+
+def is_ok(result, min_recall, min_iou):
+    """ Returns True if the agreement of a variant (see summarize) is within the tolerances
+    """
+    return bool(min(result["recall"], result["precision"]) >= min_recall) \
+        and (result["box_iou"] or 1.0) >= min_iou and (result["mask_iou"] or 1.0) >= min_iou
+
+
+def compare_variants(d, variants, images_dir, max_images=None, iou_threshold=0.5, progress=None):
+    """ Runs a detector (the reference) and its variants on the images of a folder
+
+    Params:
+        d: dict, config of the detector (see get_detector_config)
+        variants: list[dict], params of each variant, replacing the ones of the config (see parse_params)
+        images_dir: str, folder of the images (sub-folders included)
+        max_images: int, maximum number of images used (all the images of the folder if None)
+        iou_threshold: float, minimum box IoU for two detections to match
+        progress: function(done, total), optional, called after each image
+
+    Returns:
+        reference_ms: float, median latency of the reference
+        results: list[dict], agreement and latency of each variant (see summarize)
+    """
+    configs = [d]
+    for params in variants:
+        config = copy.deepcopy(d)
+        config.setdefault("params", dict()).update(params)
+        configs.append(config)
+    registry = ModelRegistry(configs)
+    models = [registry.get(i) for i in range(len(configs))]
+    paths = list_images(images_dir)[:max_images]
+    if not paths:
+        raise ValueError(f"No image found in {images_dir}")
+    totals = [{"reference": 0, "candidate": 0, "matched": 0, "box_ious": [], "score_diffs": [], "mask_ious": []}
+              for _ in variants]
+    timings = [list() for _ in models]
+    for i, path in enumerate(paths):
+        image = cv2.cvtColor(cv2.imread(str(Path(images_dir) / path), cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB)
+        if i == 0: # warm-up (first run of the networks, export of the onnx graphs...)
+            for model in models:
+                model.detect(image)
+        predictions = list()
+        for model, model_timings in zip(models, timings):
+            pred, seconds = timed_detect(model, image)
+            predictions.append(pred)
+            model_timings.append(seconds)
+        for variant_totals, candidate in zip(totals, predictions[1:]):
+            for key, value in compare(predictions[0], candidate, iou_threshold=iou_threshold).items():
+                variant_totals[key] += value
+        if progress is not None:
+            progress(i + 1, len(paths))
+    reference_ms = statistics.median(timings[0]) * 1000
+    results = [summarize(variant_totals, variant_timings, reference_ms)
+               for variant_totals, variant_timings in zip(totals, timings[1:])]
+    return reference_ms, results
+
+
+def print_progress(done, total):
+    print(f"\r{done}/{total} images", end="", file=sys.stderr, flush=True)
+
+
+def main(args):
+    d = get_detector_config(args.bconfig, args.model)
+    variants = [parse_params(variant) for variant in args.variants]
+    reference_ms, results = compare_variants(d, variants, args.images_dir, args.max_images, args.iou_threshold,
+                                             progress=print_progress)
+    print(file=sys.stderr)
+    images = len(list_images(args.images_dir)[:args.max_images])
+    print(f"{d['name']} ({d['class']}), {images} images, reference params: {d.get('params')}")
+    print(f"reference latency: {reference_ms:.1f} ms")
+    print(f"{'variant':>36} {'recall':>7} {'prec.':>7} {'box IoU':>8} {'mask IoU':>8} {'score':>7} {'ms':>8} "
+          f"{'speedup':>8}")
+    fmt = lambda value: "-" if value is None else f"{value:.4f}"
+    for params, result in zip(variants, results):
+        result["params"] = params
+        result["ok"] = is_ok(result, args.min_recall, args.min_iou)
+        name = ",".join(f"{key}={value}" for key, value in params.items())
+        print(f"{name:>36} {fmt(result['recall']):>7} {fmt(result['precision']):>7} {fmt(result['box_iou']):>8} "
+              f"{fmt(result['mask_iou']):>8} {fmt(result['score_diff']):>7} {result['median_ms']:>8.1f} "
+              f"{result['speedup']:>7.2f}x {'OK' if result['ok'] else 'FAILED'}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"meta": get_metadata(), "model": d, "images": images, "reference_ms": reference_ms,
+                       "results": results}, f, indent=2)
+    return 0 if all(result["ok"] for result in results) else 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("images_dir",
+                        type=str,
+                        help="Folder of the images used for the comparison (sub-folders included)")
+    parser.add_argument("--bconfig",
+                        default="config.yml",
+                        type=str,
+                        help="Name of the backend config file")
+    parser.add_argument("--model",
+                        required=True,
+                        type=str,
+                        help="Detection model, name (as in the config file) or index in the detectors section")
+    parser.add_argument("--variants",
+                        default=["backend=onnx"],
+                        nargs="+",
+                        help="Variants compared to the model, each given as params (key=value separated by commas) "
+                             "that replace the ones of the config file. Default is backend=onnx")
+    parser.add_argument("--max_images",
+                        default=None,
+                        type=int,
+                        help="Maximum number of images used. Default is all the images of the folder")
+    parser.add_argument("--iou_threshold",
+                        default=0.5,
+                        type=float,
+                        help="Minimum box IoU for two detections to match. Default is 0.5")
+    parser.add_argument("--min_recall",
+                        default=0.99,
+                        type=float,
+                        help="Minimum recall and precision of a variant for the check. Default is 0.99")
+    parser.add_argument("--min_iou",
+                        default=0.95,
+                        type=float,
+                        help="Minimum mean IoU of the matched boxes and masks for the check. Default is 0.95")
+    parser.add_argument("--output",
+                        default=None,
+                        type=str,
+                        help="JSON file where the results (and metadata such as the git commit) are saved")
+    args = parser.parse_args()
+    sys.exit(main(args))
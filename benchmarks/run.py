@@ -0,0 +1,247 @@
+""" Per-stage latency benchmarks of the anonymisation pipeline on synthetic images
+    The detection models are replaced by the stand-in detectors of benchmarks/fakes.py (see configs/_bench.yml),
+    so the suite runs offline, on CPU and without any model weights
+
+    Usage (from the root folder):
+        python -m benchmarks.run [--sizes 0.3 1 4 12 40] [--stages ...] [--output results.json] [--compare old.json]
+"""
+import argparse
+import base64
+import datetime
+import io
+import json
+import platform
+import statistics
+import subprocess
+import time
+
+import cv2
+import numpy as np
+import PIL.Image
+
+from image_anonymiser.backend import serialization
+from image_anonymiser.backend.anonymiser import Anonymiser
+from image_anonymiser.backend.detector import DetectorBackend
+from image_anonymiser.models.predictions import to_arrays, to_serializable
+
+CONFIG = "_bench.yml"
+BOX_MODEL = 0 # index of the fake box detector in the config
+MASK_MODEL = 1 # index of the fake segmentation detector in the config
+DEFAULT_SIZES = [0.3, 1, 4, 12, 40] # in megapixels
+BLUR_KERNEL = (29, 29)
+
+
+def make_image(megapixels, seed=0):
+    """ Returns a synthetic 4:3 RGB image (smooth gradients and noise, so it compresses like a photo)
+    """
+    width = int(np.sqrt(megapixels * 1e6 * 4 / 3))
+    height = int(width * 3 / 4)
+    rng = np.random.default_rng(seed)
+    xs = np.linspace(0, 255, width, dtype=np.float32)
+    ys = np.linspace(0, 255, height, dtype=np.float32)
+    image = np.empty((height, width, 3), dtype=np.uint8)
+    image[..., 0] = (xs[None, :] * 0.7 + ys[:, None] * 0.3)
+    image[..., 1] = (xs[None, :] * 0.3 + ys[:, None] * 0.7)
+    image[..., 2] = 128
+    image = cv2.add(image, rng.integers(0, 32, image.shape, dtype=np.uint8))
+    return image
+
+
+class Stages():
+    """ Functions benchmarked for each image size. Each stage is a method named `stage_<name>` that prepares its
+        inputs and returns the function to time
+    """
+
+    def __init__(self, image):
+        self.image = image
+        self.detector = DetectorBackend(CONFIG)
+        self.anonymiser = Anonymiser()
+        self.box_predictions = self.detector.detect(image, BOX_MODEL)
+        self.mask_predictions = self.detector.detect(image, MASK_MODEL)
+
+    @classmethod
+    def names(cls):
+        return [name[len("stage_"):] for name in dir(cls) if name.startswith("stage_")]
+
+    def get(self, name):
+        return getattr(self, f"stage_{name}")()
+
+    def stage_decode_jpeg_pil(self):
+        data = self._encode_jpeg()
+        return lambda: np.array(PIL.Image.open(io.BytesIO(data)))
+
+    def stage_decode_jpeg_cv2(self):
+        data = self._encode_jpeg()
+        return lambda: cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+    def stage_detect_boxes(self):
+        return lambda: self.detector.detect(self.image, BOX_MODEL)
+
+    def stage_detect_masks(self):
+        return lambda: self.detector.detect(self.image, MASK_MODEL)
+
+    def stage_regions_box(self):
+        class_name = self.box_predictions["pred_labels"][0]
+        return lambda: self.detector.get_target_regions(class_name, "all", "box", self.box_predictions)
+
+    def stage_regions_mask(self):
+        class_name = self.mask_predictions["pred_labels"][0]
+        return lambda: self.detector.get_target_regions(class_name, "all", "mask", self.mask_predictions)
+
+    def stage_anonymise_blur(self):
+        targets = self._box_targets()
+        return lambda: self.anonymiser.anonymise(self.image, targets, anonym_type="blur", blur_kernel=BLUR_KERNEL)
+
+    def stage_anonymise_pyramid_blur(self):
+        targets = self._box_targets()
+        return lambda: self.anonymiser.anonymise(self.image, targets, anonym_type="pyramid_blur",
+                                                 blur_kernel=BLUR_KERNEL)
+
+    def stage_anonymise_box_blur(self):
+        targets = self._box_targets()
+        return lambda: self.anonymiser.anonymise(self.image, targets, anonym_type="box_blur", blur_kernel=BLUR_KERNEL)
+
+    def stage_anonymise_pixelate(self):
+        targets = self._box_targets()
+        return lambda: self.anonymiser.anonymise(self.image, targets, anonym_type="pixelate", blur_kernel=BLUR_KERNEL)
+
+    def stage_anonymise_color(self):
+        targets = self._box_targets()
+        return lambda: self.anonymiser.anonymise(self.image, targets, anonym_type="color", color=[0, 0, 0])
+
+    def stage_anonymise_blur_mask(self):
+        class_name = self.mask_predictions["pred_labels"][0]
+        targets = self.detector.get_target_regions(class_name, "all", "mask", self.mask_predictions)
+        return lambda: self.anonymiser.anonymise(self.image, targets, anonym_type="blur", blur_kernel=BLUR_KERNEL)
+
+    def stage_visualise_boxes(self):
+        def run():
+            # the layer of the model boxes is cached by the visualizer: cleared so that every call renders it
+            self.detector.visualizer.clear()
+            return self.detector.visualise_boxes(self.image, self.box_predictions)
+        return run
+
+    def stage_visualise_boxes_cached(self):
+        self.detector.visualise_boxes(self.image, self.box_predictions)
+        return lambda: self.detector.visualise_boxes(self.image, self.box_predictions)
+
+    def stage_serialize_json(self):
+        """ Round trip of the json transport (client encoding, server decoding and response)
+        """
+        def fn():
+            buff = io.BytesIO()
+            PIL.Image.fromarray(self.image).save(buff, format="JPEG")
+            request = json.dumps({"image_str": base64.b64encode(buff.getvalue()).decode("utf-8"), "model_index": 1})
+            image_str = json.loads(request)["image_str"]
+            np.array(PIL.Image.open(io.BytesIO(base64.b64decode(image_str))))
+            response = json.dumps({"predictions": to_serializable(self.mask_predictions)})
+            return to_arrays(json.loads(response)["predictions"])
+        return fn
+
+    def stage_serialize_binary(self):
+        """ Round trip of the binary transport (client encoding, server decoding and response)
+        """
+        def fn():
+            body, headers = serialization.encode_image(self.image)
+            serialization.decode_image(body, headers[serialization.SHAPE_HEADER])
+            return serialization.decode_predictions(serialization.encode_predictions(self.mask_predictions))
+        return fn
+
+    def _encode_jpeg(self):
+        return cv2.imencode(".jpg", self.image)[1].tobytes()
+
+    def _box_targets(self):
+        class_name = self.box_predictions["pred_labels"][0]
+        return self.detector.get_target_regions(class_name, "all", "box", self.box_predictions)
+
+
+def measure(fn, repeat):
+    fn() # warm-up
+    timings = list()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def get_metadata():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"commit": commit,
+            "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "numpy": np.__version__,
+            "opencv": cv2.__version__
+            }
+
+
+def compare(results, baseline_file):
+    """ Prints the ratio between the current timings and the ones stored in a previous results file
+    """
+    with open(baseline_file, "r") as f:
+        baseline = json.load(f)
+    reference = {(r["stage"], r["megapixels"]): r["median_ms"] for r in baseline["results"]}
+    print(f"\ncomparison with {baseline_file} (commit {baseline['meta'].get('commit')}), ratio = current / baseline")
+    for r in results:
+        key = (r["stage"], r["megapixels"])
+        if key in reference:
+            print(f"{r['stage']:>22} {r['megapixels']:>6}MP {r['median_ms'] / reference[key]:>7.2f}x")
+
+
+def main(args):
+    stages = args.stages or Stages.names()
+    results = list()
+    print(f"{'stage':>22} {'size':>8} {'median (ms)':>12} {'min (ms)':>10}")
+    for megapixels in args.sizes:
+        image = make_image(megapixels)
+        suite = Stages(image)
+        for name in stages:
+            timings = measure(suite.get(name), args.repeat)
+            result = {"stage": name,
+                      "megapixels": megapixels,
+                      "height": image.shape[0],
+                      "width": image.shape[1],
+                      "repeat": args.repeat,
+                      "median_ms": statistics.median(timings) * 1000,
+                      "min_ms": min(timings) * 1000
+                      }
+            results.append(result)
+            print(f"{name:>22} {megapixels:>6}MP {result['median_ms']:>12.1f} {result['min_ms']:>10.1f}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"meta": get_metadata(), "results": results}, f, indent=2)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes",
+                        default=DEFAULT_SIZES,
+                        nargs="+",
+                        type=float,
+                        help=f"Sizes of the synthetic images in megapixels. Default is {DEFAULT_SIZES}")
+    parser.add_argument("--stages",
+                        default=None,
+                        nargs="+",
+                        choices=Stages.names(),
+                        help="Stages to run. Default is all the stages")
+    parser.add_argument("--repeat",
+                        default=5,
+                        type=int,
+                        help="Number of timed runs per stage and size. Default is 5")
+    parser.add_argument("--output",
+                        default=None,
+                        type=str,
+                        help="JSON file where the results (and metadata such as the git commit) are saved")
+    parser.add_argument("--compare",
+                        default=None,
+                        type=str,
+                        help="JSON file produced by a previous run, used to print the ratio of the timings")
+    args = parser.parse_args()
+    main(args)
@@ -6,8 +6,10 @@ from pathlib import Path
 
 import gradio as gr
 
-from image_anonymiser.backend.anonymiser import AnonymiserBackend
+from image_anonymiser.backend.anonymiser import ANONYM_TYPES, BLUR_TYPES, AnonymiserBackend
+from image_anonymiser.backend.cache import image_digest
 from image_anonymiser.backend.detector import DetectorBackend
+from image_anonymiser.backend.metrics import start_http_server
 
 DEFAULT_PORT = 7861
 PAR_DIR = Path(__file__).resolve().parent
@@ -24,13 +26,14 @@ will also be updated based on the model output and classes/instances identified.
 anonymisation options will not be displayed.
 
 - **Choosing the Anonymisation Parameters**:
-    * `Anonymisation type`: Can be `blur` or `color`
+    * `Anonymisation type`: Can be `blur` (gaussian blur), `pyramid_blur` or `box_blur` (faster approximations of the 
+    gaussian blur for strong blurs), `pixelate` (mosaic of blocks) or `color`
     * `Compound Anonymisation` flag: If selected, several anonymisations can be applied to the same image. e.g. using a face
     detector to blur faces and then using a text detector to color text
     * `Target Type`: Can be `box` (for bounding boxes), or `mask` (for segmentation masks). The choices are set automatically
     based on the model outputs. If for instance, there is only `box`, this means that the model doesn't support segmentation
-    * `Blur Intensity`: Value from 0 to 100%, `0` meaning no blur and `1` meaning maximum blur. Used if the `Anonymisation Type`
-    is `blur`
+    * `Blur Intensity`: Value from 0 to 100%, `0` meaning no blur and `1` meaning maximum blur (or largest blocks for 
+    `pixelate`). Used for all the anonymisation types except `color`
     * `Color`: Click to choose the color. Used if the `Anonymisation Type` is `color`
     * `Choose the class`: Object classes detected in the image. This is relevant for multi-class models. For models that detect
     only one class, the latter will be selected by default
@@ -81,7 +84,7 @@ class App():
                                     with gr.Row():
                                         with gr.Column():
                                             self.anonym_type = gr.Dropdown(label="Anonymisation type", 
-                                                choices=["blur", "color"], value="blur")
+                                                choices=ANONYM_TYPES, value="blur")
                                         with gr.Column():
                                             self.anonym_compound = gr.Checkbox(label="Compound Anonymisation")
                                     with gr.Row():
@@ -149,9 +152,11 @@ class App():
                 output[self.model_choice] = gr.Dropdown.update(value=None)
                 if image is None: 
                     cache["input_img"] = None
+                    cache["image_key"] = None
                     output[self.model_container] = gr.Group.update(visible=False)
                 else:
                     cache["input_img"] = image
+                    cache["image_key"] = image_digest(image)
                     output[self.model_container] = gr.Group.update(visible=True)
                 output[self.session_cache] = cache
                 return output
@@ -238,11 +243,14 @@ class App():
             ## Anonymisation requested
             def anonymise(anonym_type, anonym_compound, target_type, blur_intensity, anonym_color, 
                         anonym_class, anonym_instance, model_index, session_cache):
-                ''' Anonymisation function called when the button is clicked. Performs anonymisation on the input
-                    image (cached) or the previsously cached anonymised image (if the anonym_compound is True)
+                ''' Anonymisation function called when the button is clicked. A compound anonymisation is applied to
+                    the previous output, otherwise to the input image (see AnonymiserBackend.anonymise_plan). The 
+                    blurred layers of the input image are cached by the backend (shared by the sessions), so changing
+                    the blur intensity back to a value already used (or anonymising other targets with it) doesn't blur
+                    the image again
 
                 Params:
-                    anonym_type: "blur" or "color"
+                    anonym_type: one of ANONYM_TYPES
                     anonym_compound: If True, the anonymisation config is applied to the previous output
                     target_type: "box" or "mask" depending on the detector output
                     blur_intensity: value from 0 to 1 used to control the level of blur
@@ -258,22 +266,23 @@ class App():
                 '''
                 output = dict()
                 cache = session_cache
-                if anonym_compound and cache["anonym_img"] is not None:
-                    input_img = cache["anonym_img"]
-                else:
-                    input_img = cache["input_img"]
-                predictions = cache["predictions"][model_index]
-                target_regions = self.detector_backend.get_target_regions(anonym_class, anonym_instance, target_type, 
-                                predictions)
-                if anonym_type == "blur":
+                operation = {"model_index": model_index, "class_name": anonym_class, "instance": anonym_instance, 
+                             "target_type": target_type, "anonym_type": anonym_type}
+                if anonym_type in BLUR_TYPES:
                     intensity = self.anonymiser_backend.convert_intensity(blur_intensity)
-                    kernel = (intensity, intensity)
-                    anonym_img = self.anonymiser_backend.anonymise(input_img, target_regions, anonym_type=anonym_type, 
-                                                    blur_kernel=kernel)
+                    operation["blur_kernel"] = (intensity, intensity)
                 elif anonym_type == "color":
-                    color = self.anonymiser_backend.convert_color_hex_to_rgb(anonym_color)
-                    anonym_img = self.anonymiser_backend.anonymise(input_img, target_regions, anonym_type=anonym_type, 
-                                                    color=color)
+                    operation["color"] = self.anonymiser_backend.convert_color_hex_to_rgb(anonym_color)
+                predictions = {i: p for i, p in enumerate(cache["predictions"]) if p is not None}
+                if anonym_compound and cache["anonym_img"] is not None:
+                    # the blurred layers are cached for the input image, not the previous output
+                    anonym_img = self.anonymiser_backend.anonymise_plan(cache["anonym_img"], [operation], 
+                                                                        self.detector_backend, predictions)
+                else:
+                    anonym_img = self.anonymiser_backend.anonymise_plan(cache["input_img"], [operation], 
+                                                                        self.detector_backend, predictions, 
+                                                                        self.anonymiser_backend.blur_cache, 
+                                                                        cache["image_key"])
                 cache["anonym_img"] = anonym_img
                 output[self.anonym_img] = anonym_img
                 output[self.session_cache] = cache
@@ -283,6 +292,8 @@ class App():
                             self.model_choice, self.session_cache], [self.anonym_img, self.session_cache])
 
 def main(args):
+    if args.metrics_port is not None:
+        start_http_server(args.metrics_port)
     app = App(args.bconfig)
     app.make_ui()
     app.demo.launch(server_name = args.server, server_port= args.port, share=args.share, 
@@ -310,5 +321,9 @@ if __name__ == "__main__":
                         default="config.yml", 
                         type=str, 
                         help=f"Name of the backend config file")
+    parser.add_argument("--metrics_port", 
+                        default=None, 
+                        type=int, 
+                        help=f"If set, the Prometheus metrics are served on http://<server>:<metrics_port>/metrics. Default is None")
     args = parser.parse_args()
     main(args)
@@ -8,7 +8,7 @@ import PIL.Image
 import streamlit as st
 from streamlit_cropper import st_cropper
 
-from image_anonymiser.backend.anonymiser import AnonymiserBackend
+from image_anonymiser.backend.anonymiser import ANONYM_TYPES, BLUR_TYPES, AnonymiserBackend
 from image_anonymiser.backend.detector import DetectorBackend
 from image_anonymiser.backend.file_io import FileIO
 
@@ -78,7 +78,10 @@ def btn_add_user_box(image, box, label, predictions):
     coords = [x1, y1, x2, y2]
     predictions = detector.add_labeled_box(coords, label, predictions)
     st.session_state["predictions"] = predictions
-    st.session_state["pred_image"] = detector.visualise_boxes(image, predictions, True)
+    # only the user boxes are drawn, on the boxes of the model rendered by the visualizer for these predictions
+    # (cached), and in the previous pred_image of the session instead of a new copy of the image
+    st.session_state["pred_image"] = detector.visualise_boxes(image, predictions, True, 
+                                                              out=st.session_state.get("pred_image"))
 
 def btn_annotations(image, predictions, model_id, allow_save):
     """ Send the input image and the predictions (including the user annotations) to the backend
@@ -96,23 +99,23 @@ def btn_annotations(image, predictions, model_id, allow_save):
 def btn_anonymise(image, predictions, anonym_type, compound, target_type, blur_strength, color,
                 anonym_class, anonym_instance):
     ''' Function called when the user clicks on the anonymise button
-        If the compound parameter is True, it loads the previous anonym_image (if it exists) from session_state
-        It then calls the anonymise function
+        The anonymisation is applied to the previous output if the compound parameter is True, otherwise to the 
+        input image
         ##todo Change anonymise to do conversions in the backend 
     '''
-    if compound and "anonym_image" in st.session_state:
-        input_img = st.session_state["anonym_image"]
-    else:
-        input_img = image
-    target_regions = detector.get_target_regions(anonym_class, anonym_instance, target_type, predictions, True)
-    if anonym_type == "blur":
+    operation = {"model_index": st.session_state["model_index"], "class_name": anonym_class, 
+                 "instance": anonym_instance, "target_type": target_type, "anonym_type": anonym_type, 
+                 "incl_user_boxes": True, "predictions": predictions}
+    if anonym_type in BLUR_TYPES:
         strength = anonymiser.convert_intensity(blur_strength)
-        kernel = (strength, strength)
-        anonym_img = anonymiser.anonymise(input_img, target_regions, anonym_type=anonym_type, blur_kernel=kernel)
+        operation["blur_kernel"] = (strength, strength)
     elif anonym_type == "color":
-        anonym_color = anonymiser.convert_color_hex_to_rgb(color)
-        anonym_img = anonymiser.anonymise(input_img, target_regions, anonym_type=anonym_type, color=anonym_color)
-    st.session_state["anonym_image"] = anonym_img
+        operation["color"] = anonymiser.convert_color_hex_to_rgb(color)
+    if compound and "anonym_image" in st.session_state:
+        st.session_state["anonym_image"] = anonymiser.anonymise_plan(st.session_state["anonym_image"], [operation], 
+                                                                     detector)
+    else:
+        st.session_state["anonym_image"] = anonymiser.anonymise_plan(image, [operation], detector)
 
 # Functions originally used as a wrapper around the backend calls in order to cache the results
 # Not used due to performance issues when reading from cache
@@ -185,11 +188,11 @@ def create_anonym_params(image, predictions, pred_classes, pred_types):
     st.sidebar.markdown("### 3. Choose Anonymisation params")
     c1 = st.sidebar.columns(3)
     target_type = c1[0].selectbox(label="Target Type", options=pred_types)
-    anonym_type = c1[1].selectbox(label="Anonymisation", options=["blur", "color"])
+    anonym_type = c1[1].selectbox(label="Anonymisation", options=ANONYM_TYPES)
     if anonym_type == "color":
         blur_strength = None
         color = c1[2].color_picker(label="Pick Color")
-    if anonym_type == "blur":
+    if anonym_type in BLUR_TYPES:
         color = None
         blur_strength = c1[2].slider(label="Blur Strength", min_value=0.0, max_value=1.0, step=0.05, value=0.2)
     compound = st.sidebar.checkbox(label="Compound Anonymisation", key="compound")
@@ -40,11 +40,12 @@ with col[1]:
     st.markdown("""
     * `Target Type`: Can be `box` (for bounding boxes), or `mask` (for segmentation masks). The choices are set automatically
     based on the model outputs. If for instance, there is only `box`, this means that the model doesn't support segmentation
-    * `Anonymisation`: Can be `blur` or `color`
+    * `Anonymisation`: Can be `blur` (gaussian blur), `pyramid_blur` or `box_blur` (faster approximations of the gaussian
+    blur for strong blurs), `pixelate` (mosaic of blocks) or `color`
     * `Compound Anonymisation` flag: If selected, several anonymisations can be applied to the same image. e.g. using a face
     detector to blur faces and then using a text detector to color text
-    * `Blur Strength`: Value from 0 to 100%, `0` meaning no blur and `1` meaning maximum blur. Used if the `Anonymisation`
-    is `blur`
+    * `Blur Strength`: Value from 0 to 100%, `0` meaning no blur and `1` meaning maximum blur (or largest blocks for 
+    `pixelate`). Used for all the anonymisation types except `color`
     * `Color`: Click to choose the color. Used if the `Anonymisation` is `color`
     * `Choose the class`: Object classes detected in the image. This is relevant for multi-class models. For models that detect
     only one class, the latter will be selected by default
@@ -7,6 +7,7 @@ import streamlit as st
 
 from image_anonymiser.backend.detector import DetectorBackend
 from image_anonymiser.backend.file_io import FileIO
+from image_anonymiser.backend.metrics import metrics
 
 
 @st.experimental_singleton(show_spinner=False)
@@ -84,7 +85,7 @@ try:
     if not check_password():
         pass
     else:
-        tab_flagged, tab_feedback = st.tabs(["Flagged Images", "User Feedback"])
+        tab_flagged, tab_feedback, tab_metrics = st.tabs(["Flagged Images", "User Feedback", "Metrics"])
         # tab to display images flagged by the users
         with tab_flagged:
             flagged_images = file_io.list_flagged_directory()
@@ -97,6 +98,10 @@ try:
         with tab_feedback:
             st.dataframe(file_io.get_feedback().iloc[:100])
 
+        # tab to display the latency/counter metrics of the backend (Prometheus text format)
+        with tab_metrics:
+            st.code(metrics.render(), language="text")
+
 except Exception as e:
     st.error(f"Something went wrong. Please refresh and try again.")
     file_io.store_exception(e)
@@ -4,8 +4,16 @@ import cv2
 import numpy as np
 import yaml
 
+from image_anonymiser.backend.cache import BlurLayerCache, image_digest
+from image_anonymiser.backend.metrics import metrics, size_label
+from image_anonymiser.backend.regions import TargetRegions, merge_rects, rects_overlap
+
 PAR_DIR = Path(__file__).resolve().parent 
 CONFIG_DIR = PAR_DIR / "configs"
+FULL_FRAME_RATIO = 0.6 # above this fraction of the image area, the blur is computed on the full frame
+BLUR_TYPES = ["blur", "pyramid_blur", "box_blur", "pixelate"] # anonymisations parametrised by blur_kernel
+ANONYM_TYPES = BLUR_TYPES + ["color"]
+PYRAMID_MIN_KERNEL = 7 # the pyramid blur downsamples the image while the kernel stays above this size
 
 class AnonymiserBackend():
     """ Interface to a backend that returns an anonymised image
@@ -15,10 +23,13 @@ class AnonymiserBackend():
         config_file = CONFIG_DIR / config
         with open(config_file, 'r') as file:
             self.config = yaml.safe_load(file)
-        anonymiser = Anonymiser()
-        self.anonymise = anonymiser.anonymise
+        self.anonymiser = Anonymiser()
+        self.anonymise = self.anonymiser.anonymise
         self.max_blur_intensity = self.config["anonymiser"]["max_blur_intensity"]
         self.min_blur_intensity = self.config["anonymiser"]["min_blur_intensity"]
+        # shared by all the sessions of the apps (keyed by image digest), bounded by a single memory budget
+        blur_cache_mb = self.config["anonymiser"].get("blur_cache_mb", 0)
+        self.blur_cache = BlurLayerCache(blur_cache_mb) if blur_cache_mb > 0 else None
 
     def convert_intensity(self, intensity):
         """ Converts a blur intensity from percentage to a kernel value used by the anonymise function
@@ -34,6 +45,50 @@ class AnonymiserBackend():
         result = list(int(code[i:i+2], 16) for i in [0, 2, 4])
         return result 
 
+    def anonymise_plan(self, image, plan, detector, predictions=None, blur_cache=None, image_key=None):
+        """ Applies an anonymisation plan (several anonymisations, e.g. blur the faces then color the text) to an 
+            image in a single pass, see Anonymiser.anonymise_steps
+
+        Params:
+            image: numpy array, input image
+            plan: list[dict], ordered operations, each with the keys:
+                - model_index: int, index of the detection model in detector.choices
+                - class_name: str, class to anonymise (the operation is skipped if the class isn't detected)
+                - instance: str or int, "all" or the id of the instance within the class
+                - target_type: str, "box" or "mask"
+                - anonym_type: str, see ANONYM_TYPES
+                - blur_kernel: tuple(int, int), kernel size of the blur (if anonym_type is in BLUR_TYPES)
+                - color: list[int], color in [R,G,B] format (if anonym_type is color)
+                - incl_user_boxes: bool, optional (default False), use the boxes added by the user
+                - predictions: dict, optional, predictions used by this operation (instead of the ones of the model)
+            detector: DetectorBackend, used to get the target regions (and to run the models whose predictions are 
+                    not provided)
+            predictions: dict, predictions already computed for the image by model index (e.g. in the app session)
+            blur_cache, image_key: see Anonymiser.anonymise_steps
+
+        Returns:
+            output: numpy array, image anonymised
+        """
+        predictions = dict(predictions or {})
+        steps = list()
+        for operation in plan:
+            model_index = operation["model_index"]
+            model_predictions = operation.get("predictions")
+            if model_predictions is None:
+                if predictions.get(model_index) is None:
+                    predictions[model_index] = detector.detect(image, model_index)
+                model_predictions = predictions[model_index]
+            incl_user_boxes = operation.get("incl_user_boxes", False)
+            if operation["class_name"] in detector.get_pred_classes(model_predictions, incl_user_boxes):
+                targets = detector.get_target_regions(operation["class_name"], operation.get("instance", "all"), 
+                                                      operation["target_type"], model_predictions, incl_user_boxes)
+            else:
+                targets = TargetRegions()
+            steps.append({"targets": targets, "anonym_type": operation["anonym_type"], 
+                          "blur_kernel": tuple(operation.get("blur_kernel", (7, 7))), 
+                          "color": list(operation.get("color", [0, 255, 255]))})
+        return self.anonymiser.anonymise_steps(image, steps, blur_cache, image_key)
+
 class Anonymiser():
     """ Perform anonymisation locally
     """
@@ -45,21 +100,234 @@ class Anonymiser():
 
         Params:
             image: numpy array, input image
-            targets: tuple(list[int], list[int]), coordinates of the pixels to anonymise
-            anonym_type: str, can be "blur" or "color"
-            blur_kernel: int, kernel size to be used by cv2.GaussianBlur
+            targets: TargetRegions (as returned by DetectorBackend.get_target_regions), or 
+                    tuple(list[int], list[int]) coordinates of the pixels to anonymise
+            anonym_type: str, can be one of BLUR_TYPES or "color" (see blur_image)
+            blur_kernel: tuple(int, int), kernel size of the blur (block size if anonym_type is "pixelate")
             color: list[int], color in [R,G,B] format
         
         Returns:
             output: numpy array, image anonymised
         """
+        check_anonym_type(anonym_type)
+        with metrics.timer("anonymise", type=anonym_type, size=size_label(image)):
+            return self._anonymise(image, targets, anonym_type, blur_kernel, color)
+
+    def anonymise_steps(self, image, steps, blur_cache=None, image_key=None):
+        """ Applies several anonymisations to an image, with the same result as calling anonymise on the output of 
+            the previous step (except that targets blurred several times with the same kernel are blurred once)
+            The image is copied once and the steps are grouped: steps of the same type and parameters (e.g. two
+            blurs with the same kernel) are applied together, so each blur is computed once for all their targets.
+            A step is only grouped with an earlier one if the steps in between don't overlap it
+            With a blur_cache, the blurs are computed on the full frame and cached: a blur whose regions don't 
+            overlap the ones of the previous groups reads the cached layer of the input image (only a masked copy)
+
+        Params:
+            image: numpy array, input image
+            steps: list[dict], ordered anonymisations with the keys targets (TargetRegions), anonym_type, 
+                    blur_kernel and color (see anonymise)
+            blur_cache: BlurLayerCache, optional, cache of the blurred layers of the image
+            image_key: str, identity of the image in blur_cache (e.g. its image_digest), computed if not provided
+
+        Returns:
+            output: numpy array, image anonymised
+        """
+        for step in steps:
+            check_anonym_type(step["anonym_type"])
+        with metrics.timer("anonymise", type="plan", size=size_label(image)):
+            output = np.copy(image)
+            if blur_cache is not None and image_key is None:
+                image_key = image_digest(image)
+            modified = list() # rects of the groups already applied (the input image is unchanged elsewhere)
+            for group in self._group_steps(steps, image.shape):
+                targets = TargetRegions.union(group["targets"])
+                if targets.is_empty():
+                    continue
+                if group["anonym_type"] in BLUR_TYPES:
+                    if blur_cache is not None and not rects_overlap(group["rects"], modified):
+                        blur = self._get_blur_layer(image, group["param"], group["anonym_type"], blur_cache, 
+                                                    image_key)
+                    else:
+                        blur = self._blur_regions(output, targets, group["param"], group["anonym_type"])
+                    targets.apply(output, source=blur)
+                else:
+                    targets.apply(output, value=group["param"])
+                modified.extend(group["rects"])
+            metrics.inc("anonymise_steps", len(steps))
+            return output
+
+    def _get_blur_layer(self, image, blur_kernel, anonym_type, blur_cache, image_key):
+        key = blur_cache.key(image_key, anonym_type, blur_kernel)
+        layer = blur_cache.get(key)
+        metrics.inc("blur_cache", type=anonym_type, result="miss" if layer is None else "hit")
+        if layer is None:
+            layer = blur_image(image, blur_kernel, anonym_type)
+            blur_cache.put(key, layer)
+        return layer
+
+    def _group_steps(self, steps, shape):
+        """ Returns the steps grouped by anonymisation type and parameter (kernel or color). A step joins the last 
+            group with the same parameters if the pixels it reads and writes (its targets, padded by the kernel 
+            radius for a blur) don't overlap the ones of the groups created after it, so the order is preserved
+        """
+        groups = list()
+        for step in steps:
+            if step["anonym_type"] in BLUR_TYPES:
+                param = step["blur_kernel"]
+                pad_x, pad_y = get_blur_padding(param, step["anonym_type"])
+            else:
+                param = step["color"]
+                pad_x, pad_y = 0, 0
+            rects = [(x1 - pad_x, y1 - pad_y, x2 + pad_x, y2 + pad_y) for x1, y1, x2, y2 in step["targets"].rects(shape)]
+            joined = None
+            for group in reversed(groups):
+                if group["anonym_type"] == step["anonym_type"] and group["param"] == param:
+                    joined = group
+                    break
+                if rects_overlap(rects, group["rects"]):
+                    break
+            if joined is None:
+                groups.append({"anonym_type": step["anonym_type"], "param": param, "targets": [step["targets"]], 
+                               "rects": rects})
+            else:
+                joined["targets"].append(step["targets"])
+                joined["rects"].extend(rects)
+        return groups
+
+    def _anonymise(self, image, targets, anonym_type, blur_kernel, color):
         output = np.copy(image)
-        if anonym_type =="blur":
-            blur = cv2.GaussianBlur(output, blur_kernel, 0)
+        if isinstance(targets, TargetRegions):
+            if targets.is_empty():
+                return output
+            if anonym_type in BLUR_TYPES:
+                blur = self._blur_regions(image, targets, blur_kernel, anonym_type)
+                targets.apply(output, source=blur)
+            else:
+                targets.apply(output, value=color)
+        elif anonym_type in BLUR_TYPES:
+            blur = blur_image(output, blur_kernel, anonym_type)
             output[targets] = blur[targets]
-        elif anonym_type =="color":
-            output[targets] = color 
         else:
-            raise ValueError(f"anonymisation type: {anonym_type} not supported; use `blur` or `color`")
+            output[targets] = color 
         return output
 
+    def _blur_regions(self, image, targets, blur_kernel, anonym_type="blur"):
+        """ Blurs the image only around the target regions
+
+        The regions are padded by the kernel radius and aligned on the grid of the blocks (pixelate) or of the 
+        downsampling (pyramid_blur), so the blur inside the targets is identical to a full-frame blur, and 
+        overlapping crops are merged. The pixels outside the crops are left uninitialised and should not be read by 
+        the caller
+
+        Returns:
+            blur: numpy array, same shape as the image, blurred at least on the target pixels
+        """
+        h, w = image.shape[:2]
+        pad_x, pad_y = get_blur_padding(blur_kernel, anonym_type) if anonym_type != "pixelate" else (0, 0)
+        gx, gy = _get_blur_grid(blur_kernel, anonym_type)
+        rects = (((x1 - pad_x) // gx * gx, (y1 - pad_y) // gy * gy, -(-(x2 + pad_x) // gx) * gx, 
+                  -(-(y2 + pad_y) // gy) * gy) for x1, y1, x2, y2 in targets.rects(image.shape))
+        rois = merge_rects((max(0, x1), max(0, y1), min(w, x2), min(h, y2)) for x1, y1, x2, y2 in rects)
+        roi_area = sum((x2 - x1) * (y2 - y1) for x1, y1, x2, y2 in rois)
+        if roi_area >= FULL_FRAME_RATIO * h * w:
+            return blur_image(image, blur_kernel, anonym_type)
+        blur = np.empty_like(image)
+        for x1, y1, x2, y2 in rois:
+            blur[y1:y2, x1:x2] = blur_image(image[y1:y2, x1:x2], blur_kernel, anonym_type)
+        return blur
+
+
+def blur_image(image, blur_kernel, anonym_type="blur"):
+    """ Returns the blurred image (same shape)
+        - blur: gaussian blur, its cost grows with the kernel size
+        - pyramid_blur: the image is downsampled (by a power of 2 per axis) so that the gaussian blur runs with a
+          small kernel, then upsampled; close to the gaussian blur for large kernels, at a fraction of the cost
+        - box_blur: 3 successive box blurs approximating the gaussian blur, their cost doesn't depend on the kernel
+        - pixelate: mosaic of blocks of blur_kernel pixels, each one filled with its mean color (the cost doesn't
+          depend on the block size)
+    """
+    blur_kernel = tuple(int(k) for k in blur_kernel)
+    if anonym_type == "pyramid_blur":
+        return _pyramid_blur(image, blur_kernel)
+    if anonym_type == "box_blur":
+        sizes = tuple(_box_size(k) for k in blur_kernel)
+        blur = image
+        for _ in range(3 if sizes != (1, 1) else 0):
+            blur = cv2.blur(blur, sizes)
+        return blur
+    if anonym_type == "pixelate":
+        return _pixelate(image, blur_kernel)
+    return cv2.GaussianBlur(image, blur_kernel, 0)
+
+
+def get_blur_padding(blur_kernel, anonym_type="blur"):
+    """ Returns the distance (x, y) in pixels beyond which the pixels of the image don't affect the blur of a pixel
+    """
+    if anonym_type == "pixelate":
+        return blur_kernel[0] - 1, blur_kernel[1] - 1
+    if anonym_type == "box_blur":
+        return tuple(max(k // 2, 3 * (_box_size(k) // 2)) for k in blur_kernel)
+    if anonym_type == "pyramid_blur":
+        # the resampling reads up to 2 pixels of the downsampled image around the blur kernel
+        return tuple(k // 2 + 2 * _pyramid_factor(k) for k in blur_kernel)
+    return blur_kernel[0] // 2, blur_kernel[1] // 2
+
+
+def _get_blur_grid(blur_kernel, anonym_type):
+    """ Returns the grid (x, y) on which the blur of a crop should start to be identical to the full-frame blur
+    """
+    if anonym_type == "pixelate":
+        return max(1, blur_kernel[0]), max(1, blur_kernel[1])
+    if anonym_type == "pyramid_blur":
+        return _pyramid_factor(blur_kernel[0]), _pyramid_factor(blur_kernel[1])
+    return 1, 1
+
+
+def _pyramid_factor(kernel):
+    factor = 1
+    while kernel // (2 * factor) >= PYRAMID_MIN_KERNEL:
+        factor *= 2
+    return factor
+
+
+def _pyramid_blur(image, blur_kernel):
+    fx, fy = (_pyramid_factor(k) for k in blur_kernel)
+    if fx == fy == 1:
+        return cv2.GaussianBlur(image, blur_kernel, 0)
+    h, w = image.shape[:2]
+    # padded to a multiple of the factors, so the downsampling averages whole blocks of pixels
+    pad_w, pad_h = -w % fx, -h % fy
+    padded = cv2.copyMakeBorder(image, 0, pad_h, 0, pad_w, cv2.BORDER_REFLECT_101) if pad_w or pad_h else image
+    small_size = ((w + pad_w) // fx, (h + pad_h) // fy)
+    small = cv2.resize(padded, small_size, interpolation=cv2.INTER_AREA)
+    small_kernel = ((blur_kernel[0] // fx) | 1, (blur_kernel[1] // fy) | 1)
+    small = cv2.GaussianBlur(small, small_kernel, 0)
+    blur = cv2.resize(small, (w + pad_w, h + pad_h), interpolation=cv2.INTER_LINEAR)
+    return blur[:h, :w]
+
+
+def _box_size(kernel):
+    """ Returns the (odd) size of the 3 box blurs approximating the gaussian blur of a kernel size (same sigma as
+        cv2.GaussianBlur), at least 3 for any kernel > 1 so that small kernels still blur
+    """
+    if kernel <= 1:
+        return 1
+    sigma = 0.3 * ((kernel - 1) * 0.5 - 1) + 0.8
+    size = int(np.sqrt(4 * sigma ** 2 + 1))
+    return max(3, size if size % 2 == 1 else size + 1)
+
+
+def _pixelate(image, blur_kernel):
+    bx, by = max(1, blur_kernel[0]), max(1, blur_kernel[1])
+    h, w = image.shape[:2]
+    # the last blocks are completed by replicating the border, so every block is averaged by a single resize
+    pad_w, pad_h = -w % bx, -h % by
+    padded = cv2.copyMakeBorder(image, 0, pad_h, 0, pad_w, cv2.BORDER_REPLICATE) if pad_w or pad_h else image
+    small = cv2.resize(padded, ((w + pad_w) // bx, (h + pad_h) // by), interpolation=cv2.INTER_AREA)
+    blocks = cv2.resize(small, (w + pad_w, h + pad_h), interpolation=cv2.INTER_NEAREST)
+    return blocks[:h, :w]
+
+
+def check_anonym_type(anonym_type):
+    if anonym_type not in ANONYM_TYPES:
+        raise ValueError(f"anonymisation type: {anonym_type} not supported; use one of {ANONYM_TYPES}")
@@ -1,26 +1,67 @@
+import asyncio
 import base64
+import binascii
 import io
 import os
+import time
+from typing import List
 
 import numpy as np
-from fastapi import FastAPI
-from PIL import Image
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import PlainTextResponse
+from fastapi.concurrency import run_in_threadpool
+from PIL import Image, UnidentifiedImageError
 from pydantic import BaseModel
 
+from image_anonymiser.backend import serialization
 from image_anonymiser.backend.detector import DetectorBackend
+from image_anonymiser.backend.metrics import CONTENT_TYPE, metrics, size_label
+from image_anonymiser.backend.scheduler import BatchScheduler
+from image_anonymiser.models.predictions import to_serializable
 
 app = FastAPI()
 detector = None
+scheduler = None
 
 class DetectionData(BaseModel):
     image_str: str
     model_index: int
 
+class BatchDetectionData(BaseModel):
+    images_str: List[str]
+    model_index: int
+
 @app.on_event("startup")
 def load_model():
-    global detector
+    global detector, scheduler
     config = os.environ.get("FASTAPICONFIG", "config.yml")
     detector = DetectorBackend(config=config, force_inapp=True)
+    batching = detector.config["predictor"].get("batching", dict())
+    scheduler = BatchScheduler(detector.detect_batch, **batching)
+
+@app.on_event("shutdown")
+async def stop_scheduler():
+    await scheduler.close()
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    start = time.perf_counter()
+    status = 500 # unhandled exception (re-raised after it is recorded)
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # labelled by the route template (set by the router), not the raw path: unknown urls would create new series
+        route = request.scope.get("route")
+        endpoint = route.path if route is not None else "other"
+        if endpoint != "/metrics":
+            metrics.observe("request", time.perf_counter() - start, endpoint=endpoint)
+            metrics.inc("requests", endpoint=endpoint, status=status)
+
+@app.get("/metrics")
+def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type=CONTENT_TYPE)
 
 @app.get("/info")
 def get_api_info():
@@ -30,11 +71,69 @@ def get_api_info():
             }
 
 @app.post("/detect")
-def get_predictions(payload: DetectionData):
+async def get_predictions(payload: DetectionData):
     payload = payload.dict()
     image_str = payload["image_str"]
     model_index = payload["model_index"]
-    image_decoded = base64.b64decode(image_str)
-    image = np.array(Image.open(io.BytesIO(image_decoded)))
-    predictions = detector.detect(image, model_index)
-    return {"predictions": predictions}
\ No newline at end of file
+    check_model_index(model_index)
+    try:
+        image = await run_in_threadpool(decode_image, image_str)
+    except ValueError as e: # invalid base64 or image file
+        raise HTTPException(status_code=400, detail=str(e))
+    predictions = await scheduler.submit(image, model_index)
+    return {"predictions": to_serializable(predictions)}
+
+@app.post("/detect/binary")
+async def get_binary_predictions(request: Request, model_index: int):
+    """ Same as /detect but the image is sent in the request body (raw pixels with their shape in the 
+        X-Image-Shape header, or an encoded image file) and the predictions are returned as npz bytes 
+        (see backend/serialization.py)
+    """
+    check_model_index(model_index)
+    body = await request.body()
+    try:
+        image = await run_in_threadpool(deserialize_binary_image, body, request.headers.get(serialization.SHAPE_HEADER))
+    except ValueError as e: # invalid shape header or image file
+        raise HTTPException(status_code=400, detail=str(e))
+    predictions = await scheduler.submit(image, model_index)
+    content = await run_in_threadpool(serialize_binary_predictions, predictions, image)
+    return Response(content=content, media_type=serialization.MEDIA_TYPE)
+
+@app.post("/detect_batch")
+async def get_batch_predictions(payload: BatchDetectionData):
+    """ Same as /detect for a list of images. The images go through the scheduler like the other routes (it
+        groups them in batches of max_batch_size, with the concurrent requests for the same model)
+    """
+    payload = payload.dict()
+    model_index = payload["model_index"]
+    check_model_index(model_index)
+    try:
+        images = await run_in_threadpool(lambda: [decode_image(image_str) for image_str in payload["images_str"]])
+    except ValueError as e: # invalid base64 or image file
+        raise HTTPException(status_code=400, detail=str(e))
+    predictions = await asyncio.gather(*[scheduler.submit(image, model_index) for image in images])
+    return {"predictions": [to_serializable(p) for p in predictions]}
+
+def check_model_index(model_index):
+    """ Rejects invalid model indices before they are queued (so they don't fail a whole batch)
+    """
+    if model_index not in range(len(detector.choices)):
+        raise HTTPException(status_code=422, detail="Incorrect model index")
+
+def decode_image(image_str):
+    """ Decodes a base64 encoded image file, raises a ValueError if it is not a valid image
+    """
+    with metrics.timer("deserialize", transport="json"):
+        try:
+            image_decoded = base64.b64decode(image_str, validate=True)
+            return np.array(Image.open(io.BytesIO(image_decoded)))
+        except (binascii.Error, UnidentifiedImageError) as e:
+            raise ValueError(f"The image is not a valid base64 encoded image file ({e})") from None
+
+def deserialize_binary_image(body, shape):
+    with metrics.timer("deserialize", transport="binary"):
+        return serialization.decode_image(body, shape)
+
+def serialize_binary_predictions(predictions, image):
+    with metrics.timer("serialize", transport="binary", size=size_label(image)):
+        return serialization.encode_predictions(predictions)
@@ -0,0 +1,230 @@
+import hashlib
+import json
+import pickle
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+
+def image_digest(image):
+    """ Returns a fast content hash of an image (numpy array), including its shape and type
+    """
+    image = np.ascontiguousarray(image)
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{image.shape}{image.dtype}".encode())
+    h.update(memoryview(image).cast("B"))
+    return h.hexdigest()
+
+
+def estimate_size(obj):
+    """ Returns an approximate size in bytes of a predictions dict (or any of its values)
+        Lists are assumed to be homogeneous, only their first element is inspected
+    """
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, dict):
+        return sum(estimate_size(k) + estimate_size(v) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        if len(obj) == 0:
+            return 8
+        return 8 * len(obj) + len(obj) * estimate_size(obj[0])
+    if isinstance(obj, (str, bytes)):
+        return len(obj) + 48
+    return 32
+
+
+class PredictionCache():
+    """ Content-addressed cache of predictions shared by all the sessions/frontends using the same backend
+        The predictions are kept in an in-memory LRU (bounded by their estimated size) and, optionally, in a
+        directory on disk (used when an entry is not, or no longer, in memory). The eviction of the on-disk tier uses an
+        in-memory index of its files (sizes and access order), so a write doesn't scan the directory
+    """
+
+    def __init__(self, max_memory_mb=256, disk_dir=None, max_disk_mb=1024):
+        """
+        Params:
+            max_memory_mb: float, memory budget of the in-memory tier (0 to disable it)
+            disk_dir: str, directory used by the on-disk tier (None to disable it)
+            max_disk_mb: float, size budget of the on-disk tier
+        """
+        self.max_memory = max_memory_mb * 1024 ** 2
+        self.disk_dir = None if disk_dir is None else Path(disk_dir)
+        self.max_disk = max_disk_mb * 1024 ** 2
+        self.memory = OrderedDict() # key -> (predictions, size), ordered from least to most recent
+        self.memory_size = 0
+        # index of the on-disk tier (seeded once from the directory, then kept up to date by the reads and writes)
+        self.disk_files = OrderedDict() # key -> file size, ordered from least to most recent
+        self.disk_size = 0
+        self.lock = threading.Lock()
+        if self.disk_dir is not None:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+            self._load_disk_index()
+
+    def key(self, image, model_id, params=None, digest=None):
+        """ Returns the cache key of the predictions of a model on an image
+
+        Params:
+            image: numpy array, input image
+            model_id: any JSON serializable value that identifies the model (e.g. its index and config)
+            params: dict, parameters passed to the model
+            digest: str, image_digest of the image if it is already computed
+        """
+        model_key = json.dumps([model_id, params or dict()], sort_keys=True, default=str)
+        digest = image_digest(image) if digest is None else digest
+        return hashlib.blake2b(f"{digest}{model_key}".encode(), digest_size=16).hexdigest()
+
+    def get(self, key):
+        """ Returns a copy of the cached predictions, or None if the key is not in the cache
+        """
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                return dict(self.memory[key][0])
+        predictions = self._read_disk(key)
+        if predictions is not None:
+            self._put_memory(key, predictions)
+        return predictions
+
+    def put(self, key, predictions):
+        """ Stores a copy of the predictions
+            The copy is shallow: callers should not modify the values in place (see DetectorBackend.add_labeled_box)
+        """
+        predictions = dict(predictions)
+        self._put_memory(key, predictions)
+        self._write_disk(key, predictions)
+
+    def clear(self):
+        with self.lock:
+            self.memory = OrderedDict()
+            self.memory_size = 0
+            self.disk_files = OrderedDict()
+            self.disk_size = 0
+        if self.disk_dir is not None:
+            for f in self.disk_dir.glob("*.pkl"):
+                f.unlink()
+
+    def _put_memory(self, key, predictions):
+        size = estimate_size(predictions)
+        if size > self.max_memory:
+            return
+        with self.lock:
+            if key in self.memory:
+                self.memory_size -= self.memory.pop(key)[1]
+            self.memory[key] = (dict(predictions), size)
+            self.memory_size += size
+            while self.memory_size > self.max_memory:
+                _, (_, old_size) = self.memory.popitem(last=False)
+                self.memory_size -= old_size
+
+    def _load_disk_index(self):
+        """ Seeds the index of the on-disk tier with the files of the directory (e.g. left by a previous run), ordered
+            by last access time
+        """
+        files = list()
+        for f in self.disk_dir.glob("*.pkl"):
+            try:
+                stat = f.stat()
+            except FileNotFoundError: # removed by another thread/process
+                continue
+            files.append((stat.st_mtime, stat.st_size, f.stem))
+        for _, size, key in sorted(files):
+            self.disk_files[key] = size
+            self.disk_size += size
+
+    def _read_disk(self, key):
+        if self.disk_dir is None:
+            return None
+        path = self.disk_dir / f"{key}.pkl"
+        try:
+            with open(path, "rb") as f:
+                predictions = pickle.load(f)
+                size = f.tell()
+            path.touch() # last access time, used to order the index when it is seeded
+        except (OSError, pickle.UnpicklingError, EOFError):
+            with self.lock: # e.g. removed by another process
+                if key in self.disk_files:
+                    self.disk_size -= self.disk_files.pop(key)
+            return None
+        with self.lock:
+            if key not in self.disk_files: # e.g. written by another process
+                self.disk_files[key] = size
+                self.disk_size += size
+            self.disk_files.move_to_end(key)
+        return predictions
+
+    def _write_disk(self, key, predictions):
+        if self.disk_dir is None:
+            return
+        path = self.disk_dir / f"{key}.pkl"
+        tmp_path = self.disk_dir / f"{key}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(predictions, f, protocol=pickle.HIGHEST_PROTOCOL)
+            size = f.tell()
+        tmp_path.replace(path)
+        evicted = list()
+        with self.lock:
+            if key in self.disk_files:
+                self.disk_size -= self.disk_files.pop(key)
+            self.disk_files[key] = size
+            self.disk_size += size
+            while self.disk_size > self.max_disk and len(self.disk_files) > 1: # the new entry is kept
+                old_key, old_size = self.disk_files.popitem(last=False)
+                self.disk_size -= old_size
+                evicted.append(old_key)
+        for old_key in evicted:
+            try:
+                (self.disk_dir / f"{old_key}.pkl").unlink()
+            except FileNotFoundError: # removed by another thread/process
+                pass
+
+
+class BlurLayerCache():
+    """ In-memory LRU (bounded by the size of the layers) of full-frame blurred versions of images, e.g. shared by the
+        sessions of an app so that anonymising the same image again with a blur already computed (the user comparing
+        strengths or changing the targets) is only a masked copy of the cached layer (see Anonymiser.anonymise_steps)
+    """
+
+    def __init__(self, max_memory_mb=256):
+        self.max_memory = max_memory_mb * 1024 ** 2
+        self.layers = OrderedDict() # key -> layer, ordered from least to most recent
+        self.memory_size = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(image_key, anonym_type, blur_kernel):
+        """ Returns the cache key of a layer
+
+        Params:
+            image_key: str, identity of the image (e.g. its image_digest)
+            anonym_type: str, blur type (see BLUR_TYPES in anonymiser.py)
+            blur_kernel: tuple(int, int), kernel size of the blur
+        """
+        return (image_key, anonym_type, tuple(int(k) for k in blur_kernel))
+
+    def get(self, key):
+        """ Returns the cached layer (read-only), or None if the key is not in the cache
+        """
+        with self.lock:
+            if key not in self.layers:
+                return None
+            self.layers.move_to_end(key)
+            return self.layers[key]
+
+    def put(self, key, layer):
+        if layer.nbytes > self.max_memory:
+            return
+        with self.lock:
+            if key in self.layers:
+                self.memory_size -= self.layers.pop(key).nbytes
+            self.layers[key] = layer
+            self.memory_size += layer.nbytes
+            while self.memory_size > self.max_memory:
+                _, old_layer = self.layers.popitem(last=False)
+                self.memory_size -= old_layer.nbytes
+
+    def clear(self):
+        with self.lock:
+            self.layers = OrderedDict()
+            self.memory_size = 0
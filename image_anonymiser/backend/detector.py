@@ -2,7 +2,6 @@ import base64
 import os
 from importlib import import_module
 from io import BytesIO
-from itertools import compress
 from pathlib import Path
 
 import cv2
@@ -11,6 +10,14 @@ import PIL.Image
 import requests
 import yaml
 
+from image_anonymiser.backend import serialization
+from image_anonymiser.backend.cache import PredictionCache, image_digest
+from image_anonymiser.backend.metrics import metrics, size_label
+from image_anonymiser.backend.regions import TargetRegions
+from image_anonymiser.backend.registry import ModelRegistry
+from image_anonymiser.models import hooks
+from image_anonymiser.models.predictions import to_arrays
+
 PAR_DIR = Path(__file__).resolve().parent
 CONFIG_DIR = PAR_DIR / "configs"
 
@@ -24,55 +31,125 @@ class DetectorBackend():
         with open(config_file, 'r') as file:
             self.config = yaml.safe_load(file)
         # setup predictor 
-        self.detectors_fn = list()
+        self.registry = None
         self.choices = list()
         self.descriptions = list()
         self.classes = list()
         self.predictor = "inapp" if force_inapp else self.config["predictor"]["type"]
         self.predictor_url = None
+        self.transport = self.config["predictor"].get("transport", "json")
         if self.predictor == "inapp":
-            models_module = import_module("image_anonymiser.models.detectors")
-            for d in self.config["detectors"]:
-                d_class = getattr(models_module, d["class"])
-                if "params" in d:
-                    detector = d_class(**d["params"])
-                else:
-                    detector = d_class()
+            # models are loaded on their first use (see ModelRegistry)
+            registry_config = self.config["predictor"].get("registry", dict())
+            self.registry = ModelRegistry(self.config["detectors"], **registry_config)
+            for i, d in enumerate(self.config["detectors"]):
                 self.choices.append(d["name"])
                 self.descriptions.append(d["description"])
-                self.classes.append(detector.class_names) 
-                self.detectors_fn.append(detector.detect)
+                self.classes.append(self.registry.get_class_names(i)) 
         elif self.predictor == "api":
             self.predictor_url = os.environ.get("FASTAPIURL", "http://127.0.0.1:8000")
             self.get_endpoint_info()
         else:
             raise ValueError("Incorrect predictor type, should be inapp or api")
+        # setup predictions cache
+        cache_config = self.config["predictor"].get("cache")
+        self.cache = None if cache_config is None else PredictionCache(**cache_config)
         # setup visualizer
         viz_module = import_module("image_anonymiser.backend.visualizer")
         v_class = getattr(viz_module, self.config["visualizer"]["class"])
-        self.visualise_boxes = v_class().visualise_boxes
+        self.visualizer = v_class()
 
 
-    def detect(self, image, model_index, **params):
+    def detect(self, image, model_index, use_cache=True, **params):
         """ Runs a detection model
         
         Params:
             image: numpy array, input image
-            model_index: int, index of the dector model in self.detectors_fn
+            model_index: int, index of the dector model in self.choices
+            use_cache: bool, if False the predictions cache is bypassed (e.g. for video frames that are never seen
+                    twice)
             params: model parameters
 
         Returns:
-            predictions: dict, predictions as returned by the dection models
+            predictions: dict, predictions as returned by the dection models (numeric outputs as numpy arrays)
         """
         if model_index not in range(len(self.choices)):
             raise ValueError("Incorrect model index")
+        key = None
+        digest = None # computed once for the predictions cache and the models (see hooks.image_keys)
+        if self.cache is not None and use_cache:
+            with metrics.timer("cache_lookup", size=size_label(image)):
+                digest = image_digest(image)
+                key = self.cache.key(image, self._get_model_id(model_index), params, digest)
+                predictions = self.cache.get(key)
+            metrics.inc("predictions_cache", model=model_index, result="miss" if predictions is None else "hit")
+            if predictions is not None:
+                return predictions
+        if self.predictor_url is None:
+            model = self.registry.get(model_index)
+            if digest is None and use_cache:
+                digest = image_digest(image)
+            with metrics.timer("inference", model=model_index, size=size_label(image)), \
+                    hooks.image_keys([image], [digest]):
+                predictions = to_arrays(model.detect(image, **params))
         else:
+            with metrics.timer("inference", model=model_index, size=size_label(image), predictor="api"):
+                predictions = self._predict_from_endpoint(image, model_index) # Note: params are not used in api
+        if key is not None:
+            self.cache.put(key, predictions)
+        return predictions
+
+    def detect_batch(self, images, model_index, **params):
+        """ Runs a detection model on a list of images
+        
+        Params:
+            images: list of numpy arrays, input images
+            model_index: int, index of the dector model in self.choices
+            params: model parameters
+
+        Returns:
+            predictions: list[dict], predictions for each image as returned by the dection models
+        """
+        if model_index not in range(len(self.choices)):
+            raise ValueError("Incorrect model index")
+        predictions = [None for _ in images]
+        keys = [None for _ in images]
+        # see detect, not needed in api mode without cache
+        digests = [image_digest(image) if self.cache is not None or self.predictor_url is None else None 
+                   for image in images]
+        if self.cache is not None:
+            model_id = self._get_model_id(model_index)
+            for i, image in enumerate(images):
+                keys[i] = self.cache.key(image, model_id, params, digests[i])
+                predictions[i] = self.cache.get(keys[i])
+                metrics.inc("predictions_cache", model=model_index, result="miss" if predictions[i] is None else "hit")
+        missing = [i for i, p in enumerate(predictions) if p is None]
+        if missing:
+            missing_images = [images[i] for i in missing]
+            largest = max(missing_images, key=lambda image: image.shape[0] * image.shape[1])
             if self.predictor_url is None:
-                predictions = self.detectors_fn[model_index](image, **params)
+                model = self.registry.get(model_index)
+                with metrics.timer("inference_batch", model=model_index, size=size_label(largest)), \
+                        hooks.image_keys(missing_images, [digests[i] for i in missing]):
+                    results = [to_arrays(result) for result in model.detect_batch(missing_images, **params)]
             else:
-                predictions = self._predict_from_endpoint(image, model_index) # Note: params are not used in api
+                with metrics.timer("inference_batch", model=model_index, size=size_label(largest), predictor="api"):
+                    results = self._predict_batch_from_endpoint(missing_images, model_index)
+            metrics.inc("batched_images", len(missing_images), model=model_index)
+            for i, result in zip(missing, results):
+                predictions[i] = result
+                if keys[i] is not None:
+                    self.cache.put(keys[i], result)
         return predictions
 
+    def _get_model_id(self, model_index):
+        """ Returns the identifier of a model used in the predictions cache keys
+        """
+        if self.predictor_url is None:
+            return self.config["detectors"][model_index]
+        else:
+            return [self.predictor_url, model_index, self.choices[model_index]]
+
     def get_pred_types(self, predictions, incl_user_boxes=False):
         """ Returns the types of predictions returned by the Detect method
         
@@ -85,10 +162,10 @@ class DetectorBackend():
         """
         result = list()
         if incl_user_boxes and "boxes_adj" in predictions:
-            if predictions["boxes_adj"] != []: result.append("box")
+            if len(predictions["boxes_adj"]) > 0: result.append("box")
         else:
-            if predictions["boxes"] != []: result.append("box")
-        if predictions["masks"] != []: result.append("mask")
+            if len(predictions["boxes"]) > 0: result.append("box")
+        if len(predictions["masks"]) > 0: result.append("mask")
         return result
 
     def get_pred_classes(self, predictions, incl_user_boxes=False):
@@ -125,8 +202,7 @@ class DetectorBackend():
         else:
             pred_classes = predictions["pred_classes"]
             i_ids = predictions["instance_ids"]
-        mask = [True if i == class_id else False for i in pred_classes]
-        instance_ids = list(compress(i_ids, mask))
+        instance_ids = np.asarray(i_ids)[np.asarray(pred_classes) == class_id].tolist()
         if len(instance_ids) > 1: result.extend(instance_ids)
         return result
 
@@ -141,8 +217,12 @@ class DetectorBackend():
             incl_user_boxes, bool (default False)
 
         Returns:
-            result: numpy array, indices of the target pixels in the image
+            result: TargetRegions, boxes or union of the masks of the targets (to be used by Anonymiser.anonymise)
         """
+        with metrics.timer("regions", target=target_type):
+            return self._get_target_regions(class_name, instance_id, target_type, predictions, incl_user_boxes)
+
+    def _get_target_regions(self, class_name, instance_id, target_type, predictions, incl_user_boxes):
         class_id = predictions["name2int"][class_name]
         if target_type == "box":
             if incl_user_boxes and "boxes_adj" in predictions:
@@ -151,33 +231,32 @@ class DetectorBackend():
             else:
                 boxes = predictions["boxes"]
                 pred_classes = predictions["pred_classes"]
-            mask = np.array([True if i == class_id else False for i in pred_classes])
-            boxes = np.array(boxes)[mask]
-            if instance_id != "all":
-                boxes = np.array([boxes[int(instance_id)]])
-            result = self._get_indices_from_boxes(boxes)
+            indices = self._get_class_indices(pred_classes, class_id, instance_id)
+            result = TargetRegions.from_boxes(np.asarray(boxes).reshape(-1, 4)[indices])
         elif target_type == "mask":
-            mask = np.array([True if i == class_id else False for i in predictions["pred_classes"]])
-            seg_masks = np.array(predictions["masks"])[mask]
-            if instance_id != "all":
-                seg_masks = np.array([seg_masks[int(instance_id)]])
-            seg_mask = np.sum(seg_masks, axis=0)
-            result = np.where(seg_mask != 0)
-
+            indices = self._get_class_indices(predictions["pred_classes"], class_id, instance_id)
+            masks = predictions["masks"]
+            if isinstance(masks, np.ndarray):
+                result = TargetRegions.from_masks(masks[indices])
+            else: # list of RLE (or dense) masks, only the selected ones are decoded
+                result = TargetRegions.from_masks([masks[i] for i in indices])
+        else:
+            raise ValueError(f"target type: {target_type} not supported; use `box` or `mask`")
         return result
 
-    def _get_indices_from_boxes(self, boxes):
-        """ Helper function to convert box coordinates into pixels
+    def _get_class_indices(self, pred_classes, class_id, instance_id):
+        """ Helper function that returns the positions (in the predictions) of the targeted class instances
+        """
+        indices = np.flatnonzero(np.asarray(pred_classes) == class_id)
+        if instance_id != "all":
+            indices = indices[[int(instance_id)]]
+        return indices
+
+    def visualise_boxes(self, image, predictions, incl_user_boxes=False, out=None):
+        """ Returns a copy of the image with the predicted boxes and labels, see Visualizer.visualise_boxes
         """
-        tmp = list()
-        box_indices_y = list()
-        box_indices_x = list()
-        for box in boxes:
-            x1, y1, x2, y2 = box
-            tmp.extend((y, x) for y in range(y1, y2) for x in range(x1, x2))
-        box_indices_y = [t[0] for t in tmp]
-        box_indices_x = [t[1] for t in tmp]
-        return (np.array(box_indices_y), np.array(box_indices_x))
+        with metrics.timer("visualise", size=size_label(image)):
+            return self.visualizer.visualise_boxes(image, predictions, incl_user_boxes, out)
 
     def add_labeled_box(self, box, label, predictions):
         """ Adds a user defined box to the predictions dictionary
@@ -202,15 +281,16 @@ class DetectorBackend():
                 predictions["user_boxes"].append(box)
             else:
                 predictions["user_boxes"] = [box]
-                predictions["pred_classes_adj"] = predictions["pred_classes"].copy()
-                predictions["scores_adj"] = predictions["scores"].copy()
-                predictions["boxes_adj"] = predictions["boxes"].copy()
-                predictions["instance_ids_adj"] = predictions["instance_ids"].copy()
+                predictions["pred_classes_adj"] = predictions["pred_classes"]
+                predictions["scores_adj"] = predictions["scores"]
+                predictions["boxes_adj"] = predictions["boxes"]
+                predictions["instance_ids_adj"] = predictions["instance_ids"]
                 predictions["pred_labels_adj"] = predictions["pred_labels"].copy()
                 predictions["is_user_box"] = [False for _ in predictions["boxes"]]
 
-            predictions["scores_adj"].append(1)
-            predictions["boxes_adj"].append(box)
+            # the arrays are concatenated (not modified in place), so the cached predictions are not affected
+            predictions["scores_adj"] = np.append(predictions["scores_adj"], 1)
+            predictions["boxes_adj"] = np.concatenate([predictions["boxes_adj"], np.array([box], dtype=np.int64)])
             predictions["is_user_box"].append(True)
 
             if label not in predictions["pred_labels_adj"]:
@@ -218,11 +298,11 @@ class DetectorBackend():
             if len(predictions["class_names"]) > 1:
                 new_id = 0
                 if new_id in predictions["pred_classes_adj"]:
-                    new_id = sum(1 if label_id == c else 0 for c in predictions["pred_classes_adj"])
+                    new_id = int(np.count_nonzero(predictions["pred_classes_adj"] == label_id))
             else:
                 new_id = len(predictions["instance_ids_adj"])
-            predictions["pred_classes_adj"].append(label_id)
-            predictions["instance_ids_adj"].append(new_id)
+            predictions["pred_classes_adj"] = np.append(predictions["pred_classes_adj"], label_id)
+            predictions["instance_ids_adj"] = np.append(predictions["instance_ids_adj"], new_id)
         return predictions
 
     def get_endpoint_info(self):
@@ -233,11 +313,34 @@ class DetectorBackend():
         self.classes = info["classes"]
 
     def _predict_from_endpoint(self, image, model_index):
+        if self.transport == "binary":
+            return self._predict_from_binary_endpoint(image, model_index)
+        with metrics.timer("serialize", transport="json", size=size_label(image)):
+            byte_string = self._encode_image(image)
+        response = requests.post(f"{self.predictor_url}/detect", json={"image_str": byte_string, 
+                                                                "model_index": model_index})
+        with metrics.timer("deserialize", transport="json"):
+            predictions = to_arrays(response.json()["predictions"])
+        return predictions
+
+    def _predict_from_binary_endpoint(self, image, model_index):
+        with metrics.timer("serialize", transport="binary", size=size_label(image)):
+            body, headers = serialization.encode_image(image)
+        response = requests.post(f"{self.predictor_url}/detect/binary", params={"model_index": model_index}, 
+                                    data=body, headers=headers)
+        response.raise_for_status()
+        with metrics.timer("deserialize", transport="binary"):
+            return to_arrays(serialization.decode_predictions(response.content))
+
+    def _predict_batch_from_endpoint(self, images, model_index):
+        images_str = [self._encode_image(image) for image in images]
+        response = requests.post(f"{self.predictor_url}/detect_batch", json={"images_str": images_str, 
+                                                                "model_index": model_index})
+        predictions = [to_arrays(p) for p in response.json()["predictions"]]
+        return predictions
+
+    def _encode_image(self, image):
         pil_img = PIL.Image.fromarray(image)
         buff = BytesIO()
         pil_img.save(buff, format="JPEG")
-        byte_string = base64.b64encode(buff.getvalue()).decode("utf-8")
-        response = requests.post(f"{self.predictor_url}/detect", json={"image_str": byte_string, 
-                                                                "model_index": model_index})
-        predictions = response.json()["predictions"]
-        return predictions
\ No newline at end of file
+        return base64.b64encode(buff.getvalue()).decode("utf-8")
\ No newline at end of file
@@ -9,6 +9,8 @@ import pandas as pd
 import yaml
 from PIL import Image
 
+from image_anonymiser.models.predictions import to_arrays, to_serializable
+
 PAR_DIR = Path(__file__).resolve().parent
 CONFIG_DIR = PAR_DIR / "configs"
 
@@ -62,13 +64,15 @@ class FileIO():
         Args:
             image(np.array): image to store
             additional_info(dict): additional information for the anonymiser
-            predictions(dict): predictions dictionary from the detector component
+            predictions(dict): predictions dictionary from the detector component. The masks are stored as RLE
+                (they are decoded only when used, see DetectorBackend.get_target_regions)
         """
 
         folder_name = self._img_root_dir / self._current_time_str()
         folder_name.mkdir()
 
         if image is not None:
+            predictions = to_serializable(predictions)
             with open(folder_name / "predictions.json", "w") as outfile:
                 json.dump(predictions, outfile)
 
@@ -94,7 +98,7 @@ class FileIO():
 
         if Path(folder / "predictions.json").exists():
             with open(folder / "predictions.json", "r") as infile:
-                predictions = json.load(infile)
+                predictions = to_arrays(json.load(infile))
         else:
             predictions = None
 
@@ -0,0 +1,143 @@
+""" Timing and counter hooks used to monitor the application, exported in the Prometheus text format
+    The hooks are used by the backend (detector, anonymiser, api server), by the models through models/hooks.py
+    (set by the backend registry) and can also be used by the frontends, e.g.:
+
+        from image_anonymiser.backend.metrics import metrics, size_label
+        with metrics.timer("anonymise", size=size_label(image)):
+            ...
+        metrics.inc("requests", endpoint="detect")
+"""
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+PREFIX = "image_anonymiser"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (0.5, 2, 5, 13, 25) # in megapixels
+
+
+def size_label(image):
+    """ Returns the image-size bucket (in megapixels) of an image, used as a label of the metrics
+    """
+    megapixels = image.shape[0] * image.shape[1] / 1e6
+    lower = 0
+    for upper in SIZE_BUCKETS:
+        if megapixels < upper:
+            return f"{lower}-{upper}MP"
+        lower = upper
+    return f">{lower}MP"
+
+
+class Metrics():
+    """ Thread-safe registry of counters and latency histograms
+        - timer/observe record a duration in the `<PREFIX>_stage_seconds` histogram, with the stage name as a label
+        - inc increments the `<PREFIX>_<name>_total` counter
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.histograms = dict() # labels -> [bucket counts, sum, count]
+        self.counters = dict() # name -> {labels: value}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def timer(self, stage, **labels):
+        """ Context manager that records the duration of its block for the given stage
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start, **labels)
+
+    def observe(self, stage, seconds, **labels):
+        key = self._labels_key(stage=stage, **labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = [[0 for _ in self.buckets], 0.0, 0]
+            histogram = self.histograms[key]
+            for i, upper in enumerate(self.buckets):
+                if seconds <= upper:
+                    histogram[0][i] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    def inc(self, name, value=1, **labels):
+        key = self._labels_key(**labels)
+        with self.lock:
+            counter = self.counters.setdefault(name, dict())
+            counter[key] = counter.get(key, 0) + value
+
+    def reset(self):
+        with self.lock:
+            self.histograms = dict()
+            self.counters = dict()
+
+    def render(self):
+        """ Returns the metrics in the Prometheus text exposition format
+        """
+        lines = list()
+        with self.lock:
+            name = f"{PREFIX}_stage_seconds"
+            lines.append(f"# HELP {name} Duration of the processing stages in seconds")
+            lines.append(f"# TYPE {name} histogram")
+            for key, (counts, total, count) in sorted(self.histograms.items()):
+                for upper, bucket_count in zip(self.buckets, counts):
+                    lines.append(f"{name}_bucket{self._format(key + (('le', str(upper)),))} {bucket_count}")
+                lines.append(f"{name}_bucket{self._format(key + (('le', '+Inf'),))} {count}")
+                lines.append(f"{name}_sum{self._format(key)} {total}")
+                lines.append(f"{name}_count{self._format(key)} {count}")
+            for counter_name, values in sorted(self.counters.items()):
+                name = f"{PREFIX}_{counter_name}_total"
+                lines.append(f"# TYPE {name} counter")
+                for key, value in sorted(values.items()):
+                    lines.append(f"{name}{self._format(key)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def _labels_key(self, **labels):
+        return tuple(sorted((k, str(v)) for k, v in labels.items() if v is not None))
+
+    def _format(self, key):
+        if not key:
+            return ""
+        labels = ",".join(f'{k}="{self._escape(v)}"' for k, v in key)
+        return f"{{{labels}}}"
+
+    def _escape(self, value):
+        return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def start_http_server(port, addr="0.0.0.0", registry=None):
+    """ Serves the metrics on http://addr:port/metrics in a background thread (for the apps that don't run the
+        FastAPI server)
+    """
+    registry = registry or metrics
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            content = registry.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format, *args):
+            pass
+
+    class Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    server = Server((addr, port), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+metrics = Metrics()
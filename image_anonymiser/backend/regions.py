@@ -0,0 +1,147 @@
+import cv2
+import numpy as np
+
+from image_anonymiser.models.masks import decode_rle_union, is_rle
+
+MAX_MASK_RECTS = 64
+
+
+class TargetRegions():
+    """ Pixels of an image that should be anonymised
+        Boxes are kept as rectangles (applied with slicing) and segmentation masks are merged into a single
+        boolean mask, so no per-pixel coordinates are ever materialised
+    """
+
+    def __init__(self, boxes=None, mask=None):
+        """
+        Params:
+            boxes: list[list[int]] or numpy array, coordinates (x1,y1,x2,y2) of the target boxes; x2 and y2 are
+                    excluded from the target region
+            mask: numpy array of bool (same height/width as the image), True for the target pixels
+        """
+        if boxes is None or len(boxes) == 0:
+            self.boxes = np.zeros((0, 4), dtype=int)
+        else:
+            self.boxes = np.asarray(boxes).reshape(-1, 4).astype(int)
+        self.mask = mask
+
+    @classmethod
+    def from_boxes(cls, boxes):
+        """ Creates the target regions from a list of boxes (x1,y1,x2,y2)
+        """
+        return cls(boxes=boxes)
+
+    @classmethod
+    def from_masks(cls, masks):
+        """ Creates the target regions from the union of several segmentation masks
+
+        Params:
+            masks: numpy array (or list) of shape (n_masks, height, width), or list of RLE masks (decoded directly
+                    into the union, see image_anonymiser/models/masks.py)
+        """
+        if len(masks) > 0 and is_rle(masks[0]):
+            return cls(mask=decode_rle_union(masks, masks[0]["size"]))
+        masks = np.asarray(masks, dtype=bool)
+        if masks.ndim != 3 or masks.shape[0] == 0:
+            return cls()
+        if masks.shape[0] == 1:
+            mask = masks[0]
+        else:
+            mask = np.any(masks, axis=0)
+        return cls(mask=mask)
+
+    @classmethod
+    def union(cls, regions):
+        """ Creates the target regions covering all the given TargetRegions
+        """
+        regions = list(regions)
+        boxes = np.concatenate([np.zeros((0, 4), dtype=int)] + [r.boxes for r in regions])
+        masks = [r.mask for r in regions if r.mask is not None]
+        mask = None
+        if len(masks) == 1:
+            mask = masks[0]
+        elif len(masks) > 1:
+            mask = np.logical_or.reduce(masks)
+        return cls(boxes=boxes, mask=mask)
+
+    def is_empty(self):
+        return len(self.boxes) == 0 and self.mask is None
+
+    def slices(self, shape):
+        """ Yields the (rows, cols) slices of each box clipped to an image of the given shape
+        """
+        h, w = shape[:2]
+        for x1, y1, x2, y2 in self.boxes.tolist():
+            x1, y1 = max(0, x1), max(0, y1)
+            x2, y2 = min(w, x2), min(h, y2)
+            if x2 > x1 and y2 > y1:
+                yield slice(y1, y2), slice(x1, x2)
+
+    def rects(self, shape):
+        """ Returns the rectangles (x1,y1,x2,y2) that enclose the target regions, clipped to the given shape
+            For the mask, one rectangle is returned per connected component (or a single rectangle enclosing the
+            whole mask if it is very fragmented)
+        """
+        result = [(cols.start, rows.start, cols.stop, rows.stop) for rows, cols in self.slices(shape)]
+        if self.mask is not None:
+            _, _, stats, _ = cv2.connectedComponentsWithStats(self.mask.view(np.uint8), connectivity=8)
+            stats = stats[1:] # label 0 is the background
+            if len(stats) > MAX_MASK_RECTS:
+                ys = np.flatnonzero(self.mask.any(axis=1))
+                xs = np.flatnonzero(self.mask.any(axis=0))
+                result.append((xs[0], ys[0], xs[-1] + 1, ys[-1] + 1))
+            else:
+                for x, y, w, h, _ in stats.tolist():
+                    result.append((x, y, x + w, y + h))
+        return result
+
+    def apply(self, output, source=None, value=None):
+        """ Writes into the target pixels of output (in place), either the pixels of source or a constant value
+        """
+        if source is None and value is None:
+            raise ValueError("Either source or value should be provided")
+        for rows, cols in self.slices(output.shape):
+            output[rows, cols] = value if source is None else source[rows, cols]
+        if self.mask is not None:
+            output[self.mask] = value if source is None else source[self.mask]
+        return output
+
+    def to_mask(self, shape):
+        """ Returns the target regions as a single boolean mask of the given shape
+        """
+        result = np.zeros(shape[:2], dtype=bool)
+        self.apply(result, value=True)
+        return result
+
+    def to_indices(self, shape):
+        """ Returns the target regions as (rows, cols) pixel indices (format used by older versions of the backend)
+        """
+        return np.nonzero(self.to_mask(shape))
+
+
+def merge_rects(rects):
+    """ Merges overlapping rectangles (x1,y1,x2,y2) until none of the returned rectangles overlap
+    """
+    result = [tuple(r) for r in rects]
+    merged = True
+    while merged:
+        merged = False
+        remaining = list()
+        for rect in result:
+            x1, y1, x2, y2 = rect
+            for i, (ox1, oy1, ox2, oy2) in enumerate(remaining):
+                if x1 < ox2 and ox1 < x2 and y1 < oy2 and oy1 < y2:
+                    remaining[i] = (min(x1, ox1), min(y1, oy1), max(x2, ox2), max(y2, oy2))
+                    merged = True
+                    break
+            else:
+                remaining.append(rect)
+        result = remaining
+    return result
+
+
+def rects_overlap(rects, others):
+    """ Returns True if any of the rectangles (x1,y1,x2,y2) overlaps any of the other rectangles
+    """
+    return any(x1 < ox2 and ox1 < x2 and y1 < oy2 and oy1 < y2 
+               for x1, y1, x2, y2 in rects for ox1, oy1, ox2, oy2 in others)
@@ -0,0 +1,106 @@
+import gc
+import threading
+from collections import OrderedDict
+from importlib import import_module
+
+from image_anonymiser.backend.metrics import metrics
+from image_anonymiser.models import hooks
+from image_anonymiser.models.base import get_module_footprint
+from image_anonymiser.models.wrappers import wrap_model
+
+MODELS_MODULE = "image_anonymiser.models.detectors"
+
+hooks.set_metrics(metrics) # the models report their stages (preprocess, forward...) to the backend metrics
+
+
+class ModelRegistry():
+    """ Loads the detection models (as configured in the detectors section of the config file) on their first use
+        and keeps the most recently used ones in memory. When the budget (number of models and/or memory used by
+        the weights) is exceeded, the least recently used models are evicted
+    """
+
+    def __init__(self, detectors_config, max_models=None, max_memory_mb=None):
+        """
+        Params:
+            detectors_config: list[dict], the detectors section of the config file
+            max_models: int, maximum number of models kept in memory (None for no limit)
+            max_memory_mb: float, maximum memory used by the model weights (None for no limit). The most recently
+                used model is always kept, even if it exceeds the budget on its own
+        """
+        self.detectors_config = detectors_config
+        self.max_models = max_models
+        self.max_memory = None if max_memory_mb is None else max_memory_mb * 1024 ** 2
+        self.loaded = OrderedDict() # model_index -> (model, {module id: size}), ordered from least to most recent
+        self.lock = threading.Lock()
+        self._class_names = dict()
+
+    def __len__(self):
+        return len(self.detectors_config)
+
+    def get(self, model_index):
+        """ Returns the model object, loading it if needed
+        """
+        with self.lock:
+            if model_index in self.loaded:
+                self.loaded.move_to_end(model_index)
+                return self.loaded[model_index][0]
+            with metrics.timer("model_load", model=model_index):
+                model = self._load(model_index)
+            modules = {id(module): get_module_footprint(module) for module in model.get_torch_modules()}
+            self.loaded[model_index] = (model, modules)
+            self._evict()
+            return model
+
+    def get_class_names(self, model_index):
+        """ Returns the class names of a model, without loading it if the model class supports it
+        """
+        if model_index not in self._class_names:
+            d = self.detectors_config[model_index]
+            class_names = self._get_class(d).get_class_names(**d.get("params", dict()))
+            if class_names is None:
+                class_names = self.get(model_index).class_names
+            self._class_names[model_index] = list(class_names)
+        return self._class_names[model_index]
+
+    def is_loaded(self, model_index):
+        return model_index in self.loaded
+
+    def get_memory_used(self):
+        """ Returns the memory used by the weights of the loaded models. The modules shared by several models
+            (e.g. two detectors using the same network) are counted once
+        """
+        modules = dict()
+        for _, model_modules in self.loaded.values():
+            modules.update(model_modules)
+        return sum(modules.values())
+
+    def _get_class(self, d):
+        """ Returns the model class, from the module given in the config (default is MODELS_MODULE)
+        """
+        return getattr(import_module(d.get("module", MODELS_MODULE)), d["class"])
+
+    def _load(self, model_index):
+        """ Instantiates the model and applies the wrappers set in its config (e.g. max_inference_side)
+        """
+        d = self.detectors_config[model_index]
+        d_class = self._get_class(d)
+        if "params" in d:
+            model = d_class(**d["params"])
+        else:
+            model = d_class()
+        return wrap_model(model, d)
+
+    def _evict(self):
+        """ Removes the least recently used models until the budget is respected
+        """
+        evicted = False
+        while len(self.loaded) > 1:
+            over_count = self.max_models is not None and len(self.loaded) > self.max_models
+            over_memory = self.max_memory is not None and self.get_memory_used() > self.max_memory
+            if not (over_count or over_memory):
+                break
+            self.loaded.popitem(last=False)
+            metrics.inc("model_evictions")
+            evicted = True
+        if evicted:
+            gc.collect()
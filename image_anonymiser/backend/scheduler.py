@@ -0,0 +1,89 @@
+import asyncio
+
+from fastapi.concurrency import run_in_threadpool
+
+
+class BatchScheduler():
+    """ Dynamic micro-batching of detection requests
+        Requests are queued per model index. A worker per queue waits for the first request, then keeps collecting
+        the requests that arrive within max_wait_ms (up to max_batch_size), runs them as a single batch and sends
+        each result back to its caller. If a batch fails, its requests are run one by one so that an invalid image
+        only fails its own request
+    """
+
+    def __init__(self, detect_batch_fn, max_batch_size=8, max_wait_ms=10):
+        """
+        Params:
+            detect_batch_fn: function(images, model_index) -> list of predictions (e.g. DetectorBackend.detect_batch)
+            max_batch_size: int, maximum number of requests in a batch
+            max_wait_ms: float, time window (after the first request of a batch) used to coalesce requests
+        """
+        self.detect_batch_fn = detect_batch_fn
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000
+        self.queues = dict()
+        self.workers = dict()
+
+    async def submit(self, image, model_index):
+        """ Queues an image for detection and waits for its predictions
+        """
+        if model_index not in self.queues:
+            self.queues[model_index] = asyncio.Queue()
+            self.workers[model_index] = asyncio.create_task(self._worker(model_index))
+        future = asyncio.get_running_loop().create_future()
+        await self.queues[model_index].put((image, future))
+        return await future
+
+    async def close(self):
+        """ Stops the workers, the requests still in the queues are cancelled
+        """
+        for worker in self.workers.values():
+            worker.cancel()
+        for queue in self.queues.values():
+            while not queue.empty():
+                _, future = queue.get_nowait()
+                future.cancel()
+        self.queues = dict()
+        self.workers = dict()
+
+    async def _worker(self, model_index):
+        queue = self.queues[model_index]
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                if not queue.empty():
+                    batch.append(queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            batch = [(image, future) for image, future in batch if not future.cancelled()]
+            if not batch:
+                continue
+            images = [image for image, _ in batch]
+            try:
+                results = await run_in_threadpool(self.detect_batch_fn, images, model_index)
+            except Exception as e:
+                if len(batch) == 1:
+                    if not batch[0][1].done(): batch[0][1].set_exception(e)
+                    continue
+                # the batch failed, each image runs on its own so that only the failing requests get the error
+                for image, future in batch:
+                    await self._run_single(image, future, model_index)
+            else:
+                for (_, future), result in zip(batch, results):
+                    if not future.done(): future.set_result(result)
+
+    async def _run_single(self, image, future, model_index):
+        try:
+            result = (await run_in_threadpool(self.detect_batch_fn, [image], model_index))[0]
+        except Exception as e:
+            if not future.done(): future.set_exception(e)
+        else:
+            if not future.done(): future.set_result(result)
@@ -0,0 +1,91 @@
+""" Binary formats used between the DetectorBackend (api mode) and the FastAPI app
+    - images are sent as raw pixels (no codec, lossless) with their shape in the SHAPE_HEADER header,
+      or as an encoded image file (jpeg, png...) if the header is missing
+    - predictions are returned as an uncompressed npz archive: numeric outputs are stored as arrays, dense masks are
+      bit-packed and the other keys (including the RLE masks) are stored in a JSON string
+"""
+import io
+import json
+import math
+
+import cv2
+import numpy as np
+
+from image_anonymiser.models.masks import is_rle
+
+SHAPE_HEADER = "X-Image-Shape"
+MEDIA_TYPE = "application/octet-stream"
+ARRAY_KEYS = {"pred_classes": np.int64, "scores": np.float64, "boxes": np.int64, "instance_ids": np.int64,
+              "polygons": np.int64}
+META_KEY = "__meta__"
+
+
+def encode_image(image):
+    """ Returns the raw bytes of an image and the headers needed to decode it
+    """
+    image = np.ascontiguousarray(image, dtype=np.uint8)
+    headers = {SHAPE_HEADER: ",".join(str(d) for d in image.shape), "Content-Type": MEDIA_TYPE}
+    return image.tobytes(), headers
+
+
+def decode_image(body, shape=None):
+    """ Decodes an image sent by encode_image (if shape is provided) or an encoded image file
+
+    Params:
+        body: bytes, content of the request
+        shape: str, value of the SHAPE_HEADER header e.g. "480,640,3" (None for an encoded image file)
+
+    Returns:
+        image: numpy array in RGB format
+
+    Raises:
+        ValueError: if the shape is invalid (or doesn't match the size of the body) or the body is not a valid image
+    """
+    if shape is not None:
+        try:
+            dims = tuple(int(d) for d in shape.split(","))
+        except ValueError:
+            raise ValueError(f"Invalid {SHAPE_HEADER} header: {shape}") from None
+        if len(dims) != 3 or dims[2] != 3 or min(dims) <= 0:
+            raise ValueError(f"Invalid {SHAPE_HEADER} header: {shape} (expected height,width,3 for an RGB image)")
+        if math.prod(dims) != len(body):
+            raise ValueError(f"The size of the request body ({len(body)} bytes) doesn't match the image shape {shape}")
+        return np.frombuffer(body, dtype=np.uint8).reshape(dims)
+    image = cv2.imdecode(np.frombuffer(body, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("The request body is not a valid image")
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+
+def encode_predictions(predictions):
+    """ Serializes a predictions dict (as described in DetectionModel.detect) into npz bytes
+    """
+    arrays = dict()
+    meta = dict()
+    for key, value in predictions.items():
+        if key in ARRAY_KEYS:
+            arrays[key] = np.asarray(value, dtype=ARRAY_KEYS[key])
+        elif key == "masks" and len(value) > 0 and not is_rle(value[0]):
+            masks = np.asarray(value, dtype=bool)
+            arrays["masks_shape"] = np.array(masks.shape, dtype=np.int64)
+            arrays["masks"] = np.packbits(masks, axis=None)
+        else:
+            meta[key] = value
+    arrays[META_KEY] = np.array(json.dumps(meta))
+    buff = io.BytesIO()
+    np.savez(buff, **arrays)
+    return buff.getvalue()
+
+
+def decode_predictions(content):
+    """ Deserializes the output of encode_predictions into a predictions dict (numeric outputs as numpy arrays)
+    """
+    with np.load(io.BytesIO(content), allow_pickle=False) as data:
+        predictions = json.loads(str(data[META_KEY]))
+        for key in ARRAY_KEYS:
+            if key in data:
+                predictions[key] = data[key]
+        if "masks" in data:
+            shape = tuple(data["masks_shape"].tolist())
+            predictions["masks"] = np.unpackbits(data["masks"], count=int(np.prod(shape))).reshape(shape).astype(bool)
+    return predictions
@@ -0,0 +1,193 @@
+import time
+
+import cv2
+import numpy as np
+
+from image_anonymiser.backend.metrics import metrics
+from image_anonymiser.backend.regions import TargetRegions
+
+PROPAGATION_MODES = ["interpolate", "hold"]
+
+
+class VideoAnonymiser():
+    """ Anonymises a video frame by frame, running the detection model only every `stride` frames
+        Between two detections (keyframes), the target regions are propagated:
+        - interpolate: the boxes matched between the two keyframes are linearly interpolated (the frames in between
+          are buffered, at most stride - 1 frames), the unmatched boxes of both keyframes are kept. For masks, the
+          union of the masks of both keyframes is used
+        - hold: the regions of the last keyframe are reused (no buffering)
+        In both cases, the propagated boxes are enlarged by `margin` to account for the motion
+        The frames are read and written one at a time, so the video is never held in memory
+    """
+
+    def __init__(self, detector, anonymiser, model_index, class_name, target_type="box", anonym_type="blur",
+                 blur_kernel=(29, 29), color=[0, 0, 0], stride=5, propagation="interpolate", margin=0.1):
+        """
+        Params:
+            detector: DetectorBackend
+            anonymiser: Anonymiser (or AnonymiserBackend)
+            model_index: int, index of the detection model in detector.choices
+            class_name: str, name of the class to anonymise
+            target_type: str, "box" or "mask"
+            anonym_type: str, see ANONYM_TYPES in anonymiser.py
+            blur_kernel: tuple(int, int), kernel size of the blur (block size for pixelate)
+            color: list[int], color in [R,G,B] format
+            stride: int, the detection model runs on one frame every stride frames
+            propagation: str, how the regions are propagated between two detections (see PROPAGATION_MODES)
+            margin: float, fraction of their size by which the propagated boxes are enlarged
+        """
+        if class_name not in detector.classes[model_index]:
+            raise ValueError(f"class: {class_name} is not detected by the model {detector.choices[model_index]}")
+        if propagation not in PROPAGATION_MODES:
+            raise ValueError(f"propagation: {propagation} not supported; use one of {PROPAGATION_MODES}")
+        self.detector = detector
+        self.anonymiser = anonymiser
+        self.model_index = model_index
+        self.class_name = class_name
+        self.target_type = target_type
+        self.anonym_type = anonym_type
+        self.blur_kernel = blur_kernel
+        self.color = list(color)[::-1] # the frames are processed in BGR format
+        self.stride = max(1, stride)
+        self.propagation = propagation
+        self.margin = margin
+
+    def run(self, input_path, output_path, codec="mp4v", max_frames=None, progress=None):
+        """ Anonymises the video input_path and writes the result to output_path
+
+        Params:
+            input_path: str, input video (any format supported by cv2.VideoCapture)
+            output_path: str, output video
+            codec: str, fourcc code of the output video
+            max_frames: int, if set only the first max_frames frames are processed
+            progress: callable, called with the number of frames processed (and the total if known) after each
+                    keyframe
+
+        Returns:
+            stats: dict, number of frames and keyframes, processing time and throughput (frames per second)
+        """
+        capture = cv2.VideoCapture(str(input_path))
+        if not capture.isOpened():
+            raise ValueError(f"Cannot read the video {input_path}")
+        fps = capture.get(cv2.CAP_PROP_FPS) or 25
+        width = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        total = int(capture.get(cv2.CAP_PROP_FRAME_COUNT)) or None
+        writer = cv2.VideoWriter(str(output_path), cv2.VideoWriter_fourcc(*codec), fps, (width, height))
+        if not writer.isOpened():
+            capture.release()
+            raise ValueError(f"Cannot write the video {output_path} with the codec {codec} (unsupported codec or "
+                             f"container, or invalid path)")
+        stats = {"frames": 0, "keyframes": 0, "detect_seconds": 0.0, "anonymise_seconds": 0.0}
+        start = time.perf_counter()
+        buffer = list() # frames read since the last keyframe (interpolate mode)
+        previous = None # target regions of the last keyframe
+        try:
+            while max_frames is None or stats["frames"] < max_frames:
+                ok, frame = capture.read()
+                if not ok:
+                    break
+                if stats["frames"] % self.stride == 0:
+                    regions = self._detect(frame, stats)
+                    for i, buffered in enumerate(buffer):
+                        t = (i + 1) / (len(buffer) + 1)
+                        writer.write(self._anonymise(buffered, self._propagate(previous, regions, t), stats))
+                    writer.write(self._anonymise(frame, regions, stats))
+                    buffer = list()
+                    previous = regions
+                    if progress is not None:
+                        progress(stats["frames"] + 1, total)
+                elif self.propagation == "interpolate":
+                    buffer.append(frame)
+                else:
+                    writer.write(self._anonymise(frame, self._propagate(previous, previous, 0), stats))
+                stats["frames"] += 1
+            for buffered in buffer: # frames after the last keyframe
+                writer.write(self._anonymise(buffered, self._propagate(previous, previous, 0), stats))
+        finally:
+            capture.release()
+            writer.release()
+        stats["seconds"] = time.perf_counter() - start
+        stats["fps"] = stats["frames"] / stats["seconds"] if stats["seconds"] > 0 else 0.0
+        metrics.inc("video_frames", stats["frames"])
+        return stats
+
+    def _detect(self, frame, stats):
+        start = time.perf_counter()
+        image = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        predictions = self.detector.detect(image, self.model_index, use_cache=False)
+        if self.class_name in self.detector.get_pred_classes(predictions):
+            regions = self.detector.get_target_regions(self.class_name, "all", self.target_type, predictions)
+        else:
+            regions = TargetRegions()
+        stats["keyframes"] += 1
+        stats["detect_seconds"] += time.perf_counter() - start
+        return regions
+
+    def _anonymise(self, frame, regions, stats):
+        start = time.perf_counter()
+        output = self.anonymiser.anonymise(frame, regions, anonym_type=self.anonym_type, blur_kernel=self.blur_kernel,
+                                           color=self.color)
+        stats["anonymise_seconds"] += time.perf_counter() - start
+        return output
+
+    def _propagate(self, previous, following, t):
+        """ Returns the target regions of a frame between two keyframes (t is the position of the frame, from 0 for
+            the previous keyframe to 1 for the following one)
+        """
+        mask = previous.mask
+        if following is not previous and following.mask is not None:
+            mask = following.mask if mask is None else mask | following.mask
+        if following is previous:
+            boxes = previous.boxes
+        else:
+            boxes = interpolate_boxes(previous.boxes, following.boxes, t)
+        return TargetRegions(boxes=expand_boxes(boxes, self.margin), mask=mask)
+
+
+def interpolate_boxes(boxes, next_boxes, t, iou_threshold=0.3):
+    """ Returns the boxes at the position t (between 0 and 1) between two sets of boxes
+        The boxes are matched greedily by IoU; the boxes without a match are returned as they are
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    next_boxes = np.asarray(next_boxes, dtype=np.float64).reshape(-1, 4)
+    if len(boxes) == 0 or len(next_boxes) == 0:
+        return np.concatenate([boxes, next_boxes]).astype(np.int64)
+    ious = box_iou(boxes, next_boxes)
+    result = list()
+    matched, next_matched = set(), set()
+    for flat in np.argsort(-ious, axis=None):
+        i, j = np.unravel_index(flat, ious.shape)
+        if ious[i, j] < iou_threshold:
+            break
+        if i in matched or j in next_matched:
+            continue
+        matched.add(i)
+        next_matched.add(j)
+        result.append(boxes[i] * (1 - t) + next_boxes[j] * t)
+    result += [box for i, box in enumerate(boxes) if i not in matched]
+    result += [box for j, box in enumerate(next_boxes) if j not in next_matched]
+    return np.round(np.array(result)).astype(np.int64)
+
+
+def box_iou(boxes, other_boxes):
+    """ Returns the matrix of the IoU between two arrays of boxes (x1,y1,x2,y2)
+    """
+    x1 = np.maximum(boxes[:, None, 0], other_boxes[None, :, 0])
+    y1 = np.maximum(boxes[:, None, 1], other_boxes[None, :, 1])
+    x2 = np.minimum(boxes[:, None, 2], other_boxes[None, :, 2])
+    y2 = np.minimum(boxes[:, None, 3], other_boxes[None, :, 3])
+    intersection = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    other_area = (other_boxes[:, 2] - other_boxes[:, 0]) * (other_boxes[:, 3] - other_boxes[:, 1])
+    return intersection / np.maximum(area[:, None] + other_area[None, :] - intersection, 1e-9)
+
+
+def expand_boxes(boxes, margin):
+    """ Enlarges boxes (x1,y1,x2,y2) by a fraction of their size on each side
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    dx = (boxes[:, 2] - boxes[:, 0]) * margin / 2
+    dy = (boxes[:, 3] - boxes[:, 1]) * margin / 2
+    result = boxes + np.stack([-dx, -dy, dx, dy], axis=1)
+    return np.concatenate([np.floor(result[:, :2]), np.ceil(result[:, 2:])], axis=1).astype(np.int64)
@@ -1,5 +1,9 @@
 import random
+import threading
+import weakref
 from abc import ABC, abstractmethod
+from collections import OrderedDict
+from functools import lru_cache
 
 import cv2
 import numpy as np
@@ -14,18 +18,34 @@ class Visualizer(ABC):
         pass
 
     @abstractmethod
-    def visualise_boxes(self, image, predictions, incl_user_boxes=False):
+    def visualise_boxes(self, image, predictions, incl_user_boxes=False, out=None):
         """ Function used to visualise boxes detected 
         
         Params:
             image: An input image in numpy format
             predictions: dict, as described in DetectionModel.detect
             incl_user_boxes, bool (default False)
+            out: numpy array, optional buffer (e.g. the previous output of the caller) where the output is drawn, 
+                    used if it has the shape and type of the image (see _get_output)
         
         Returns:
             output: Output image in numpy format, a copy of the original image with boxes and labels   
         """
 
+    def _get_output(self, image, out):
+        """ Returns a copy of the image, written into out if possible (no new allocation)
+        """
+        if out is not None and out is not image and out.shape == image.shape and out.dtype == image.dtype:
+            np.copyto(out, image)
+            return out
+        return np.copy(image)
+
+    def _to_lists(self, boxes, pred_classes, instance_ids):
+        """ Converts the numpy outputs of the predictions into lists of python ints (as expected by opencv)
+        """
+        return (np.asarray(boxes).reshape(-1, 4).tolist(), np.asarray(pred_classes).tolist(), 
+                np.asarray(instance_ids).tolist())
+
     def get_random_colors(self, num_colors):
         colors = [(a,b,c) for a in [0,51,102] for b in [0,51,102] for c in [0,51,102]]
         if num_colors <= len(colors):
@@ -34,58 +54,134 @@ class Visualizer(ABC):
             return random.choices(colors, num_colors)
 
 class AdaptativeVisualizer(Visualizer):
+    """ The boxes predicted by the model are rendered once per image and predictions (the rendered layer is cached), 
+        the boxes added by the user are drawn on a copy of this layer
+    """
+    MAX_MEMORY_MB = 128 # budget of the rendered layers cached (shared by all the sessions of an app)
+    USER_BOX_COLOR = (250,0,110)
 
     def __init__(self):
         super().__init__()
+        self.layers = OrderedDict() # (id(image), id(boxes)) -> (image ref, boxes ref, rendered layer)
+        self.memory_size = 0
+        self.deleted = list() # (key, ref) of the layers to drop, whose image or boxes were deleted while locked
+        self.lock = threading.Lock()
 
-    def visualise_boxes(self, image, predictions, incl_user_boxes=False):
-        output = np.copy(image)
+    def clear(self):
+        """ Drops all the cached layers
+        """
+        with self.lock:
+            self.layers = OrderedDict()
+            self.memory_size = 0
+            self.deleted = list()
+
+    def visualise_boxes(self, image, predictions, incl_user_boxes=False, out=None):
+        output = self._get_output(self._get_model_layer(image, predictions), out)
         if incl_user_boxes and "boxes_adj" in predictions:
-            boxes = predictions["boxes_adj"]
-            pred_classes = predictions["pred_classes_adj"]
-            instance_ids = predictions["instance_ids_adj"]
-            pred_labels = predictions["pred_labels_adj"]
-            is_user_box = predictions["is_user_box"]
-        else:
-            boxes = predictions["boxes"]
-            pred_classes = predictions["pred_classes"]
-            instance_ids = predictions["instance_ids"]
-            pred_labels = predictions["pred_labels"]
-            is_user_box = None
+            # the user boxes are appended after the boxes of the model (see DetectorBackend.add_labeled_box)
+            user = np.flatnonzero(predictions["is_user_box"])
+            boxes, pred_classes, instance_ids = self._to_lists(np.asarray(predictions["boxes_adj"])[user], 
+                                                               np.asarray(predictions["pred_classes_adj"])[user], 
+                                                               np.asarray(predictions["instance_ids_adj"])[user])
+            colors = [self.USER_BOX_COLOR for _ in boxes]
+            self._draw_boxes(output, predictions, boxes, pred_classes, instance_ids, colors)
+        return output
+
+    def _get_model_layer(self, image, predictions):
+        """ Returns the image with the boxes predicted by the model (read-only, cached)
+            The layer is cached by the identity of the image and of the boxes array of the predictions: the arrays
+            of the predictions are never modified in place (the user boxes are added to new arrays), and the image 
+            shouldn't be either
+        """
+        key = (id(image), id(predictions["boxes"]))
+        with self.lock:
+            self._drop_deleted()
+            cached = self.layers.get(key)
+            # the ids of deleted objects can be reused, the references check that they are the same objects
+            if cached is not None and cached[0]() is image and cached[1]() is predictions["boxes"]:
+                self.layers.move_to_end(key)
+                return cached[2]
+        layer = np.copy(image)
+        boxes, pred_classes, instance_ids = self._to_lists(predictions["boxes"], predictions["pred_classes"], 
+                                                           predictions["instance_ids"])
+        colors = self._get_colors(predictions["name2int"], predictions["pred_labels"], pred_classes)
+        self._draw_boxes(layer, predictions, boxes, pred_classes, instance_ids, colors)
+        if layer.nbytes > self.MAX_MEMORY_MB * 1024 ** 2:
+            return layer
+        # the layer is dropped as soon as its image or boxes are deleted (e.g. new arrays on every call of an app)
+        on_deleted = lambda ref: self._on_deleted(key, ref)
+        try:
+            refs = (weakref.ref(image, on_deleted), weakref.ref(predictions["boxes"], on_deleted))
+        except TypeError: # e.g. boxes as lists, not cached
+            return layer
+        with self.lock:
+            self._drop_deleted()
+            if key in self.layers:
+                self._remove(key)
+            self.layers[key] = refs + (layer,)
+            self.memory_size += layer.nbytes
+            while self.memory_size > self.MAX_MEMORY_MB * 1024 ** 2:
+                self._remove(next(iter(self.layers)))
+        return layer
+
+    def _on_deleted(self, key, ref):
+        """ Weakref callback, called when the image or the boxes of a cached layer are deleted
+        """
+        # it can be called while the lock is held (e.g. by the garbage collector): the layer is then dropped by the
+        # next call of _get_model_layer
+        if not self.lock.acquire(blocking=False):
+            self.deleted.append((key, ref))
+            return
+        try:
+            self._drop(key, ref)
+        finally:
+            self.lock.release()
+
+    def _drop_deleted(self):
+        while self.deleted:
+            self._drop(*self.deleted.pop())
+
+    def _drop(self, key, ref):
+        # the key may have been reused by a new layer since the referent was deleted
+        cached = self.layers.get(key)
+        if cached is not None and (cached[0] is ref or cached[1] is ref):
+            self._remove(key)
+
+    def _remove(self, key):
+        self.memory_size -= self.layers.pop(key)[2].nbytes
+
+    def _draw_boxes(self, output, predictions, boxes, pred_classes, instance_ids, colors):
         multi_class = len(predictions["pred_labels"]) > 1
-        colors = self._get_colors(predictions["name2int"], pred_labels, pred_classes, is_user_box)
-        labels = list()
-        for i_id in instance_ids:
-            labels.append(f'{i_id}')
         thick = int((output.shape[0] + output.shape[1]) // 700.0)
-        for box, color, label, c_id in zip(boxes, colors, labels, pred_classes):
+        for box, color, i_id, c_id in zip(boxes, colors, instance_ids, pred_classes):
             x1, y1, x2, y2 = box
             cv2.rectangle(output, (x1, y1), (x2, y2), color, thick)
             cname = predictions["class_names"][c_id]
-            text=f"{cname[0].upper()}{label}" if multi_class else f"{label}"
+            text=f"{cname[0].upper()}{i_id}" if multi_class else f"{i_id}"
             self._draw_text(output, box, text, color, thick)
-        return output
 
-    def _get_colors(self, name2int, pred_labels, pred_classes, is_user_box):
+    def _get_colors(self, name2int, pred_labels, pred_classes):
         random_colors = self.get_random_colors(len(pred_labels))
         color_map = {name2int[name]: color for name,color in zip(pred_labels,random_colors)}
-        if is_user_box is not None:
-            colors = []
-            for pc, is_userbox in zip(pred_classes, is_user_box):
-                c = (250,0,110) if is_userbox else color_map[pc]
-                colors.append(c)
-            return colors
-        else:
-            return [color_map[pc] for pc in pred_classes]
+        return [color_map[pc] for pc in pred_classes]
 
     def _get_optimal_font_scale(self, text, width, height, thick):
-        for scale in reversed(range(0, 60, 1)):
-            textSize = cv2.getTextSize(text, fontFace=cv2.FONT_HERSHEY_SIMPLEX, fontScale=scale / 10, 
-                thickness=thick)
-            new_width, new_height = textSize[0]
-            if (new_width <= width) and (new_height <= height):
-                return scale / 10
-        return 1
+        """ Returns the largest font scale (by steps of 0.1, at most 5.9) for which the text fits in width x height 
+            (1 if the text doesn't fit at any scale)
+            The text size is linear in the scale (up to rounding): the scale is estimated from the size of the text 
+            at 2 scales, then checked (and corrected by steps of 0.1) with the actual text size
+        """
+        fits = lambda scale: _fits(_get_text_size(text, scale, thick), width, height)
+        # cv2.getTextSize is much slower for scales below 1
+        (w0, h0), (w1, h1) = _get_text_size(text, 10, thick), _get_text_size(text, 59, thick)
+        slope_w, slope_h = max(w1 - w0, 1) / 49, max(h1 - h0, 1) / 49 # per step of 0.1
+        estimate = 10 + int(np.floor(min((width - w0) / slope_w, (height - h0) / slope_h)))
+        scale = min(max(estimate, 0), 59)
+        while scale > 0 and not fits(scale):
+            scale -= 1
+        while scale < 59 and fits(scale + 1):
+            scale += 1
+        return scale / 10 if fits(scale) else 1
 
     def _draw_text(self, image, box, text, color, thick):
         x1, y1, x2, y2 = box
@@ -95,8 +191,7 @@ class AdaptativeVisualizer(Visualizer):
         # set the text start position
         text_offset_x = x1 
         text_offset_y = y2
-        text_w, text_h = cv2.getTextSize(text, fontFace=cv2.FONT_HERSHEY_SIMPLEX, fontScale=font_scale, 
-                thickness=thick)[0]
+        text_w, text_h = _get_text_size(text, round(font_scale * 10), thick)
         cv2.rectangle(image, (text_offset_x, text_offset_y), (text_offset_x+text_w, text_offset_y-text_h), 
                     (255, 255, 255), cv2.FILLED)
         cv2.putText(image, text, (text_offset_x, text_offset_y), cv2.FONT_HERSHEY_SIMPLEX, 
@@ -107,8 +202,8 @@ class SimpleVisualizer(Visualizer):
     def __init__(self):
         super().__init__()
 
-    def visualise_boxes(self, image, predictions, incl_user_boxes = False):
-        output = np.copy(image)
+    def visualise_boxes(self, image, predictions, incl_user_boxes = False, out=None):
+        output = self._get_output(image, out)
         if incl_user_boxes and "boxes_adj" in predictions:
             boxes = predictions["boxes_adj"]
             pred_classes = predictions["pred_classes_adj"]
@@ -117,6 +212,7 @@ class SimpleVisualizer(Visualizer):
             boxes = predictions["boxes"]
             pred_classes = predictions["pred_classes"]
             instance_ids = predictions["instance_ids"]
+        boxes, pred_classes, instance_ids = self._to_lists(boxes, pred_classes, instance_ids)
         color_map = {predictions["name2int"][name]:(random.randint(0, 255), random.randint(0, 255), random.randint(0, 255)) 
                             for name in predictions["pred_labels"]} 
         colors = [color_map[id] for id in pred_classes]
@@ -131,4 +227,16 @@ class SimpleVisualizer(Visualizer):
             x1, y1, x2, y2 = box
             cv2.rectangle(output, (x1, y1), (x2, y2), color, 2)
             cv2.putText(output, label, (x1,y1), cv2.FONT_HERSHEY_SIMPLEX, 1, color, 2, 1)
-        return output
\ No newline at end of file
+        return output
+
+
+@lru_cache(maxsize=4096)
+def _get_text_size(text, scale, thick):
+    """ Returns the size (width, height) of a text drawn with the font of the visualizers at scale / 10
+        Memoized: the labels (instance ids) and the scales are shared by many boxes and images
+    """
+    return cv2.getTextSize(text, fontFace=cv2.FONT_HERSHEY_SIMPLEX, fontScale=scale / 10, thickness=thick)[0]
+
+
+def _fits(size, width, height):
+    return size[0] <= width and size[1] <= height
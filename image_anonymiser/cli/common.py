@@ -0,0 +1,56 @@
+""" Arguments shared by the command line tools
+"""
+from image_anonymiser.backend.anonymiser import ANONYM_TYPES
+
+
+def add_detection_args(parser):
+    parser.add_argument("--bconfig", 
+                        default="config.yml", 
+                        type=str, 
+                        help=f"Name of the backend config file")
+    parser.add_argument("--model", 
+                        required=True, 
+                        type=str, 
+                        help=f"Detection model, name (as in the config file) or index in the detectors section")
+    parser.add_argument("--class_name", 
+                        required=True, 
+                        type=str, 
+                        help=f"Name of the class to anonymise (e.g. face, person, text)")
+    parser.add_argument("--target_type", 
+                        default="box", 
+                        choices=["box", "mask"], 
+                        help=f"Anonymise the boxes or the segmentation masks of the targets. Default is box")
+
+
+def add_anonymisation_args(parser):
+    parser.add_argument("--anonym_type", 
+                        default="blur", 
+                        choices=ANONYM_TYPES, 
+                        help=f"Anonymisation type. Default is blur")
+    parser.add_argument("--blur_intensity", 
+                        default=0.5, 
+                        type=float, 
+                        help=f"Blur intensity from 0 to 1 (as in the apps). Default is 0.5")
+    parser.add_argument("--color", 
+                        default="#000000", 
+                        type=str, 
+                        help=f"Color in hex format, used if anonym_type is color. Default is #000000")
+
+
+def get_model_index(detector, model):
+    """ Returns the index of a model given its name or its index (as a string)
+    """
+    if model in detector.choices:
+        return detector.choices.index(model)
+    if model.isdigit() and int(model) < len(detector.choices):
+        return int(model)
+    raise ValueError(f"model: {model} not found; use one of {detector.choices} (or their index)")
+
+
+def get_anonymisation_params(args, anonymiser_backend):
+    """ Returns the keyword arguments of Anonymiser.anonymise from the command line arguments
+    """
+    intensity = anonymiser_backend.convert_intensity(args.blur_intensity)
+    return {"anonym_type": args.anonym_type,
+            "blur_kernel": (intensity, intensity),
+            "color": anonymiser_backend.convert_color_hex_to_rgb(args.color)}
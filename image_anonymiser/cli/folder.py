@@ -0,0 +1,167 @@
+""" Anonymise all the images of a folder (from the root folder):
+        python -m image_anonymiser.cli.folder input_dir output_dir --model "Face detection" --class_name face [args]
+
+    The images are processed by a pool of worker processes, each one loading the detection model once. Every processed
+    image is recorded in a manifest (JSON lines, in the output folder by default), so an interrupted run resumes where
+    it stopped: the images already anonymised are skipped (the ones that failed are retried)
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from image_anonymiser.backend.anonymiser import AnonymiserBackend
+from image_anonymiser.backend.detector import DetectorBackend
+from image_anonymiser.cli.common import (add_anonymisation_args, add_detection_args, get_anonymisation_params,
+                                         get_model_index)
+
+EXTENSIONS = [".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff", ".webp"]
+MANIFEST_NAME = "manifest.jsonl"
+
+_worker = None # state of the worker process, set by init_worker
+
+
+def list_images(input_dir, extensions=EXTENSIONS):
+    """ Returns the paths (relative to input_dir, sorted) of the images in input_dir and its sub-folders
+    """
+    input_dir = Path(input_dir)
+    return sorted(str(p.relative_to(input_dir)) for p in input_dir.rglob("*") if p.suffix.lower() in extensions)
+
+
+def read_manifest(manifest_path):
+    """ Returns the paths of the images successfully processed by a previous run
+    """
+    done = set()
+    if not Path(manifest_path).exists():
+        return done
+    with open(manifest_path, "r") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError: # last line of an interrupted run
+                continue
+            if record.get("status") == "ok":
+                done.add(record["path"])
+    return done
+
+
+def check_args(args):
+    """ Returns the model index and the anonymisation params of the command line arguments, exits with an error
+        message if they are invalid (checked before starting the workers, an exception in their initializer would
+        only make the pool spawn them again)
+    """
+    detector = DetectorBackend(args.bconfig)
+    anonymiser_backend = AnonymiserBackend(args.bconfig)
+    try:
+        model_index = get_model_index(detector, args.model)
+        params = get_anonymisation_params(args, anonymiser_backend)
+    except ValueError as e:
+        sys.exit(f"error: {e}")
+    if args.class_name not in detector.classes[model_index]:
+        sys.exit(f"error: class: {args.class_name} is not detected by the model {detector.choices[model_index]}; "
+                 f"use one of {detector.classes[model_index]}")
+    return model_index, params
+
+
+def init_worker(args, model_index, params, threads):
+    """ Loads the backend once per worker process (the arguments are already checked by check_args)
+    """
+    global _worker
+    # must be set before the deep learning libraries are imported (when the model is loaded)
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+    _worker = {"detector": DetectorBackend(args.bconfig),
+               "anonymiser": AnonymiserBackend(args.bconfig),
+               "model_index": model_index,
+               "params": params,
+               "args": args}
+
+
+def process_image(path):
+    """ Anonymises one image (path relative to the input folder) and returns its manifest record
+    """
+    args = _worker["args"]
+    detector = _worker["detector"]
+    start = time.perf_counter()
+    record = {"path": path}
+    try:
+        image = cv2.imread(str(Path(args.input_dir) / path), cv2.IMREAD_COLOR)
+        if image is None:
+            raise ValueError("cannot read the image")
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        predictions = detector.detect(image, _worker["model_index"], use_cache=False)
+        if args.class_name in detector.get_pred_classes(predictions):
+            regions = detector.get_target_regions(args.class_name, "all", args.target_type, predictions)
+            class_id = predictions["name2int"][args.class_name]
+            record["targets"] = int(np.count_nonzero(np.asarray(predictions["pred_classes"]) == class_id))
+            image = _worker["anonymiser"].anonymise(image, regions, **_worker["params"])
+        else:
+            record["targets"] = 0
+        output_path = Path(args.output_dir) / path
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        if not cv2.imwrite(str(output_path), cv2.cvtColor(image, cv2.COLOR_RGB2BGR)):
+            raise ValueError("cannot write the image")
+        record["status"] = "ok"
+    except Exception as e:
+        record["status"] = "error"
+        record["error"] = f"{type(e).__name__}: {e}"
+    record["seconds"] = round(time.perf_counter() - start, 4)
+    return record
+
+
+def main(args):
+    model_index, params = check_args(args)
+    manifest_path = Path(args.manifest or Path(args.output_dir) / MANIFEST_NAME)
+    manifest_path.parent.mkdir(parents=True, exist_ok=True)
+    done = read_manifest(manifest_path)
+    paths = [p for p in list_images(args.input_dir) if p not in done]
+    print(f"{len(paths)} images to process ({len(done)} already done)", file=sys.stderr)
+    workers = args.workers or os.cpu_count()
+    threads = max(1, os.cpu_count() // workers)
+    counts = {"ok": 0, "error": 0}
+    start = time.perf_counter()
+    # spawn: the workers don't inherit the state of the deep learning libraries from the parent process
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(workers, initializer=init_worker, initargs=(args, model_index, params, threads)) as pool, \
+            open(manifest_path, "a") as manifest:
+        for i, record in enumerate(pool.imap_unordered(process_image, paths, chunksize=args.chunksize)):
+            manifest.write(json.dumps(record) + "\n")
+            manifest.flush()
+            counts[record["status"]] += 1
+            if record["status"] == "error":
+                print(f"\n{record['path']}: {record['error']}", file=sys.stderr)
+            print(f"\r{i + 1}/{len(paths)} images", end="", file=sys.stderr, flush=True)
+    seconds = time.perf_counter() - start
+    print(file=sys.stderr)
+    print(f"{counts['ok']} images anonymised, {counts['error']} errors in {seconds:.1f}s "
+          f"({len(paths) / seconds if seconds > 0 else 0:.1f} images/s). Manifest: {manifest_path}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input_dir",
+                        type=str,
+                        help=f"Folder of the images to anonymise (sub-folders included)")
+    parser.add_argument("output_dir",
+                        type=str,
+                        help=f"Folder where the anonymised images are written (with the same relative paths)")
+    add_detection_args(parser)
+    add_anonymisation_args(parser)
+    parser.add_argument("--workers",
+                        default=None,
+                        type=int,
+                        help=f"Number of worker processes. Default is the number of CPUs")
+    parser.add_argument("--chunksize",
+                        default=4,
+                        type=int,
+                        help=f"Number of images sent to a worker at a time. Default is 4")
+    parser.add_argument("--manifest",
+                        default=None,
+                        type=str,
+                        help=f"Manifest file used to resume an interrupted run. Default is {MANIFEST_NAME} in output_dir")
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,63 @@
+""" Anonymise a video file (from the root folder):
+        python -m image_anonymiser.cli.video input.mp4 output.mp4 --model "Face detection" --class_name face [args]
+"""
+import argparse
+import sys
+
+from image_anonymiser.backend.anonymiser import AnonymiserBackend
+from image_anonymiser.backend.detector import DetectorBackend
+from image_anonymiser.backend.video import PROPAGATION_MODES, VideoAnonymiser
+from image_anonymiser.cli.common import (add_anonymisation_args, add_detection_args, get_anonymisation_params,
+                                         get_model_index)
+
+
+def print_progress(frames, total):
+    print(f"\r{frames}/{total or '?'} frames", end="", file=sys.stderr, flush=True)
+
+
+def main(args):
+    detector = DetectorBackend(args.bconfig)
+    anonymiser_backend = AnonymiserBackend(args.bconfig)
+    params = get_anonymisation_params(args, anonymiser_backend)
+    video_anonymiser = VideoAnonymiser(detector, anonymiser_backend, get_model_index(detector, args.model), 
+                                       args.class_name, target_type=args.target_type, stride=args.stride, 
+                                       propagation=args.propagation, margin=args.margin, **params)
+    stats = video_anonymiser.run(args.input, args.output, codec=args.codec, max_frames=args.max_frames, 
+                                 progress=print_progress)
+    print(file=sys.stderr)
+    print(f"{stats['frames']} frames ({stats['keyframes']} detections) in {stats['seconds']:.1f}s: "
+          f"{stats['fps']:.1f} fps (detection {stats['detect_seconds']:.1f}s, "
+          f"anonymisation {stats['anonymise_seconds']:.1f}s)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input", 
+                        type=str, 
+                        help=f"Input video")
+    parser.add_argument("output", 
+                        type=str, 
+                        help=f"Output video")
+    add_detection_args(parser)
+    add_anonymisation_args(parser)
+    parser.add_argument("--stride", 
+                        default=5, 
+                        type=int, 
+                        help=f"The detection runs on one frame every stride frames. Default is 5")
+    parser.add_argument("--propagation", 
+                        default="interpolate", 
+                        choices=PROPAGATION_MODES, 
+                        help=f"How the targets are propagated between two detections. Default is interpolate")
+    parser.add_argument("--margin", 
+                        default=0.1, 
+                        type=float, 
+                        help=f"Fraction of their size by which the propagated boxes are enlarged. Default is 0.1")
+    parser.add_argument("--codec", 
+                        default="mp4v", 
+                        type=str, 
+                        help=f"Fourcc code of the output video. Default is mp4v")
+    parser.add_argument("--max_frames", 
+                        default=None, 
+                        type=int, 
+                        help=f"If set, only the first max_frames frames are processed")
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,86 @@
+""" Base class of the detection models. This module doesn't depend on the deep learning libraries, so it can be
+    imported by lightweight models (e.g. the stand-in detectors used by the benchmarks)
+"""
+from abc import ABC, abstractmethod
+
+
+def get_module_footprint(module):
+    """ Returns the size (in bytes) of the parameters and buffers of a torch module. Sub-modules that run outside of
+        torch (e.g. models/onnx_backend.py) give their size in a footprint attribute
+    """
+    tensors = sum(tensor.numel() * tensor.element_size() for tensor in list(module.parameters()) + list(module.buffers()))
+    return tensors + sum(getattr(submodule, "footprint", 0) for submodule in module.modules())
+
+
+class DetectionModel(ABC):
+    """ Abstract class for a detection model 
+        Any new model added should implement the abstract methods and return the output in a unified format
+    """
+
+    def __init__(self):
+        pass
+
+    @abstractmethod
+    def detect(image, **params):
+        """ Detect objects in an image and store the results in self.predictions 
+        
+        Params:
+            image: An input image in numpy format
+            params: kwargs that are specific to each detection model
+        Returns:
+            predictions: A dict that should contain the following keys:
+                - pred_classes: numpy array of int, shape (n,), ids of the classes detected in the image
+                - pred_labels: list[str], names corresponding to the classes detected
+                - scores: numpy array of float, shape (n,), scores representing the model certainty about the class 
+                        detected
+                - boxes: numpy array of int, shape (n, 4), coordiantes of the box (x1,y1,x2,y2) for each class detected
+                - masks: list[dict], for each class detected the mask (same shape as the image)
+                        that contains True if the pixel corresponds to the class, run-length encoded (see 
+                        image_anonymiser/models/masks.py). Dense masks (numpy array of bool, shape (n, h, w)) are 
+                        also accepted. This output is generated by segmentation models
+                - class_names: list[str], name of each class that can be detected by the model
+                - name2int: dict, mapping from class names to ids 
+                - instance_ids: numpy array of int, shape (n,), id of each instance within the class
+        Notes:
+            - All the keys above should be present in the output. If the model doen't produce the output 
+            (e.g. doesn't support segmentation), the value should be empty
+            - Other model specific keys can be added (e.g. polygons and text for ocr)
+            - The predictions are only converted to JSON serializable types at the boundaries of the application (see
+            image_anonymiser/models/predictions.py), the outputs of the models can be any type supported by 
+            to_serializable
+        """
+        return None
+
+    def detect_batch(self, images, **params):
+        """ Detect objects in a list of images
+            Models that support batched inference should override this method, the default implementation
+            calls self.detect on each image
+
+        Params:
+            images: list of input images in numpy format
+            params: kwargs that are specific to each detection model
+        Returns:
+            predictions: list[dict], predictions for each image as described in self.detect
+        """
+        return [self.detect(image, **params) for image in images]
+
+    @classmethod
+    def get_class_names(cls, **params):
+        """ Returns the names of the classes that can be detected, without loading the model (used by the backend 
+            to describe the models before their first use). Returns None if the model has to be loaded to know them
+
+        Params:
+            params: kwargs used to instantiate the model
+        """
+        return None
+
+    def get_torch_modules(self):
+        """ Returns the torch modules used by the model (used to estimate its memory footprint). Modules shared
+            with other models (see detectors.get_shared_predictor) are only counted once by the backend registry
+        """
+        return []
+
+    def get_memory_footprint(self):
+        """ Returns the approximate size (in bytes) of the model weights
+        """
+        return sum(get_module_footprint(module) for module in self.get_torch_modules())
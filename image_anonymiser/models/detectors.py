@@ -1,5 +1,7 @@
 import pickle
-from abc import ABC, abstractmethod
+import threading
+import weakref
+from collections import OrderedDict
 from pathlib import Path
 
 import cv2
@@ -13,53 +15,145 @@ from detectron2.data import MetadataCatalog
 from detectron2.engine import DefaultPredictor
 from facenet_pytorch import MTCNN
 
+from image_anonymiser.models import hooks
+from image_anonymiser.models.base import DetectionModel
+from image_anonymiser.models.masks import encode_rle_from_crop
+from image_anonymiser.models.onnx_backend import (check_backend, convert_craft, convert_detectron, convert_mtcnn,
+                                                  quantize_torch)
+from image_anonymiser.models.predictions import get_instance_ids
+
 DETECTRON_DEFAULT = "COCO-PanopticSegmentation/panoptic_fpn_R_50_3x.yaml"
 PAR_DIR = Path(__file__).resolve().parent
 ARTIFACTS_DIR = PAR_DIR / "artifacts"
+RAW_CACHE_SIZE = 4 # number of raw outputs kept by each shared predictor
 
-class DetectionModel(ABC):
-    """ Abstract class for a detection model 
-        Any new model added should implement the abstract methods and return the output in a unified format
+class BatchPredictor(DefaultPredictor):
+    """ Subclass of the detectron2 default predictor that runs the model on a list of images
     """
 
-    def __init__(self):
-        pass
+    def __call__(self, images):
+        arch = self.cfg.MODEL.META_ARCHITECTURE
+        with torch.no_grad():
+            inputs = []
+            with hooks.timer("preprocess", arch=arch):
+                for image in images:
+                    if self.input_format == "RGB":
+                        image = image[:, :, ::-1]
+                    height, width = image.shape[:2]
+                    image = self.aug.get_transform(image).apply_image(image)
+                    image = torch.as_tensor(image.astype("float32").transpose(2, 0, 1))
+                    inputs += [{"image": image, "height": height, "width": width}]
+            with hooks.timer("forward", arch=arch):
+                predictions = self.model(inputs)
+            return predictions 
 
-    @abstractmethod
-    def detect(image, **params):
-        """ Detect objects in an image and store the results in self.predictions 
-        
-        Params:
-            image: An input image in numpy format
-            params: kwargs that are specific to each detection model
-        Returns:
-            predictions: A dict that should contain the following keys:
-                - pred_classes: list[int], ids of the classes detected in the image
-                - pred_labels: list[str], names corresponding to the classes detected
-                - pred_scores: list[float], scores representing the model certainty about the class detected
-                - boxes: list[list[int]], coordiantes of the box (x1,y1,x2,y2) for each class detected
-                - masks: list[list[bool]], for each class detected the mask (same shape as the image)
-                        that contains True if the pixel corresponds to the class. This output is generated by
-                        segmentation models
-                - class_names: list[str], name of each class that can be detected by the model
-                - name2int: dict, mapping from class names to ids 
-                - instance_ids: list[int], id of each instance within the class
-        Notes:
-            - All the keys above should be present in the output. If the model doen't produce the output 
-            (e.g. doesn't support segmentation), the value should be an empty list
-            - Other model specific keys can be added (e.g. text for ocr)
-            - For the time being, all the outputs should be JSON serializable (to take into account web deployment) 
+class SharedPredictor():
+    """ Detectron2 predictor shared by all the detectors using the same config, weights and device (see 
+        get_shared_predictor), so that the network is loaded once and runs once per image
+        - The score threshold of the network is the lowest threshold of the detectors using it, each detector then
+          filters the instances with its own threshold
+        - The raw outputs (instances on cpu) of the last images are kept, so that switching between detectors
+          derived from the same network doesn't run it again on the same image. They are keyed by the image keys set
+          by the backend (see hooks.image_keys), the images without a key are not cached
+    """
+
+    def __init__(self, cfg, backend="torch", quantization=None, cache_size=RAW_CACHE_SIZE):
+        self.predictor = BatchPredictor(cfg)
+        if backend == "onnx":
+            convert_detectron(self.predictor.model, quantization)
+        elif quantization is not None:
+            quantize_torch(self.predictor.model)
+        self.threshold = cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST
+        self.cache_size = cache_size
+        self.cache = OrderedDict() # image key -> instances, ordered from least to most recent
+        self.lock = threading.Lock()
+
+    @property
+    def model(self):
+        return self.predictor.model
+
+    def require_threshold(self, threshold):
+        """ Lowers the score threshold of the network if a detector needs a lower one
         """
-        return None
+        with self.lock:
+            if threshold >= self.threshold:
+                return
+            self.threshold = threshold
+            box_predictor = getattr(getattr(self.model, "roi_heads", None), "box_predictor", None)
+            if box_predictor is not None:
+                box_predictor.test_score_thresh = threshold
+            else: # single stage detectors (e.g. RetinaNet)
+                self.model.test_score_thresh = threshold
+            self.cache = OrderedDict()
+
+    def __call__(self, images):
+        """ Returns the instances detected in each image (on cpu, with scores >= self.threshold)
+        """
+        keys = [hooks.get_image_key(image) for image in images]
+        outputs = [None for _ in images]
+        with self.lock:
+            threshold = self.threshold
+            for i, key in enumerate(keys):
+                if key is not None and key in self.cache:
+                    self.cache.move_to_end(key)
+                    outputs[i] = self.cache[key]
+        missing = [i for i, output in enumerate(outputs) if output is None]
+        hooks.inc("shared_predictions", value=len(images) - len(missing), arch=self.predictor.cfg.MODEL.META_ARCHITECTURE)
+        if missing:
+            preds = self.predictor([images[i] for i in missing])
+            with self.lock:
+                for i, pred in zip(missing, preds):
+                    outputs[i] = pred["instances"].to("cpu")
+                    # not cached if the threshold was lowered in the meantime
+                    if keys[i] is not None and threshold == self.threshold:
+                        self.cache[keys[i]] = outputs[i]
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        return outputs
+
+def encode_instance_masks(instances):
+    """ Returns the RLE masks of detectron2 instances. The masks are pasted by detectron2 inside the boxes (with a
+        1 pixel margin), so only these crops are encoded
+    """
+    masks = instances.pred_masks.numpy()
+    boxes = instances.pred_boxes.tensor.numpy()
+    h, w = masks.shape[1:]
+    result = list()
+    for mask, (x1, y1, x2, y2) in zip(masks, boxes):
+        x1, y1 = max(0, int(np.floor(x1)) - 1), max(0, int(np.floor(y1)) - 1)
+        x2, y2 = min(w, int(np.ceil(x2)) + 1), min(h, int(np.ceil(y2)) + 1)
+        result.append(encode_rle_from_crop(mask[y1:y2, x1:x2], (x1, y1), (h, w)))
+    return result
+
+_shared_predictors = weakref.WeakValueDictionary() # key of the network (see get_shared_predictor) -> SharedPredictor
+_shared_predictors_lock = threading.Lock()
+
+def get_shared_predictor(cfg_name, cfg, threshold, backend="torch", quantization=None):
+    """ Returns the predictor of the network (cfg_name, cfg.MODEL.WEIGHTS, cfg.MODEL.DEVICE, backend, quantization),
+        creating it if no loaded detector uses it yet. The predictor is released when all the detectors using it are
+        deleted
+    """
+    key = (cfg_name, cfg.MODEL.WEIGHTS, cfg.MODEL.DEVICE, backend, quantization)
+    with _shared_predictors_lock:
+        predictor = _shared_predictors.get(key)
+        if predictor is None:
+            predictor = SharedPredictor(cfg, backend, quantization)
+            _shared_predictors[key] = predictor
+    predictor.require_threshold(threshold)
+    return predictor
 
 class DetectronDetector(DetectionModel):
     """ Multi-class object detection and segmentation based on the Detectron2 library
         The model used is the Panoptic Segmentation model pre-trained on the COCO dataset
     """
 
-    def __init__(self, cfg_name=DETECTRON_DEFAULT, weights_file_name = None, threshold=0.7, device='cpu'):
+    def __init__(self, cfg_name=DETECTRON_DEFAULT, weights_file_name = None, threshold=0.7, device='cpu', 
+                 backend="torch", quantization=None):
         super().__init__()
+        check_backend(backend, device, quantization)
         self.cfg_name = cfg_name
+        self.backend = backend
+        self.quantization = quantization
         self.cfg = get_cfg()
         self.cfg.MODEL.DEVICE=device
         self.cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST = threshold
@@ -72,88 +166,181 @@ class DetectronDetector(DetectionModel):
         self.class_names = MetadataCatalog.get(self.dataset).thing_classes
         self.name2int = {self.class_names[i]:i for i in range(len(self.class_names))}
         self.threshold = threshold
-        self.predictor = DefaultPredictor(self.cfg)
+        self.predictor = get_shared_predictor(self.cfg_name, self.cfg, self.threshold, self.backend, self.quantization)
+
+    @classmethod
+    def get_class_names(cls, cfg_name=DETECTRON_DEFAULT, **params):
+        return MetadataCatalog.get(cls._get_dataset(cfg_name)).thing_classes
+
+    @staticmethod
+    def _get_dataset(cfg_name):
+        """ Returns the name of the dataset used to train the model (without building the model)
+        """
+        cfg = get_cfg()
+        cfg.merge_from_file(model_zoo.get_config_file(cfg_name))
+        return cfg.DATASETS.TRAIN[0]
+
+    def get_torch_modules(self):
+        return [self.predictor.model]
 
     def detect(self, image):
+        return self.detect_batch([image])[0]
+
+    def detect_batch(self, images):
+        batch_instances = self.predictor(images) # If no objects detected, the instances will contain empty Tensors
+        with hooks.timer("postprocess", model_class=type(self).__name__):
+            return [self._format_predictions(self._filter_instances(instances)) for instances in batch_instances]
+
+    def _filter_instances(self, instances):
+        """ Keeps the instances (shared with the other detectors using the same network) above self.threshold
+        """
+        return instances[instances.scores >= self.threshold]
+
+    def _format_predictions(self, instances):
+        """ Converts the instances detected by the detectron2 model in one image into the predictions dict
+        """
         predictions = dict()
-        pred = self.predictor(image) # If no objects detected, pred will contain empty Tensors
-        predictions["pred_classes"] = pred["instances"].pred_classes.cpu().numpy().tolist()
-        predictions["pred_labels"] = [self.class_names[i] for i in list(set(predictions["pred_classes"]))]
-        predictions["scores"] = pred["instances"].scores.cpu().numpy().tolist()
-        predictions["boxes"] = pred["instances"].pred_boxes.tensor.cpu().numpy().astype(int).tolist()
-        if hasattr(pred["instances"], "pred_masks"):
-            predictions["masks"] = pred["instances"].pred_masks.cpu().numpy().tolist()
+        predictions["pred_classes"] = instances.pred_classes.numpy().astype(np.int64)
+        predictions["pred_labels"] = [self.class_names[i] for i in np.unique(predictions["pred_classes"])]
+        predictions["scores"] = instances.scores.numpy()
+        predictions["boxes"] = instances.pred_boxes.tensor.numpy().astype(np.int64)
+        if instances.has("pred_masks"):
+            predictions["masks"] = encode_instance_masks(instances)
         else:
             predictions["masks"] = []
         predictions["class_names"] = self.class_names
         predictions["name2int"] = self.name2int
-        predictions["instance_ids"] = list()
-        counter = {self.name2int[label]:0 for label in predictions["pred_labels"]}
-        for class_id in predictions["pred_classes"]:
-            predictions["instance_ids"].append(counter[class_id])
-            counter[class_id]+=1
+        predictions["instance_ids"] = get_instance_ids(predictions["pred_classes"])
         return predictions
 
 class FaceNETDetector(DetectionModel):
     """ Face detection model using facenet
     """
 
-    def __init__(self, min_face_size=20, thresholds=[0.6,0.7,0.7], device=None):
+    def __init__(self, min_face_size=20, thresholds=[0.6,0.7,0.7], device=None, backend="torch", quantization=None):
         super().__init__()
+        check_backend(backend, device, quantization)
         self.min_face_size = min_face_size
         self.thresholds = thresholds
         self.device = device
         self.class_names = ['face']
         self.predictor = MTCNN(keep_all=True, min_face_size=self.min_face_size, thresholds=self.thresholds, 
                         device=self.device) 
+        if backend == "onnx":
+            convert_mtcnn(self.predictor, quantization)
+        elif quantization is not None:
+            quantize_torch(self.predictor)
+
+    @classmethod
+    def get_class_names(cls, **params):
+        return ['face']
+
+    def get_torch_modules(self):
+        return [self.predictor]
 
     def detect(self, image):
-        predictions = dict()
         boxes, probs = self.predictor.detect(image) #If no objects detected, boxes will be None
+        return self._format_predictions(image, boxes, probs)
+
+    def detect_batch(self, images):
+        """ MTCNN only supports batches of images with the same size, so the images are grouped by shape 
+        """
+        results = [None for _ in images]
+        groups = dict()
+        for i, image in enumerate(images):
+            groups.setdefault(image.shape, []).append(i)
+        for indices in groups.values():
+            if len(indices) == 1:
+                batch_boxes, batch_probs = self.predictor.detect(images[indices[0]])
+                batch_boxes, batch_probs = [batch_boxes], [batch_probs]
+            else:
+                batch_boxes, batch_probs = self.predictor.detect(np.stack([images[i] for i in indices]))
+            for i, boxes, probs in zip(indices, batch_boxes, batch_probs):
+                results[i] = self._format_predictions(images[i], boxes, probs)
+        return results
+
+    def _format_predictions(self, image, boxes, probs):
+        predictions = dict()
         if boxes is None:
-            boxes = np.array([])
-            probs = np.array([])
+            boxes = np.zeros((0, 4), dtype=np.int64)
+            probs = np.zeros(0)
         else:
-            boxes = boxes.astype(int)
+            boxes = boxes.astype(np.int64)
             boxes[boxes < 0] = 0
             boxes[:,0][boxes[:,0] >= image.shape[1]] = image.shape[1]-1
             boxes[:,2][boxes[:,2] >= image.shape[1]] = image.shape[1]-1
             boxes[:,1][boxes[:,1] >= image.shape[0]] = image.shape[0]-1
             boxes[:,3][boxes[:,3] >= image.shape[0]] = image.shape[0]-1
-        predictions["pred_classes"] = [0 for _ in range(len(probs))]
+        predictions["pred_classes"] = np.zeros(len(probs), dtype=np.int64)
         predictions["pred_labels"] = ['face'] if len(predictions["pred_classes"]) > 0 else []
-        predictions["scores"] = probs.tolist()
-        predictions["boxes"] = boxes.tolist()
+        predictions["scores"] = probs.astype(np.float64)
+        predictions["boxes"] = boxes
         predictions["masks"] = []
         predictions["class_names"] = self.class_names
         predictions["name2int"] = {'face':0}
-        predictions["instance_ids"] = list(range(len(predictions["pred_classes"])))
+        predictions["instance_ids"] = np.arange(len(predictions["pred_classes"]))
         return predictions
 
 class OCRDetector(DetectionModel):
     """ OCR model using easy ocr
+        By default only the text detection network (CRAFT) is run: the boxes are all that is needed to anonymise the
+        text. With recognize=True the recognition network is also loaded and run, and the predictions include the text
+        of each box (with the recognition confidence as score)
     """
 
-    def __init__(self, lang_list=["en"], gpu=False):
+    def __init__(self, lang_list=["en"], gpu=False, recognize=False, backend="torch", quantization=None):
         super().__init__()
+        check_backend(backend, "cuda" if gpu else "cpu", quantization)
         self.lang_list = lang_list
         self.gpu = gpu
+        self.recognize = recognize
         self.model_storage_directory = ARTIFACTS_DIR
         self.class_names = ['text']
-        self.reader = easyocr.Reader(self.lang_list, gpu=self.gpu, model_storage_directory=self.model_storage_directory)
+        # easyocr's default quantize=True is kept: on cpu its Linear/LSTM layers are always dynamically quantized
+        # (the same as quantization "int8" with the torch backend)
+        self.reader = easyocr.Reader(self.lang_list, gpu=self.gpu, model_storage_directory=self.model_storage_directory,
+                                     recognizer=self.recognize)
+        if backend == "onnx": # the recognition network (small and called on each text box) still runs with torch
+            convert_craft(self.reader, quantization)
+
+    @classmethod
+    def get_class_names(cls, **params):
+        return ['text']
+
+    def get_torch_modules(self):
+        if self.recognize:
+            return [self.reader.detector, self.reader.recognizer]
+        return [self.reader.detector]
 
     def detect(self, image):
+        """ Returns the predictions (see DetectionModel.detect) with the additional keys:
+            - polygons: numpy array of int, shape (n, 4, 2), corners (x, y) of each text region (the regions of
+                    rotated text are not axis-aligned, the boxes enclose them)
+            - text: list[str], text of each region (only if recognize is True)
+        """
         predictions = dict()
-        pred = self.reader.readtext(image) # If no objects detected, pred be an empty list
-        predictions["pred_classes"] = [0 for _ in range(len(pred))]
+        if self.recognize:
+            pred = self.reader.readtext(image) # If no objects detected, pred be an empty list
+            polygons = [p[0] for p in pred]
+            scores = [p[2] for p in pred]
+            predictions["text"] = [p[1] for p in pred]
+        else:
+            horizontal_list, free_list = self.reader.detect(image)
+            # horizontal boxes are returned as (x_min, x_max, y_min, y_max), the other ones as 4 corners
+            polygons = [[[x1, y1], [x2, y1], [x2, y2], [x1, y2]] for x1, x2, y1, y2 in horizontal_list[0]]
+            polygons += free_list[0]
+            scores = [1.0] * len(polygons) # the detection network doesn't score the grouped regions
+        polygons = np.array(polygons).astype(np.int64).reshape(-1, 4, 2) # sometimes the function returns float!
+        polygons = np.clip(polygons, 0, [image.shape[1], image.shape[0]])
+        predictions["pred_classes"] = np.zeros(len(polygons), dtype=np.int64)
         predictions["pred_labels"] = ['text'] if len(predictions["pred_classes"]) > 0 else []
-        predictions["scores"] = [p[2] for p in pred]
-        predictions["boxes"] = np.array([[*p[0][0], *p[0][2]] for p in pred]).astype(int).tolist() # sometimes the function returns float!
+        predictions["scores"] = np.array(scores, dtype=np.float64)
+        predictions["boxes"] = np.concatenate([polygons.min(axis=1), polygons.max(axis=1)], axis=1)
+        predictions["polygons"] = polygons
         predictions["masks"] = []
         predictions["name2int"] = {'text':0}
         predictions["class_names"] = self.class_names
-        predictions["instance_ids"] = list(range(len(predictions["pred_classes"])))
-        predictions["text"] = [p[1] for p in pred]
+        predictions["instance_ids"] = np.arange(len(predictions["pred_classes"]))
         return predictions
 
 class DetectronSingleDetector(DetectronDetector):
@@ -161,41 +348,51 @@ class DetectronSingleDetector(DetectronDetector):
         Uses a multi-class model but returns the predictions only for a target class
     """
 
-    def __init__(self, cfg_name=DETECTRON_DEFAULT, weights_file_name = None, threshold=0.7, device='cpu', target_id=0):
-        super().__init__(cfg_name=cfg_name, weights_file_name = weights_file_name, threshold=threshold, device=device)
+    def __init__(self, cfg_name=DETECTRON_DEFAULT, weights_file_name = None, threshold=0.7, device='cpu', target_id=0,
+                 backend="torch", quantization=None):
+        super().__init__(cfg_name=cfg_name, weights_file_name = weights_file_name, threshold=threshold, device=device,
+                         backend=backend, quantization=quantization)
         self.target_id = target_id
         self.class_names = [MetadataCatalog.get(self.dataset).thing_classes[self.target_id]]
 
-    def detect(self, image):
+    @classmethod
+    def get_class_names(cls, cfg_name=DETECTRON_DEFAULT, target_id=0, **params):
+        return [MetadataCatalog.get(cls._get_dataset(cfg_name)).thing_classes[target_id]]
+
+    def _filter_instances(self, instances):
+        """ Keeps the instances of the target class above self.threshold
+        """
+        return instances[(instances.pred_classes == self.target_id) & (instances.scores >= self.threshold)]
+
+    def _format_predictions(self, instances):
         predictions = dict()
-        pred = self.predictor(image) # If no objects detected, pred will contain empty Tensors
-        pred_classes = pred["instances"].pred_classes.cpu().numpy()
-        mask = np.array([True if i == self.target_id else False for i in pred_classes]) 
-        predictions["pred_classes"] = pred_classes[mask].tolist()
-        predictions["pred_labels"] = [self.class_names[i] for i in list(set(predictions["pred_classes"]))]
-        predictions["scores"] = pred["instances"].scores.cpu().numpy()[mask].tolist()
-        predictions["boxes"] = pred["instances"].pred_boxes.tensor.cpu().numpy().astype(int)[mask].tolist()
-        if hasattr(pred["instances"], "pred_masks"):
-            predictions["masks"] = pred["instances"].pred_masks.cpu().numpy()[mask].tolist()
+        predictions["pred_classes"] = instances.pred_classes.numpy().astype(np.int64)
+        predictions["pred_labels"] = [self.class_names[0]] if len(predictions["pred_classes"]) > 0 else []
+        predictions["scores"] = instances.scores.numpy()
+        predictions["boxes"] = instances.pred_boxes.tensor.numpy().astype(np.int64)
+        if instances.has("pred_masks"):
+            predictions["masks"] = encode_instance_masks(instances)
         else:
             predictions["masks"] = []
         predictions["class_names"] = self.class_names
         predictions["name2int"] = {self.class_names[0]:self.target_id}
-        predictions["instance_ids"] = list(range(len(predictions["pred_classes"])))
+        predictions["instance_ids"] = np.arange(len(predictions["pred_classes"]))
         return predictions
 
 class FaceDetector(DetectionModel):
     """Face Detector that performs face detection with facenet and face segmentation
     with deeplab
     """
-    def __init__(self, min_face_size=20, thresholds=[0.6,0.7,0.7], expansion=20, deeplab_model="", device=None):
+    def __init__(self, min_face_size=20, thresholds=[0.6,0.7,0.7], expansion=20, deeplab_model="", device=None, 
+                 batch_size=8, backend="torch", quantization=None):
         """Initialises facenet mtcnn input params and creates the deeplab default predictor
+        batch_size is the maximum number of face patches segmented by deeplab in a single call
         """
         self.min_face_size = min_face_size
         self.thresholds = thresholds
         self.device = device
         self.class_names = ['face']
-        self.facenet = FaceNETDetector(self.min_face_size, self.thresholds, self.device)
+        self.facenet = FaceNETDetector(self.min_face_size, self.thresholds, self.device, backend, quantization)
 
         if deeplab_model:
             deeplab_cfg_file = ARTIFACTS_DIR/(deeplab_model+"_cfg.pkl")
@@ -221,70 +418,75 @@ class FaceDetector(DetectionModel):
             self.deeplab_cfg.MODEL.SEM_SEG_HEAD.NORM = "BN"
         self.deeplab_cfg.MODEL.DEVICE = device
         self.deeplab_cfg.MODEL.WEIGHTS = deeplab_model_file
-        # subclass the default predictor to enable batched inferrence
-        class DeepLabPredictor(DefaultPredictor):
-            def __call__(self, images):
-                with torch.no_grad():
-                    inputs = []
-                    for image in images:
-                        if self.input_format == "RGB":
-                            image = image[:, :, ::-1]
-                        height, width = image.shape[:2]
-                        image = self.aug.get_transform(image).apply_image(image)
-                        image = torch.as_tensor(image.astype("float32").transpose(2, 0, 1))
-                        inputs += [{"image": image, "height": height, "width": width}]
-                    predictions = self.model(inputs)
-                    return predictions 
-
-        self.deeplab = DeepLabPredictor(self.deeplab_cfg)
+        self.deeplab = BatchPredictor(self.deeplab_cfg)
+        if backend == "onnx":
+            convert_detectron(self.deeplab.model, quantization)
+        elif quantization is not None:
+            quantize_torch(self.deeplab.model)
         self.expansion  = expansion
+        self.batch_size = batch_size
+
+    @classmethod
+    def get_class_names(cls, **params):
+        return ['face']
+
+    def get_torch_modules(self):
+        return self.facenet.get_torch_modules() + [self.deeplab.model]
         
     def detect(self, image):
         """Detects bounding boxes with facenet and does segmentation with deeplab
         """
-        predictions = self.facenet.detect(image)
-        boxes = predictions["boxes"]
-        refined_boxes = []
-        masks = []
-        h, w = image.shape[:2]
-        image_patches = []
-        image_patch_sizes = []
-        exp_boxes = []
-        max_w, max_h = 0, 0
-        for box in boxes:
-            x1,y1,x2,y2 = box
-            exp_x1 = max(0, x1 - self.expansion)
-            exp_y1 = max(0, y1 - self.expansion)
-            exp_x2 = min(w, x2 + self.expansion)
-            exp_y2 = min(h, y2 + self.expansion)
-            image_patch = image.copy()[exp_y1:exp_y2+1, exp_x1:exp_x2+1]
-            patch_h, patch_w = image_patch.shape[:2]
-            max_w, max_h = max(max_w, patch_w), max(max_h, patch_h)
-            image_patches += [image_patch]
-            image_patch_sizes += [(patch_w, patch_h)]
-            exp_boxes += [(exp_x1, exp_y1, exp_x2, exp_y2)]
-            
-        # resize_image patch to max size
-        for i,image_patch in enumerate(image_patches):
-            image_patches[i] = cv2.resize(image_patch, (max_w, max_h))
-
-        results = self.deeplab(image_patches)
-        for res, size, exp_box in zip(results, image_patch_sizes, exp_boxes):
-            sem_seg = res["sem_seg"]
-            sem_seg = torch.max(sem_seg, dim=0)[1].cpu().numpy()
-            skin_pixels = ((sem_seg==1)*255).astype('uint8')
-            skin_pixels = cv2.erode(skin_pixels, np.ones((5,5), np.uint8), iterations=1)
-            skin_pixels = cv2.resize(skin_pixels, size)
-            mask = np.zeros_like(image)[:,:,0]
-            exp_x1, exp_y1, exp_x2, exp_y2 = exp_box
-            mask[exp_y1:exp_y2+1, exp_x1:exp_x2+1] = skin_pixels
-            ys, xs = mask.nonzero()
-            min_y, min_x = np.min(ys), np.min(xs)
-            max_y, max_x = np.max(ys), np.max(xs)
-            refined_boxes += [[min_x,min_y,max_x,max_y]]
-            masks += [mask]
-            
-        predictions["boxes"] = refined_boxes
-        predictions["masks"] = masks
-        
-        return predictions    
\ No newline at end of file
+        return self.detect_batch([image])[0]
+
+    def detect_batch(self, images):
+        """Detects bounding boxes with facenet and does segmentation with deeplab
+        The face patches of all the images are segmented by deeplab, batch_size patches at a time. The patches are
+        views of the images (not resized: the predictor rescales and pads them), sorted by aspect ratio so that the
+        patches of a batch need little padding. The masks and refined boxes are computed on each patch, so the cost
+        per face depends on the size of the face and not on the size of the image
+        """
+        batch_predictions = self.facenet.detect_batch(images)
+        patches = [] # (image_id, face_id, expanded box)
+        for image_id, (image, predictions) in enumerate(zip(images, batch_predictions)):
+            h, w = image.shape[:2]
+            for face_id, (x1, y1, x2, y2) in enumerate(predictions["boxes"].tolist()):
+                exp_x1 = max(0, x1 - self.expansion)
+                exp_y1 = max(0, y1 - self.expansion)
+                exp_x2 = min(w - 1, x2 + self.expansion)
+                exp_y2 = min(h - 1, y2 + self.expansion)
+                patches += [(image_id, face_id, (exp_x1, exp_y1, exp_x2, exp_y2))]
+        patches.sort(key=lambda patch: (patch[2][2] - patch[2][0] + 1) / (patch[2][3] - patch[2][1] + 1))
+
+        # the faces are returned in the order of facenet (not in the order of the sorted patches)
+        refined_boxes = [[None] * len(predictions["boxes"]) for predictions in batch_predictions]
+        masks = [[None] * len(predictions["boxes"]) for predictions in batch_predictions]
+        for start in range(0, len(patches), self.batch_size):
+            batch = patches[start:start + self.batch_size]
+            image_patches = [images[image_id][y1:y2+1, x1:x2+1] for image_id, _, (x1, y1, x2, y2) in batch]
+            results = self.deeplab(image_patches)
+            with hooks.timer("postprocess", model_class=type(self).__name__):
+                for res, (image_id, face_id, exp_box) in zip(results, batch):
+                    box, mask = self._get_face_region(res["sem_seg"], exp_box, images[image_id].shape[:2])
+                    refined_boxes[image_id][face_id] = box
+                    masks[image_id][face_id] = mask
+
+        for predictions, image_boxes, image_masks in zip(batch_predictions, refined_boxes, masks):
+            predictions["boxes"] = np.array(image_boxes, dtype=np.int64).reshape(-1, 4)
+            predictions["masks"] = image_masks
+        return batch_predictions
+
+    def _get_face_region(self, sem_seg, exp_box, size):
+        """ Returns the refined box (in image coordinates) and the RLE mask of the skin pixels of a patch
+            If no skin pixel is found, the expanded box is returned and used as mask
+        """
+        exp_x1, exp_y1 = exp_box[:2]
+        sem_seg = torch.max(sem_seg, dim=0)[1].cpu().numpy()
+        skin_pixels = ((sem_seg==1)*255).astype('uint8')
+        skin_pixels = cv2.erode(skin_pixels, np.ones((5,5), np.uint8), iterations=1) > 0
+        ys = np.flatnonzero(skin_pixels.any(axis=1))
+        xs = np.flatnonzero(skin_pixels.any(axis=0))
+        if len(ys) == 0:
+            skin_pixels = np.ones_like(skin_pixels)
+            ys, xs = [0, skin_pixels.shape[0] - 1], [0, skin_pixels.shape[1] - 1]
+        box = [exp_x1 + xs[0], exp_y1 + ys[0], exp_x1 + xs[-1], exp_y1 + ys[-1]]
+        return box, encode_rle_from_crop(skin_pixels, (exp_x1, exp_y1), size)
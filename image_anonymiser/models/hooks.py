@@ -0,0 +1,55 @@
+""" Hooks used by the models to exchange information with the application without depending on it (the backend 
+    depends on the models, not the other way round):
+    - timer and inc are forwarded to the metrics registry set by the backend (see set_metrics and 
+      backend/metrics.py), they do nothing otherwise (e.g. when a model is used on its own)
+    - image_keys makes the keys of the input images computed by the backend (content digests, used by its 
+      predictions cache) available to the models, so they can cache intermediate results without hashing the images
+      again (see get_image_key)
+"""
+import contextvars
+from contextlib import contextmanager, nullcontext
+
+_metrics = None
+_image_keys = contextvars.ContextVar("image_keys", default=None) # id(image) -> (image, key)
+
+
+def set_metrics(metrics):
+    """ Sets the metrics registry (with timer and inc methods, see backend/metrics.py) used by the hooks
+    """
+    global _metrics
+    _metrics = metrics
+
+
+def timer(stage, **labels):
+    """ Context manager that records the duration of its block for the given stage
+    """
+    return nullcontext() if _metrics is None else _metrics.timer(stage, **labels)
+
+
+def inc(name, value=1, **labels):
+    """ Increments a counter
+    """
+    if _metrics is not None:
+        _metrics.inc(name, value, **labels)
+
+
+@contextmanager
+def image_keys(images, keys):
+    """ Context manager that makes the keys of the images (None for no key) available to the models called in its 
+        block, see get_image_key
+    """
+    current = dict(_image_keys.get() or {})
+    current.update({id(image): (image, key) for image, key in zip(images, keys) if key is not None})
+    token = _image_keys.set(current)
+    try:
+        yield
+    finally:
+        _image_keys.reset(token)
+
+
+def get_image_key(image):
+    """ Returns the key of an image set by image_keys, or None. The key is only returned for the same image object:
+        images derived from it (e.g. downscaled by a wrapper) have no key unless the wrapper sets one
+    """
+    entry = (_image_keys.get() or {}).get(id(image))
+    return entry[1] if entry is not None and entry[0] is image else None
@@ -0,0 +1,90 @@
+""" Compact encoding of the segmentation masks returned by the detection models
+    The masks are run-length encoded as in the COCO format (uncompressed RLE): {"size": [height, width], "counts":
+    [...]}, the counts being the lengths of the alternating runs of False and True pixels (starting with False) in
+    column-major order. The encoding is JSON serializable and only depends on numpy
+"""
+import numpy as np
+
+
+def is_rle(mask):
+    return isinstance(mask, dict) and "counts" in mask and "size" in mask
+
+
+def encode_rle(mask):
+    """ Returns the RLE of a boolean mask of shape (height, width)
+    """
+    mask = np.asarray(mask, dtype=bool)
+    return encode_rle_from_crop(mask, (0, 0), mask.shape)
+
+
+def encode_rle_from_crop(crop, offset, size):
+    """ Returns the RLE of a mask that is False everywhere except in a crop, without building the full mask
+
+    Params:
+        crop: numpy array of bool, shape (crop_height, crop_width)
+        offset: tuple(int, int), coordinates (x, y) of the top left corner of the crop in the mask
+        size: tuple(int, int), (height, width) of the mask
+    """
+    h, w = int(size[0]), int(size[1])
+    x, y = int(offset[0]), int(offset[1])
+    crop = np.asarray(crop, dtype=bool)[max(0, -y):h - y, max(0, -x):w - x]
+    x, y = max(0, x), max(0, y)
+    crop_h, crop_w = crop.shape[:2]
+    if crop.size == 0 or not crop.any():
+        return {"size": [h, w], "counts": [h * w]}
+    # column-major runs of each column of the crop, padded with False at both ends
+    padded = np.zeros((crop_w, crop_h + 2), dtype=np.int8)
+    padded[:, 1:-1] = crop.T
+    cols, rows = np.nonzero(np.diff(padded, axis=1))
+    positions = (x + cols) * h + y + rows # position in the flattened mask of each change of value
+    starts, ends = positions[0::2], positions[1::2]
+    # runs that continue from the bottom of a column to the top of the next one (crops of full height)
+    keep_start = np.ones(len(starts), dtype=bool)
+    keep_end = np.ones(len(ends), dtype=bool)
+    joined = ends[:-1] == starts[1:]
+    keep_end[:-1][joined] = False
+    keep_start[1:][joined] = False
+    starts, ends = starts[keep_start], ends[keep_end]
+    bounds = np.empty(2 * len(starts) + 2, dtype=np.int64)
+    bounds[0] = 0
+    bounds[1:-1:2] = starts
+    bounds[2:-1:2] = ends
+    bounds[-1] = h * w
+    counts = np.diff(bounds)
+    if counts[-1] == 0:
+        counts = counts[:-1]
+    return {"size": [h, w], "counts": counts.tolist()}
+
+
+def decode_rle(rle):
+    """ Returns the boolean mask of shape (height, width) encoded in a RLE
+    """
+    return decode_rle_union([rle], rle["size"])
+
+
+def decode_rle_union(rles, size):
+    """ Returns the union of several RLE masks of the same size as a single boolean mask of shape (height, width)
+    """
+    h, w = int(size[0]), int(size[1])
+    result = np.zeros((w, h), dtype=bool) # transposed, so that the flattened array is in column-major order
+    flat = result.reshape(-1)
+    for rle in rles:
+        bounds = np.cumsum(rle["counts"])
+        for start, end in zip(bounds[0::2].tolist(), bounds[1::2].tolist()):
+            flat[start:end] = True
+    return result.T
+
+
+def encode_masks(masks):
+    """ Returns the RLE of a list of masks (masks that are already encoded are returned as they are)
+    """
+    return [mask if is_rle(mask) else encode_rle(mask) for mask in masks]
+
+
+def decode_mask(mask):
+    """ Returns a boolean mask of shape (height, width) from a mask in any of the supported formats (RLE, nested
+        lists or numpy array)
+    """
+    if is_rle(mask):
+        return decode_rle(mask)
+    return np.asarray(mask, dtype=bool)
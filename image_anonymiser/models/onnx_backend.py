@@ -0,0 +1,209 @@
+""" ONNX Runtime inference backend of the detectors (backend: "onnx" in the params of a detector, cpu only)
+    The heavy sub-networks of the models are exported to ONNX on their first use and run with onnxruntime:
+    - the 3 networks of MTCNN (FaceNETDetector and FaceDetector)
+    - the backbone of the Detectron2 models (DetectronDetector and the DeepLab model of FaceDetector)
+    - the text detection network of EasyOCR (OCRDetector)
+    The torch modules are replaced by OnnxModule objects that take and return torch tensors, so the pre and post
+    processing of the libraries are unchanged. The exported graphs are cached in models/artifacts/onnx, keyed by the
+    name of the network and a digest of its weights (a new checkpoint is exported again)
+
+    Both backends support INT8 dynamic quantization (quantization: "int8" in the params of a detector): the weights are
+    stored as 8 bit integers and the activations are quantized on the fly, so no calibration data is needed
+    - onnx: all the layers of the exported networks (convolutions included) are quantized by onnxruntime, the
+      quantized graphs are cached next to the float ones
+    - torch: only the fully connected and recurrent layers are quantized (torch doesn't support the dynamic
+      quantization of convolutions), e.g. the box head of the Detectron2 models or the EasyOCR recognizer
+"""
+import hashlib
+import os
+from pathlib import Path
+
+import numpy as np
+import torch
+
+BACKENDS = ["torch", "onnx"]
+QUANTIZATIONS = [None, "int8"]
+ONNX_DIR = Path(__file__).resolve().parent / "artifacts" / "onnx"
+OPSET = 13
+
+
+def check_backend(backend, device=None, quantization=None):
+    """ Raises a ValueError if the backend or the quantization is not supported (on this device)
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"backend: {backend} not supported; use one of {BACKENDS}")
+    if quantization not in QUANTIZATIONS:
+        raise ValueError(f"quantization: {quantization} not supported; use one of {QUANTIZATIONS}")
+    if backend == "onnx" and device not in (None, "cpu"):
+        raise ValueError(f"The onnx backend only runs on cpu (device: {device})")
+    if quantization is not None and device not in (None, "cpu"):
+        raise ValueError(f"The quantized models only run on cpu (device: {device})")
+
+
+def get_weights_digest(module):
+    """ Returns a digest of the parameters and buffers of a torch module
+    """
+    digest = hashlib.blake2b(digest_size=8)
+    for name, tensor in module.state_dict().items():
+        digest.update(name.encode("utf-8"))
+        digest.update(np.ascontiguousarray(tensor.detach().cpu().numpy()))
+    return digest.hexdigest()
+
+
+def export_onnx(module, name, example_inputs, input_names, output_names, dynamic_axes, quantization=None):
+    """ Returns the path of the ONNX graph of a torch module, exporting (and quantizing) it if it isn't cached yet
+
+    Params:
+        module: torch module, its outputs should be a tensor or a tuple of tensors
+        name: str, name of the network (prefix of the file name)
+        example_inputs: tuple of tensors, inputs used to trace the module
+        input_names, output_names: list[str], names of the inputs and outputs of the graph
+        dynamic_axes: dict, dynamic axes of the inputs and outputs (see torch.onnx.export)
+        quantization: str, see QUANTIZATIONS
+    """
+    path = ONNX_DIR / f"{name}-{get_weights_digest(module)}.onnx"
+    if quantization is not None:
+        quantized_path = path.with_name(f"{path.stem}-{quantization}.onnx")
+        if not quantized_path.exists():
+            quantize_onnx(_export(module, path, example_inputs, input_names, output_names, dynamic_axes), quantized_path)
+        return quantized_path
+    return _export(module, path, example_inputs, input_names, output_names, dynamic_axes)
+
+
+def _export(module, path, example_inputs, input_names, output_names, dynamic_axes):
+    if path.exists():
+        return path
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp") # renamed once complete (several processes may export)
+    training = module.training
+    module.eval()
+    with torch.no_grad():
+        torch.onnx.export(module, example_inputs, str(tmp_path), input_names=input_names, output_names=output_names,
+                          dynamic_axes=dynamic_axes, opset_version=OPSET)
+    module.train(training)
+    os.replace(tmp_path, path)
+    return path
+
+
+def quantize_onnx(path, quantized_path):
+    """ Writes the INT8 dynamic quantization of an ONNX graph to quantized_path
+    """
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    tmp_path = quantized_path.with_suffix(f".{os.getpid()}.tmp")
+    # unsigned weights: the quantized convolutions (ConvInteger) of onnxruntime only support uint8 on cpu
+    quantize_dynamic(str(path), str(tmp_path), weight_type=QuantType.QUInt8)
+    os.replace(tmp_path, quantized_path)
+    return quantized_path
+
+
+def quantize_torch(module):
+    """ Quantizes (in place) the fully connected and recurrent layers of a torch module to INT8
+    """
+    return torch.quantization.quantize_dynamic(module, {torch.nn.Linear, torch.nn.LSTM}, dtype=torch.qint8,
+                                               inplace=True)
+
+
+class OnnxModule(torch.nn.Module):
+    """ Drop-in replacement of a torch module that runs its ONNX graph with onnxruntime on cpu
+        The outputs are returned as a tuple of torch tensors (a single tensor if the graph has one output)
+    """
+
+    def __init__(self, path):
+        super().__init__()
+        import onnxruntime # only needed by this backend
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        # same number of threads as torch when it is limited (e.g. by the folder command line tool)
+        options.intra_op_num_threads = int(os.environ.get("OMP_NUM_THREADS", 0))
+        self.path = Path(path)
+        self.session = onnxruntime.InferenceSession(str(path), options, providers=["CPUExecutionProvider"])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+        self.output_names = [o.name for o in self.session.get_outputs()]
+        self.footprint = self.path.stat().st_size # the weights are stored in the graph (see get_module_footprint)
+
+    def forward(self, *inputs):
+        feeds = {name: np.ascontiguousarray(x.detach().cpu().numpy()) for name, x in zip(self.input_names, inputs)}
+        outputs = tuple(torch.from_numpy(output) for output in self.session.run(None, feeds))
+        return outputs[0] if len(outputs) == 1 else outputs
+
+
+class OnnxBackbone(OnnxModule):
+    """ Replacement of the backbone of a Detectron2 model: returns the dict of feature maps and exposes the
+        attributes of the backbone used by the meta architectures
+    """
+
+    def __init__(self, path, backbone):
+        super().__init__(path)
+        self.size_divisibility = backbone.size_divisibility
+        self.padding_constraints = getattr(backbone, "padding_constraints", {})
+        self._output_shape = backbone.output_shape()
+
+    def output_shape(self):
+        return self._output_shape
+
+    def forward(self, x):
+        outputs = super().forward(x)
+        outputs = outputs if isinstance(outputs, tuple) else (outputs,)
+        return dict(zip(self.output_names, outputs))
+
+
+class _TupleOutputs(torch.nn.Module):
+    """ Returns the outputs of a module returning a dict as a tuple (the ONNX export doesn't support dicts)
+    """
+
+    def __init__(self, module, keys):
+        super().__init__()
+        self.module = module
+        self.keys = keys
+
+    def forward(self, x):
+        outputs = self.module(x)
+        return tuple(outputs[key] for key in self.keys)
+
+
+def convert_mtcnn(mtcnn, quantization=None):
+    """ Replaces the networks of a facenet_pytorch MTCNN by their ONNX version
+    """
+    # pnet runs on the whole image (at several scales), rnet and onet on batches of fixed size crops
+    pnet_axes = {0: "batch", 2: "out_height", 3: "out_width"}
+    networks = {"pnet": (torch.rand(1, 3, 120, 160), ["reg", "probs"],
+                         {"image": {0: "batch", 2: "height", 3: "width"}, "reg": pnet_axes, "probs": pnet_axes}),
+                "rnet": (torch.rand(1, 3, 24, 24), ["reg", "probs"],
+                         {"image": {0: "batch"}, "reg": {0: "batch"}, "probs": {0: "batch"}}),
+                "onet": (torch.rand(1, 3, 48, 48), ["reg", "landmarks", "probs"],
+                         {"image": {0: "batch"}, "reg": {0: "batch"}, "landmarks": {0: "batch"}, "probs": {0: "batch"}})}
+    for name, (example, output_names, dynamic_axes) in networks.items():
+        path = export_onnx(getattr(mtcnn, name), f"mtcnn_{name}", (example,), ["image"], output_names, dynamic_axes,
+                           quantization)
+        setattr(mtcnn, name, OnnxModule(path))
+    return mtcnn
+
+
+def convert_detectron(model, quantization=None):
+    """ Replaces the backbone of a Detectron2 model by its ONNX version (the region proposals and heads still run
+        with torch)
+    """
+    backbone = model.backbone
+    keys = list(backbone.output_shape().keys())
+    divisibility = max(32, backbone.size_divisibility)
+    example = torch.rand(1, 3, 16 * divisibility, 20 * divisibility)
+    dynamic_axes = {"image": {0: "batch", 2: "height", 3: "width"}}
+    dynamic_axes.update({key: {0: "batch", 2: f"{key}_height", 3: f"{key}_width"} for key in keys})
+    name = f"{type(model).__name__.lower()}_backbone"
+    path = export_onnx(_TupleOutputs(backbone, keys), name, (example,), ["image"], keys, dynamic_axes, quantization)
+    model.backbone = OnnxBackbone(path, backbone)
+    return model
+
+
+def convert_craft(reader, quantization=None):
+    """ Replaces the text detection network (CRAFT) of an EasyOCR reader by its ONNX version
+    """
+    detector = reader.detector
+    detector = getattr(detector, "module", detector) # the network may be wrapped in a DataParallel
+    dynamic_axes = {"image": {0: "batch", 2: "height", 3: "width"},
+                    "score": {0: "batch", 1: "out_height", 2: "out_width"},
+                    "feature": {0: "batch", 2: "out_height", 3: "out_width"}}
+    path = export_onnx(detector, "craft", (torch.rand(1, 3, 480, 640),), ["image"], ["score", "feature"], dynamic_axes,
+                       quantization)
+    reader.detector = OnnxModule(path)
+    return reader
@@ -0,0 +1,56 @@
+""" Conversion of the predictions (as described in DetectionModel.detect) between their in-process form, where the
+    numeric outputs are numpy arrays, and a JSON serializable form, used only at the boundaries of the application
+    (FastAPI app, api mode of the DetectorBackend and files written by FileIO)
+"""
+import numpy as np
+
+from image_anonymiser.models.masks import encode_masks
+
+ARRAY_KEYS = {"pred_classes": np.int64, "scores": np.float64, "boxes": np.int64, "instance_ids": np.int64,
+              "pred_classes_adj": np.int64, "scores_adj": np.float64, "boxes_adj": np.int64,
+              "instance_ids_adj": np.int64, "polygons": np.int64}
+BOX_KEYS = ["boxes", "boxes_adj"]
+POLYGON_KEYS = ["polygons"]
+
+
+def get_instance_ids(pred_classes):
+    """ Returns the id of each instance within its class (0 for the first instance of a class, 1 for the second...)
+    """
+    pred_classes = np.asarray(pred_classes)
+    result = np.zeros(len(pred_classes), dtype=np.int64)
+    for class_id in np.unique(pred_classes):
+        selected = pred_classes == class_id
+        result[selected] = np.arange(np.count_nonzero(selected))
+    return result
+
+
+def to_arrays(predictions):
+    """ Returns a shallow copy of the predictions where the numeric outputs are numpy arrays (boxes have the shape
+        (n, 4) and polygons the shape (n, 4, 2), even when empty)
+    """
+    result = dict(predictions)
+    for key, dtype in ARRAY_KEYS.items():
+        if key in result:
+            result[key] = np.asarray(result[key], dtype=dtype)
+    for key in BOX_KEYS:
+        if key in result:
+            result[key] = result[key].reshape(-1, 4)
+    for key in POLYGON_KEYS:
+        if key in result:
+            result[key] = result[key].reshape(-1, 4, 2)
+    return result
+
+
+def to_serializable(predictions):
+    """ Returns a JSON serializable copy of the predictions: numpy arrays are converted to lists and the masks
+        to RLE (see image_anonymiser/models/masks.py)
+    """
+    result = dict()
+    for key, value in predictions.items():
+        if key == "masks":
+            result[key] = encode_masks(value)
+        elif isinstance(value, (np.ndarray, np.generic)):
+            result[key] = value.tolist()
+        else:
+            result[key] = value
+    return result
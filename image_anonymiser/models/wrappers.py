@@ -0,0 +1,294 @@
+""" Wrappers that change how a detection model is run (e.g. on a downscaled copy of the image) without changing its
+    outputs: the predictions are always returned in the coordinates of the original image
+    The wrappers are configured per detector in the config file and applied by the backend registry (see wrap_model)
+"""
+import cv2
+import numpy as np
+
+from image_anonymiser.models import hooks
+from image_anonymiser.models.base import DetectionModel
+from image_anonymiser.models.masks import decode_mask, encode_rle_from_crop
+from image_anonymiser.models.predictions import get_instance_ids
+
+BASE_KEYS = ["pred_classes", "scores", "boxes", "masks", "instance_ids"]
+GLOBAL_KEYS = ["pred_labels", "class_names", "name2int"] # keys of the predictions that are not per instance
+
+
+def wrap_model(model, detector_config):
+    """ Returns the model wrapped as configured in its detector config (the model itself if no wrapper is used)
+
+    Params:
+        model: DetectionModel
+        detector_config: dict, config of the detector (item of the detectors section of the config file)
+    """
+    if detector_config.get("tiling"):
+        model = TiledDetector(model, **detector_config["tiling"])
+    if detector_config.get("max_inference_side"):
+        model = DownscaledDetector(model, detector_config["max_inference_side"])
+    return model
+
+
+class ModelWrapper(DetectionModel):
+    """ Base class of the wrappers, delegates to the wrapped model
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    @property
+    def class_names(self):
+        return self.model.class_names
+
+    def get_torch_modules(self):
+        return self.model.get_torch_modules()
+
+
+class DownscaledDetector(ModelWrapper):
+    """ Runs the model on a copy of the image whose longest side is at most max_inference_side, and scales the boxes
+        and masks back to the original resolution (so the anonymisation is still done at full resolution)
+        Images that are already small enough are passed as they are
+    """
+
+    def __init__(self, model, max_inference_side):
+        super().__init__(model)
+        self.max_inference_side = max_inference_side
+
+    def detect(self, image, **params):
+        return self.detect_batch([image], **params)[0]
+
+    def detect_batch(self, images, **params):
+        small_images = [self._downscale(image) for image in images]
+        # the keys of the downscaled images are derived from the keys of the images (see hooks.image_keys)
+        keys = [derive_image_key(image, small, "x".join(str(d) for d in small.shape[:2])) 
+                for image, small in zip(images, small_images)]
+        with hooks.image_keys(small_images, keys):
+            batch_predictions = self.model.detect_batch(small_images, **params)
+        return [self._rescale_predictions(predictions, small.shape[:2], image.shape[:2])
+                for predictions, small, image in zip(batch_predictions, small_images, images)]
+
+    def _downscale(self, image):
+        h, w = image.shape[:2]
+        scale = self.max_inference_side / max(h, w)
+        if scale >= 1:
+            return image
+        size = (max(1, round(w * scale)), max(1, round(h * scale)))
+        return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+    def _rescale_predictions(self, predictions, small_size, size):
+        if tuple(small_size) == tuple(size):
+            return predictions
+        predictions = dict(predictions)
+        predictions["boxes"] = rescale_boxes(predictions["boxes"], small_size, size)
+        predictions["masks"] = [rescale_mask(mask, size) for mask in predictions["masks"]]
+        if "polygons" in predictions:
+            predictions["polygons"] = rescale_polygons(predictions["polygons"], small_size, size)
+        return predictions
+
+
+class TiledDetector(ModelWrapper):
+    """ Runs the model on overlapping tiles of the image (for images much larger than the resolution the model was
+        trained on, e.g. scans or panoramas) and merges the predictions in the coordinates of the whole image:
+        - The tiles are views of the image, they are copied and run batch_size at a time, so the memory used by the
+          model depends on the tile size and not on the image size
+        - The masks are kept as crops around each object while merging, and returned as RLE of the whole image
+        - Objects detected in several tiles (in the overlaps) are merged with a greedy non-maximum suppression: the
+          detection with the highest score absorbs (box and mask union) the detections of the same class that
+          overlap it by more than iou_threshold. The overlap is measured relative to the smaller box, so the parts of
+          an object cut by the border of a tile are merged with the whole object
+        Images that fit in a single tile are passed as they are
+    """
+
+    def __init__(self, model, tile_size=1024, overlap=128, batch_size=4, iou_threshold=0.5):
+        """
+        Params:
+            model: DetectionModel
+            tile_size: int, side of the (square) tiles
+            overlap: int, number of pixels shared by two neighbouring tiles (should be larger than the objects
+                    that have to be detected whole in at least one tile)
+            batch_size: int, number of tiles passed to the model at a time
+            iou_threshold: float, overlap above which two detections of the same class are merged
+        """
+        super().__init__(model)
+        if not 0 <= overlap < tile_size:
+            raise ValueError("The tiling overlap should be smaller than the tile size")
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.batch_size = batch_size
+        self.iou_threshold = iou_threshold
+
+    def detect(self, image, **params):
+        h, w = image.shape[:2]
+        if h <= self.tile_size and w <= self.tile_size:
+            return self.model.detect(image, **params)
+        detections = list()
+        template = None
+        tiles = list(self._get_tiles(h, w))
+        for start in range(0, len(tiles), self.batch_size):
+            batch = tiles[start:start + self.batch_size]
+            crops = [np.ascontiguousarray(image[y1:y2, x1:x2]) for x1, y1, x2, y2 in batch]
+            keys = [derive_image_key(image, crop, ",".join(str(c) for c in tile)) for crop, tile in zip(crops, batch)]
+            with hooks.image_keys(crops, keys):
+                batch_predictions = self.model.detect_batch(crops, **params)
+            for (x1, y1, _, _), predictions in zip(batch, batch_predictions):
+                template = predictions
+                detections.extend(self._get_detections(predictions, x1, y1))
+        detections = self._merge(detections)
+        return self._format_predictions(template, detections, (h, w))
+
+    def _get_tiles(self, h, w):
+        """ Yields the coordinates (x1,y1,x2,y2) of the tiles covering an image of size (h, w)
+        """
+        stride = self.tile_size - self.overlap
+        def starts(length):
+            last = max(0, length - self.tile_size)
+            return sorted(set(list(range(0, last, stride)) + [last]))
+        for y1 in starts(h):
+            for x1 in starts(w):
+                yield x1, y1, min(w, x1 + self.tile_size), min(h, y1 + self.tile_size)
+
+    def _get_detections(self, predictions, offset_x, offset_y):
+        """ Returns the detections of a tile as dicts in the coordinates of the image (masks as cropped arrays)
+        """
+        n = len(predictions["pred_classes"])
+        boxes = np.asarray(predictions["boxes"], dtype=np.int64).reshape(-1, 4) + [offset_x, offset_y] * 2
+        detections = list()
+        for i in range(n):
+            detection = {"pred_class": int(predictions["pred_classes"][i]), 
+                         "score": float(predictions["scores"][i]), 
+                         "box": boxes[i].tolist(), 
+                         "mask": None,
+                         "extra": {key: value[i] for key, value in predictions.items() if key not in GLOBAL_KEYS 
+                                   and key not in BASE_KEYS and hasattr(value, "__len__") and len(value) == n}}
+            if "polygons" in detection["extra"]:
+                detection["extra"]["polygons"] = detection["extra"]["polygons"] + [offset_x, offset_y]
+            if len(predictions["masks"]) > 0:
+                mask = decode_mask(predictions["masks"][i])
+                ys = np.flatnonzero(mask.any(axis=1))
+                xs = np.flatnonzero(mask.any(axis=0))
+                if len(ys) > 0:
+                    crop = mask[ys[0]:ys[-1] + 1, xs[0]:xs[-1] + 1].copy()
+                    detection["mask"] = (crop, offset_x + xs[0], offset_y + ys[0])
+            detections.append(detection)
+        return detections
+
+    def _merge(self, detections):
+        """ Greedy non-maximum suppression where the kept detection absorbs the ones it suppresses
+        """
+        detections = sorted(detections, key=lambda d: -d["score"])
+        kept = list()
+        for detection in detections:
+            for other in kept:
+                if other["pred_class"] == detection["pred_class"] and \
+                        box_overlap(other["box"], detection["box"]) > self.iou_threshold:
+                    other["box"] = [min(other["box"][0], detection["box"][0]), min(other["box"][1], detection["box"][1]),
+                                    max(other["box"][2], detection["box"][2]), max(other["box"][3], detection["box"][3])]
+                    other["mask"] = union_crops(other["mask"], detection["mask"])
+                    if "polygons" in other["extra"]: # the merged region is described by its box
+                        x1, y1, x2, y2 = other["box"]
+                        other["extra"]["polygons"] = np.array([[x1, y1], [x2, y1], [x2, y2], [x1, y2]])
+                    break
+            else:
+                kept.append(detection)
+        return kept
+
+    def _format_predictions(self, template, detections, size):
+        predictions = {key: template[key] for key in GLOBAL_KEYS if key in template}
+        pred_classes = np.array([d["pred_class"] for d in detections], dtype=np.int64)
+        predictions["pred_classes"] = pred_classes
+        predictions["pred_labels"] = [name for name, class_id in template["name2int"].items() 
+                                      if class_id in pred_classes]
+        predictions["scores"] = np.array([d["score"] for d in detections], dtype=np.float64)
+        predictions["boxes"] = np.array([d["box"] for d in detections], dtype=np.int64).reshape(-1, 4)
+        if any(d["mask"] is not None for d in detections):
+            empty = (np.zeros((0, 0), dtype=bool), 0, 0)
+            predictions["masks"] = [encode_rle_from_crop(crop, (x, y), size)
+                                    for crop, x, y in (d["mask"] or empty for d in detections)]
+        else:
+            predictions["masks"] = []
+        predictions["instance_ids"] = get_instance_ids(pred_classes)
+        for key in template:
+            if key not in predictions:
+                predictions[key] = [d["extra"][key] for d in detections if key in d["extra"]]
+        if "polygons" in predictions:
+            predictions["polygons"] = np.array(predictions["polygons"], dtype=np.int64).reshape(-1, 4, 2)
+        return predictions
+
+
+def box_overlap(box, other):
+    """ Returns the area of the intersection of two boxes (x1,y1,x2,y2) divided by the area of the smaller one
+    """
+    w = min(box[2], other[2]) - max(box[0], other[0])
+    h = min(box[3], other[3]) - max(box[1], other[1])
+    if w <= 0 or h <= 0:
+        return 0
+    smaller = min((box[2] - box[0]) * (box[3] - box[1]), (other[2] - other[0]) * (other[3] - other[1]))
+    return w * h / max(1, smaller)
+
+
+def union_crops(crop, other):
+    """ Returns the union of two masks given as (cropped mask, x, y), None being an empty mask
+    """
+    if crop is None or other is None:
+        return crop if other is None else other
+    (a, ax, ay), (b, bx, by) = crop, other
+    x1, y1 = min(ax, bx), min(ay, by)
+    x2, y2 = max(ax + a.shape[1], bx + b.shape[1]), max(ay + a.shape[0], by + b.shape[0])
+    result = np.zeros((y2 - y1, x2 - x1), dtype=bool)
+    result[ay - y1:ay - y1 + a.shape[0], ax - x1:ax - x1 + a.shape[1]] |= a
+    result[by - y1:by - y1 + b.shape[0], bx - x1:bx - x1 + b.shape[1]] |= b
+    return result, x1, y1
+
+
+def derive_image_key(image, derived, suffix):
+    """ Returns the key of an image derived from another one (e.g. a downscaled copy or a tile), given the key of the
+        original image (see hooks.image_keys) and a suffix describing the transformation. None if the original image
+        has no key
+    """
+    if derived is image:
+        return hooks.get_image_key(image)
+    key = hooks.get_image_key(image)
+    return None if key is None else f"{key}@{suffix}"
+
+
+def rescale_boxes(boxes, small_size, size):
+    """ Scales boxes (x1,y1,x2,y2) from an image of size small_size (height, width) to an image of size size
+        The boxes are rounded outwards, so they still cover the whole object
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    h, w = size[:2]
+    fy, fx = h / small_size[0], w / small_size[1]
+    result = np.empty(boxes.shape, dtype=np.int64)
+    result[:, [0, 1]] = np.floor(boxes[:, [0, 1]] * [fx, fy])
+    result[:, [2, 3]] = np.ceil(boxes[:, [2, 3]] * [fx, fy])
+    result[:, [0, 2]] = np.clip(result[:, [0, 2]], 0, w)
+    result[:, [1, 3]] = np.clip(result[:, [1, 3]], 0, h)
+    return result
+
+
+def rescale_polygons(polygons, small_size, size):
+    """ Scales polygons (array of shape (n, k, 2) of points (x, y)) from an image of size small_size (height, width) to
+        an image of size size
+    """
+    polygons = np.asarray(polygons, dtype=np.float64)
+    h, w = size[:2]
+    scale = [w / small_size[1], h / small_size[0]]
+    return np.clip(np.round(polygons * scale), 0, [w, h]).astype(np.int64)
+
+
+def rescale_mask(mask, size):
+    """ Returns the RLE of a mask (RLE or dense) scaled to size (height, width). Only the part of the mask
+        enclosing the object is resized
+    """
+    small = decode_mask(mask)
+    h, w = size[:2]
+    ys = np.flatnonzero(small.any(axis=1))
+    xs = np.flatnonzero(small.any(axis=0))
+    if len(ys) == 0:
+        return encode_rle_from_crop(np.zeros((0, 0), dtype=bool), (0, 0), size)
+    fy, fx = h / small.shape[0], w / small.shape[1]
+    x1, x2 = int(np.floor(xs[0] * fx)), min(w, int(np.ceil((xs[-1] + 1) * fx)))
+    y1, y2 = int(np.floor(ys[0] * fy)), min(h, int(np.ceil((ys[-1] + 1) * fy)))
+    crop = small[ys[0]:ys[-1] + 1, xs[0]:xs[-1] + 1].astype(np.uint8) * 255
+    crop = cv2.resize(crop, (x2 - x1, y2 - y1), interpolation=cv2.INTER_LINEAR) > 127
+    return encode_rle_from_crop(crop, (x1, y1), size)
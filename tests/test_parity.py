@@ -0,0 +1,41 @@
+""" Parity of the onnx backend (float and INT8) with the torch models, on the images of tests/fixtures/parity (see
+    benchmarks/parity.py). A model is skipped if onnxruntime, its deep learning library or its weights are missing
+
+    Usage (from the root folder):
+        python -m pytest tests/test_parity.py
+"""
+from pathlib import Path
+
+import pytest
+
+from benchmarks.parity import compare_variants, get_detector_config, is_ok, parse_params
+
+ROOT_DIR = Path(__file__).parent.parent
+FIXTURES_DIR = ROOT_DIR / "tests" / "fixtures" / "parity"
+ARTIFACTS_DIR = ROOT_DIR / "image_anonymiser" / "models" / "artifacts" # as in models/detectors.py (not imported: it
+                                                                       # needs all the deep learning libraries)
+BCONFIG = "config.yml"
+
+# model name -> (module of the model, weights needed in the artifacts folder)
+MODELS = {"Face detection": ("facenet_pytorch", []),
+          "Person detection": ("detectron2", ["model_final_c10459.pkl"]),
+          "Text detection": ("easyocr", ["craft_mlt_25k.pth"])}
+
+# variant -> (minimum recall and precision, minimum mean IoU of the matched boxes and masks)
+VARIANTS = {"backend=onnx": (0.95, 0.9),
+            "backend=onnx,quantization=int8": (0.8, 0.8)}
+
+
+@pytest.mark.parametrize("variant", VARIANTS)
+@pytest.mark.parametrize("model", MODELS)
+def test_parity(model, variant):
+    pytest.importorskip("onnxruntime")
+    module, weights = MODELS[model]
+    pytest.importorskip(module)
+    missing = [name for name in weights if not (ARTIFACTS_DIR / name).is_file()]
+    if missing:
+        pytest.skip(f"missing weights: {missing} (see models/artifacts/get_model_weights.sh)")
+    _, (result,) = compare_variants(get_detector_config(BCONFIG, model), [parse_params(variant)], FIXTURES_DIR)
+    min_recall, min_iou = VARIANTS[variant]
+    assert result["detections"] > 0, "the fixtures don't contain any target of the model"
+    assert is_ok(result, min_recall, min_iou), result